@@ -0,0 +1,7 @@
+"""
+Benchmark package for the application
+
+It builds a database of configurable size with synthetic data and drives every route
+through the Flask test client, reporting latency, SQL query count and peak memory.
+See benchmark/__main__.py for usage.
+"""
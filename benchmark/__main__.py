@@ -0,0 +1,106 @@
+import argparse
+import json
+import subprocess
+import sys
+from datetime import datetime
+from surgery import app
+from benchmark.data import DataSize, use_database, build_database
+from benchmark.routes import run
+
+"""
+This script runs the benchmark of routes
+
+[Usage]
+python -m benchmark [--patients 2000] [--appointments 10000] ... [--repeat 20] [--output results.json]
+ ->Build a temporary database, measure every route and write results as JSON
+python -m benchmark --compare baseline.json [--tolerance 0.25]
+ ->Also compare with results of another commit and exit with 1 if any route regressed
+python -m benchmark --only reception login
+ ->Measure only routes whose names contain the specified words
+"""
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compare results with a baseline
+    A route regresses if its p95 latency is slower than the baseline by more than the tolerance,
+    or if it runs more SQL queries than the baseline.
+
+    :param results:
+    :param baseline:
+    :param tolerance: allowed ratio of slowdown, such as 0.25
+    :return:
+     messages of regressions
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']}ms -> {result['p95_ms']}ms")
+        if result.get('queries', 0) > base.get('queries', 0):
+            regressions.append(f"{name}: queries {base['queries']} -> {result['queries']}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description='Benchmark of routes')
+    # Sizes default to the ones of DataSize
+    default = DataSize()
+    parser.add_argument('--doctors', type=int, default=default.doctors)
+    parser.add_argument('--nurses', type=int, default=default.nurses)
+    parser.add_argument('--patients', type=int, default=default.patients)
+    parser.add_argument('--appointments', type=int, default=default.appointments)
+    parser.add_argument('--prescriptions', type=int, default=default.prescriptions)
+    parser.add_argument('--future-ratio', type=float, default=default.future_ratio, help='ratio of appointments after today')
+    parser.add_argument('--repeat', type=int, default=20, help='number of measured requests of each route')
+    parser.add_argument('--login-threads', type=int, default=8, help='clients signing in at once')
+    parser.add_argument('--only', nargs='*', help='measure only routes whose names contain these words')
+    parser.add_argument('--database', help='database file to build. A temporary file is used by default.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write results as JSON')
+    parser.add_argument('--compare', help='results of another commit to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed ratio of p95 slowdown')
+    args = parser.parse_args()
+
+    size = DataSize(doctors=args.doctors, nurses=args.nurses, patients=args.patients, appointments=args.appointments,
+                    prescriptions=args.prescriptions, future_ratio=args.future_ratio)
+    # Routes deleting rows take one row per request from the end of the generated data
+    if min(size.nurses, size.patients, size.appointments, size.prescriptions) < args.repeat + 2:
+        parser.error('nurses, patients, appointments and prescriptions must be more than repeat + 1')
+
+    path = use_database(args.database)
+    with app.app_context():
+        build_database(size, seed=args.seed)
+    print(f'Database: {path} {size.to_dict()}')
+
+    results = {
+        'meta': {'commit': git_commit(), 'created_at': datetime.utcnow().isoformat(), 'size': size.to_dict(),
+                 'repeat': args.repeat},
+        'results': run(size, repeat=args.repeat, selected=args.only, login_threads=args.login_threads),
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results['results'], baseline['results'], args.tolerance)
+        for message in regressions:
+            print(f'Regression: {message}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import os
+import random
+import tempfile
+from datetime import datetime, date, time, timedelta
+from surgery import app, db
+from surgery.models import User, HealthcareProfessional, Doctor, Nurse, Patient, Appointment, Prescription, \
+    APPOINTMENT_HOURS, PATIENT_QUOTA
+from surgery.analytics import rebuild_rollups
+
+"""
+This script builds a database filled with synthetic data for benchmarks
+Rows are inserted by executemany statements, so large databases are built in seconds.
+"""
+
+# User to sign in. This user is the first doctor.
+USERNAME = 'David'
+PASSWORD = 'cat'
+
+# Number of rows inserted by one statement
+BATCH_SIZE = 5000
+
+
+class DataSize(object):
+    """
+    Class that represents the number of rows of each table
+    """
+    def __init__(self, doctors: int = 10, nurses: int = 30, patients: int = 2000, appointments: int = 10000,
+                 prescriptions: int = 10000, future_ratio: float = 0.2):
+        self.doctors = max(doctors, 1)
+        self.nurses = nurses
+        # Patients more than the quota of all doctors cannot be registered
+        self.patients = max(min(patients, self.doctors * PATIENT_QUOTA), 1)
+        self.appointments = appointments
+        self.prescriptions = prescriptions
+        # Ratio of appointments scheduled after today
+        self.future_ratio = future_ratio
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+def use_database(path: str = None) -> str:
+    """
+    Switch the application to a database file for the benchmark
+
+    :param path: database file. A temporary file is used if it is not specified.
+    :return:
+     path: str
+    """
+    path = path or os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['JOB_RUNNER_AUTOSTART'] = False
+
+    return path
+
+
+def insert_batches(table, rows):
+    """
+    Insert rows into the table by executemany statements of BATCH_SIZE rows
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+
+
+def build_database(size: DataSize, seed: int = 0):
+    """
+    Create tables and insert synthetic data of the specified size
+
+    :param size:
+    :param seed: seed of random values, so that the same data is built every time
+    """
+    rand = random.Random(seed)
+    now = datetime.utcnow()
+    db.create_all()
+
+    # Healthcare professionals: doctors first, then nurses
+    staff = [(i + 1, 'doctor', USERNAME if i == 0 else f'Doctor{i}', f'D{i:04d}') for i in range(size.doctors)]
+    staff += [(size.doctors + i + 1, 'nurse', f'Nurse{i}', f'N{i:04d}') for i in range(size.nurses)]
+    insert_batches(HealthcareProfessional.__table__, ({'id': id, 'name': name, 'employee_num': num, 'employee_type': kind,
+                                                      'created_at': now} for id, kind, name, num in staff))
+    # Patients are assigned to doctors in turn, so the first ones have one more patient
+    insert_batches(Doctor.__table__, ({'id': id, 'patient_count': size.patients // size.doctors +
+                                       (1 if id <= size.patients % size.doctors else 0)}
+                                      for id, kind, _, _ in staff if kind == 'doctor'))
+    insert_batches(Nurse.__table__, ({'id': id} for id, kind, _, _ in staff if kind == 'nurse'))
+
+    user = User(username=USERNAME, employee_num=staff[0][3])
+    user.set_password(PASSWORD)
+    db.session.add(user)
+
+    # Patients are assigned to doctors in turn, so that no doctor goes over the quota
+    insert_batches(Patient.__table__, ({'id': i + 1, 'name': f'Patient{i}', 'address': f'{i} High Street',
+                                        'phone': f'{rand.randrange(10 ** 9, 10 ** 10)}', 'doctor_id': i % size.doctors + 1,
+                                        'created_at': now - timedelta(minutes=i)} for i in range(size.patients)))
+
+    # Appointments fill slots of each staff in date order from the past,
+    # and future_ratio of them are after today
+    slots_per_staff = -(-size.appointments // len(staff))
+    past_slots = int(slots_per_staff * (1 - size.future_ratio))
+    first_day = date.today() + timedelta(days=1) - timedelta(days=-(-past_slots // len(APPOINTMENT_HOURS)))
+
+    def appointments():
+        for i in range(size.appointments):
+            slot = i // len(staff)
+            day = first_day + timedelta(days=slot // len(APPOINTMENT_HOURS))
+            yield {'id': i + 1, 'type': rand.choice(['Consultation', 'Prescription', 'Surgery']), 'staff_id': i % len(staff) + 1,
+                   'patient_id': rand.randrange(size.patients) + 1, 'created_by': USERNAME, 'created_at': now,
+                   'date': datetime.combine(day, time(hour=APPOINTMENT_HOURS[slot % len(APPOINTMENT_HOURS)]))}
+    insert_batches(Appointment.__table__, appointments())
+
+    # Prescriptions are issued every hour, so that analytics report on more than a year of them
+    insert_batches(Prescription.__table__, ({'id': i + 1, 'type': rand.choice(['Tablet', 'Powder', 'Ointment']),
+                                             'patient_id': rand.randrange(size.patients) + 1,
+                                             'doctor_id': rand.randrange(size.doctors) + 1,
+                                             'quantity': rand.randint(1, 30), 'dosage': rand.randint(1, 50) / 10,
+                                             'created_at': now - timedelta(hours=i)} for i in range(size.prescriptions)))
+    db.session.commit()
+    # Prescriptions are inserted without the session, so rollups are counted from them
+    rebuild_rollups()
@@ -0,0 +1,291 @@
+import contextlib
+import io
+import threading
+import time
+import tracemalloc
+from datetime import date, timedelta
+from sqlalchemy import event
+from surgery import app, db
+from surgery.models import AppointmentSchedule
+from benchmark.data import DataSize, USERNAME, PASSWORD
+
+"""
+This script drives every route through the Flask test client and measures it
+For each route, latency(p50/p95), SQL query count and peak memory of a request are reported.
+"""
+
+
+class Scenario(object):
+    """
+    Class that represents how a route is requested in a benchmark
+    """
+    def __init__(self, name: str, request, signed_in: bool = True, prepare=None):
+        """
+        :param name: name of the result, such as 'GET /reception'
+        :param request: function(client, i) that sends the i-th request and returns the response
+        :param signed_in: True if the request is sent by a signed in client
+        :param prepare: function(client) called before each request, which is not measured
+        """
+        self.name = name
+        self.request = request
+        self.signed_in = signed_in
+        self.prepare = prepare
+
+
+def sign_in(client):
+    response = client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+    assert response.status_code == 302, 'Sign in failed'
+
+
+def scenarios(size: DataSize) -> list[Scenario]:
+    """
+    Scenarios for every route in routes.py
+    Requests that delete rows take them from the end of the generated data, one per request.
+
+    :param size:
+    :return:
+     scenarios: list[Scenario]
+    """
+    # Far future dates are free, so that every booking succeeds
+    booking_day = date.today() + timedelta(days=3650)
+
+    def make_appointment(client, i):
+        return client.post('/make_appointment', data={
+            'type': 'Consultation', 'staff_name': USERNAME, 'patient_name': f'Booked{i}', 'patient_address': 'Address',
+            'patient_phone': '0123456789', 'date': (booking_day + timedelta(days=i)).isoformat(), 'time': '9:00'})
+
+    def issue_prescription(client, i):
+        return client.post('/issue_prescription', data={'type': 'Tablet', 'patient_name': 'Patient0', 'quantity': 10,
+                                                         'dosage': '1.5'})
+
+    def register_patient(client, i):
+        return client.post('/register_patient', data={'name': f'Registered{i}', 'address': 'Address', 'phone': '0123456789',
+                                                       'doctor_name': f'Doctor{size.doctors - 1}'})
+
+    def register_healthcare_pro(client, i):
+        return client.post('/register_healthcare_pro', data={'type': 'nurse', 'name': f'Staff{i}',
+                                                              'employee_num': f'B{i:04d}'})
+
+    # ETag of the last response of the API, sent back by a polling client
+    etags = {}
+
+    def read_etag(client):
+        etags['appointments'] = client.get('/api/v1/appointments').headers['ETag']
+
+    def poll_appointments(client, i):
+        if 'appointments' not in etags:
+            read_etag(client)
+        return client.get('/api/v1/appointments', headers={'If-None-Match': etags['appointments']})
+
+    return [
+        Scenario('GET /login', lambda client, i: client.get('/login'), signed_in=False),
+        Scenario('POST /login', lambda client, i: client.post('/login', data={'username': USERNAME, 'password': PASSWORD}),
+                 signed_in=False, prepare=lambda client: client.get('/logout')),
+        Scenario('GET /logout', lambda client, i: client.get('/logout'), signed_in=False, prepare=sign_in),
+        Scenario('GET /index', lambda client, i: client.get('/index')),
+        Scenario('GET /reception', lambda client, i: client.get('/reception')),
+        Scenario('GET /reception?sort=-date', lambda client, i: client.get('/reception?sort=-date&page_size=200')),
+        Scenario('GET /make_appointment', lambda client, i: client.get('/make_appointment')),
+        Scenario('POST /make_appointment', make_appointment),
+        Scenario('POST /cancel_appointment', lambda client, i: client.post(f'/cancel_appointment/{size.appointments - i}')),
+        Scenario('GET /prescription', lambda client, i: client.get('/prescription')),
+        Scenario('GET /issue_prescription', lambda client, i: client.get('/issue_prescription')),
+        Scenario('POST /issue_prescription', issue_prescription),
+        Scenario('POST /cancel_prescription', lambda client, i: client.post(f'/cancel_prescription/{size.prescriptions - i}')),
+        Scenario('GET /patient', lambda client, i: client.get('/patient')),
+        Scenario('GET /register_patient', lambda client, i: client.get('/register_patient')),
+        Scenario('POST /register_patient', register_patient),
+        Scenario('POST /delete_patient', lambda client, i: client.post(f'/delete_patient/{size.patients - i}')),
+        Scenario('GET /api/v1/appointments', lambda client, i: client.get('/api/v1/appointments')),
+        Scenario('GET /api/v1/appointments (304)', poll_appointments, prepare=read_etag),
+        Scenario('GET /api/v1/availability', lambda client, i: client.get('/api/v1/availability?n=10')),
+        Scenario('GET /api/v1/availability (doctor)', lambda client, i: client.get('/api/v1/availability?n=10&type=doctor')),
+        Scenario('GET /api/v1/analytics/prescriptions',
+                 lambda client, i: client.get('/api/v1/analytics/prescriptions?group=month,type')),
+        Scenario('GET /api/v1/analytics/prescriptions (doctor)',
+                 lambda client, i: client.get('/api/v1/analytics/prescriptions?group=doctor')),
+        Scenario('GET /search/patients', lambda client, i: client.get(f'/search/patients?q=Patient{i}')),
+        Scenario('GET /search/staff', lambda client, i: client.get('/search/staff?q=Doc')),
+        Scenario('GET /healthcare_pro', lambda client, i: client.get('/healthcare_pro')),
+        Scenario('GET /register_healthcare_pro', lambda client, i: client.get('/register_healthcare_pro')),
+        Scenario('POST /register_healthcare_pro', register_healthcare_pro),
+        Scenario('POST /delete_healthcare_pro',
+                 lambda client, i: client.post(f'/delete_healthcare_pro/{size.doctors + size.nurses - i}')),
+    ]
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Get the p-th percentile by nearest rank
+    """
+    values = sorted(values)
+    return values[max(int(round(p / 100 * len(values))) - 1, 0)]
+
+
+class QueryCounter(object):
+    """
+    Count SQL statements executed on the database
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def measure(scenario: Scenario, repeat: int, start: int) -> dict:
+    """
+    Send requests of the scenario and measure them
+
+    :param scenario:
+    :param repeat: number of measured requests
+    :param start: index given to the first request, so that requests do not reuse data
+    :return:
+     result: dict
+    """
+    engine = db.get_engine(app)
+    counter = QueryCounter()
+    latencies = []
+    queries = []
+    # Messages printed by Controller functions are discarded
+    with contextlib.redirect_stdout(io.StringIO()):
+        client = app.test_client()
+        if scenario.signed_in:
+            sign_in(client)
+        # The first request warms up caches and is not measured
+        scenario.request(client, start)
+        event.listen(engine, 'before_cursor_execute', counter)
+        try:
+            for i in range(start + 1, start + 1 + repeat):
+                if scenario.prepare:
+                    event.remove(engine, 'before_cursor_execute', counter)
+                    scenario.prepare(client)
+                    event.listen(engine, 'before_cursor_execute', counter)
+                counter.count = 0
+                started = time.perf_counter()
+                response = scenario.request(client, i)
+                latencies.append((time.perf_counter() - started) * 1000)
+                queries.append(counter.count)
+                assert response.status_code < 500, f'{scenario.name} returned {response.status_code}'
+        finally:
+            event.remove(engine, 'before_cursor_execute', counter)
+
+        # Peak memory is measured by another request, since tracing slows requests down
+        if scenario.prepare:
+            scenario.prepare(client)
+        tracemalloc.start()
+        try:
+            scenario.request(client, start + 1 + repeat)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'requests': repeat,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'queries': max(queries),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def measure_schedule(repeat: int) -> dict:
+    """
+    Measure AppointmentSchedule.find_next_available without a request
+    """
+    latencies = []
+    with app.app_context():
+        for _ in range(repeat):
+            started = time.perf_counter()
+            AppointmentSchedule().find_next_available()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    return {'requests': repeat, 'p50_ms': round(percentile(latencies, 50), 3), 'p95_ms': round(percentile(latencies, 95), 3)}
+
+
+def measure_concurrent_logins(threads: int, logins: int) -> dict:
+    """
+    Sign in from parallel clients and measure latencies of sign-ins and of a list screen requested meanwhile
+    Each thread signs in logins times, so that sign-ins compete for the password hasher.
+
+    :param threads: number of clients signing in at once
+    :param logins: number of sign-ins of each client
+    :return:
+     result: dict
+    """
+    latencies = []
+    other_latencies = []
+    statuses = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads + 1)
+
+    def sign_in_repeatedly():
+        client = app.test_client()
+        barrier.wait()
+        for _ in range(logins):
+            started = time.perf_counter()
+            response = client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+            elapsed = (time.perf_counter() - started) * 1000
+            client.get('/logout')
+            with lock:
+                latencies.append(elapsed)
+                statuses.append(response.status_code)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        workers = [threading.Thread(target=sign_in_repeatedly) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        # A signed in user keeps reading a list screen while others sign in
+        client = app.test_client()
+        sign_in(client)
+        barrier.wait()
+        started = time.perf_counter()
+        while any(worker.is_alive() for worker in workers):
+            request_started = time.perf_counter()
+            client.get('/healthcare_pro')
+            other_latencies.append((time.perf_counter() - request_started) * 1000)
+        elapsed = time.perf_counter() - started
+        for worker in workers:
+            worker.join()
+
+    return {
+        'requests': len(latencies),
+        'threads': threads,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'logins_per_second': round(len(latencies) / elapsed, 1),
+        'refused': sum(status == 503 for status in statuses),
+        'other_p95_ms': round(percentile(other_latencies, 95), 3),
+    }
+
+
+def run(size: DataSize, repeat: int, selected: list[str] = None, login_threads: int = 8) -> dict:
+    """
+    Measure every scenario
+
+    :param size: size of the database, used to choose rows to delete
+    :param repeat: number of measured requests of each scenario
+    :param selected: names of scenarios to run. All scenarios run if it is not specified.
+    :param login_threads: number of clients signing in at once in the concurrent sign-in benchmark
+    :return:
+     results keyed by scenario name
+    """
+    results = {}
+    for scenario in scenarios(size):
+        if selected and not any(name in scenario.name for name in selected):
+            continue
+        # Every scenario starts at index 0. Scenarios that write rows use names of their own, such as Booked{i} and
+        # Registered{i}, and ones that delete rows take them from the end of their own tables, at most repeat + 2 rows.
+        results[scenario.name] = measure(scenario, repeat=repeat, start=0)
+        print(f'{scenario.name}: {results[scenario.name]}')
+
+    if not selected or any(name in 'AppointmentSchedule.find_next_available' for name in selected):
+        results['AppointmentSchedule.find_next_available'] = measure_schedule(repeat)
+        print(f"AppointmentSchedule.find_next_available: {results['AppointmentSchedule.find_next_available']}")
+
+    if not selected or any(name in 'POST /login concurrent' for name in selected):
+        results['POST /login concurrent'] = measure_concurrent_logins(login_threads, logins=max(repeat // 4, 1))
+        print(f"POST /login concurrent: {results['POST /login concurrent']}")
+
+    return results
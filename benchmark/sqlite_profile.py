@@ -0,0 +1,129 @@
+import argparse
+import json
+import random
+import threading
+import time
+from sqlalchemy.exc import OperationalError
+from surgery import app, db
+from surgery.models import Appointment, AppointmentSchedule, Prescription
+from benchmark.data import DataSize, use_database, build_database
+from benchmark.routes import percentile
+
+"""
+This script compares throughput of database engine profiles under mixed read/write load
+
+[Usage]
+python -m benchmark.sqlite_profile [--threads 8] [--seconds 10] [--write-ratio 0.2] [--output results.json]
+ ->Run the same load on the default and production profiles and print operations per second of each
+
+Each thread repeats either a read (a page of appointments and the next available date)
+or a write (a prescription committed in its own transaction) chosen at random.
+"""
+
+
+class LoadResult(object):
+    """
+    Class that accumulates results of operations of all threads
+    """
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        # Operations that failed with "database is locked"
+        self.locked = 0
+        self.latencies: list[float] = []
+        self.lock = threading.Lock()
+
+    def to_dict(self, seconds: float) -> dict:
+        return {
+            'operations_per_second': round((self.reads + self.writes) / seconds, 1),
+            'reads_per_second': round(self.reads / seconds, 1),
+            'writes_per_second': round(self.writes / seconds, 1),
+            'locked_errors': self.locked,
+            'p50_ms': round(percentile(self.latencies, 50), 3) if self.latencies else None,
+            'p95_ms': round(percentile(self.latencies, 95), 3) if self.latencies else None,
+        }
+
+
+def read():
+    Appointment.query.order_by(Appointment.date.desc(), Appointment.id.desc()).limit(50).all()
+    AppointmentSchedule().find_next_available()
+
+
+def write(rand: random.Random, size: DataSize):
+    db.session.add(Prescription(type='Tablet', patient_id=rand.randrange(size.patients) + 1, doctor_id=1, quantity=1,
+                                dosage=1.0))
+    db.session.commit()
+
+
+def worker(result: LoadResult, size: DataSize, write_ratio: float, deadline: float, seed: int):
+    rand = random.Random(seed)
+    while time.perf_counter() < deadline:
+        is_write = rand.random() < write_ratio
+        started = time.perf_counter()
+        with app.app_context():
+            try:
+                write(rand, size) if is_write else read()
+            except OperationalError:
+                db.session.rollback()
+                with result.lock:
+                    result.locked += 1
+                continue
+            finally:
+                db.session.remove()
+        elapsed = (time.perf_counter() - started) * 1000
+        with result.lock:
+            result.latencies.append(elapsed)
+            if is_write:
+                result.writes += 1
+            else:
+                result.reads += 1
+
+
+def run_profile(profile: str, size: DataSize, threads: int, seconds: float, write_ratio: float) -> dict:
+    """
+    Build a new database with the profile and run the load on it
+
+    :return:
+     result: dict
+    """
+    app.config['DATABASE_PROFILE'] = profile
+    use_database()
+    with app.app_context():
+        build_database(size)
+
+    result = LoadResult()
+    deadline = time.perf_counter() + seconds
+    workers = [threading.Thread(target=worker, args=(result, size, write_ratio, deadline, i)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    return result.to_dict(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmark.sqlite_profile',
+                                     description='Throughput of database engine profiles under mixed load')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--appointments', type=int, default=20000)
+    parser.add_argument('--output', help='file to write results as JSON')
+    args = parser.parse_args()
+
+    size = DataSize(appointments=args.appointments)
+    results = {}
+    for profile in ('default', 'production'):
+        results[profile] = run_profile(profile, size, threads=args.threads, seconds=args.seconds,
+                                       write_ratio=args.write_ratio)
+        print(f'{profile}: {results[profile]}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'threads': args.threads, 'seconds': args.seconds, 'write_ratio': args.write_ratio,
+                       'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
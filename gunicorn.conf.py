@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+
+"""
+This script is the configuration of gunicorn to run the application in production
+
+[Usage]
+gunicorn -c gunicorn.conf.py surgery:app
+ ->Run worker processes. Settings are given by environment variables below.
+kill -HUP <master pid>
+ ->Replace workers gracefully, letting them finish requests they are serving
+kill -USR2 <master pid>, then kill -TERM <old master pid>
+ ->Start a new master with new code next to the old one, then stop the old one gracefully.
+   The application is preloaded, so HUP alone does not load new code.
+
+SURGERY_BIND: address to listen on (127.0.0.1:8000)
+SURGERY_WORKERS: number of worker processes (number of cores)
+SURGERY_THREADS: number of threads in each worker (4)
+SURGERY_MAX_REQUESTS: number of requests after which a worker is replaced (1000, 0 for never)
+SURGERY_SECRET_KEY or SURGERY_SECRET_KEY_FILE: secret key shared by workers. See surgery/config.py
+SURGERY_SETTINGS: Python file overriding surgery/config.py
+"""
+
+# Workers use the production profile of the database unless another one is given
+os.environ.setdefault('SURGERY_DATABASE_PROFILE', 'production')
+
+bind = os.environ.get('SURGERY_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('SURGERY_WORKERS', multiprocessing.cpu_count()))
+# Threads let a worker serve other requests while streams of the reception board are open
+# Keep RECEPTION_MAX_STREAMS in surgery/config.py below the number of threads, so that streams do not take all of them
+worker_class = 'gthread'
+threads = int(os.environ.get('SURGERY_THREADS', 4))
+# The application is imported once by the master and shared by forked workers,
+# so that workers start quickly and an import error stops the server before it serves
+preload_app = True
+# Workers are replaced after a number of requests, at different times, to release memory they have grown
+max_requests = int(os.environ.get('SURGERY_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+# Seconds that a worker is given to finish its requests when it is stopped or replaced
+graceful_timeout = 30
+# Seconds without a heartbeat after which a worker is regarded as stuck and restarted
+# Open streams of the reception board are served by threads and do not stop the heartbeat.
+timeout = 60
+keepalive = 5
+
+
+def on_starting(server):
+    # Read the key in the master, so that workers share it even if the key file does not exist yet
+    from surgery import app
+    source = 'SURGERY_SECRET_KEY' if os.environ.get('SURGERY_SECRET_KEY') else app.config['SECRET_KEY_FILE']
+    server.log.info(f'Secret key is read from {source}')
+
+
+def post_fork(server, worker):
+    # Connections opened by the master must not be shared with workers
+    from surgery import app, db
+    db.get_engine(app).dispose()
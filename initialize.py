@@ -1,5 +1,13 @@
+import os
 import sys
+import time
 from surgery.models import User, Doctor
+from surgery.importer import PatientImporter
+from surgery.search import build_search_index
+from surgery.export import EXPORTS, export_to
+from surgery.jobs import JOB_FUNCTIONS, start_runner, submit_job
+from surgery.archive import archive_all
+from surgery.analytics import rebuild_rollups
 from surgery import db
 
 
@@ -11,6 +19,22 @@ python initialize.py drop
  ->Drop all tables on a database
 python initialize.py user
  ->Insert an initial user and doctor into a database
+python initialize.py import-patients <file> [batch size]
+ ->Import patients from a CSV or JSONL file with columns name, address, phone and doctor_name
+python initialize.py search-index
+ ->Create or rebuild search indexes of patients and staff
+python initialize.py recount-patients
+ ->Recount the number of patients stored with each doctor
+python initialize.py archive [batch size]
+ ->Move past appointments and old prescriptions into archive tables. Run it daily, such as by cron.
+python initialize.py rebuild-analytics
+ ->Count daily rollups of prescriptions for analytics again, including archived prescriptions
+python initialize.py worker [threads]
+ ->Run background jobs until interrupted
+python initialize.py submit <kind> [name=value ...]
+ ->Submit a background job, such as "submit import-patients path=patients.csv"
+python initialize.py export <appointments|prescriptions|patients> <file> [date from] [date to]
+ ->Export all rows, or rows in the date range(YYYY-MM-DD), into a CSV or NDJSON(.ndjson, .jsonl) file. "-" writes CSV to stdout.
 """
 
 
@@ -41,6 +65,92 @@ def add_user():
         print(user.employee_num, user.username)
 
 
+def import_patients(path: str, batch_size: int = None):
+    """
+    Import patients from a file and print errors of rows that are not imported
+    """
+    report = PatientImporter(batch_size=batch_size).run(path)
+    report.print()
+
+
+def rebuild_search_index():
+    """
+    Create or rebuild search indexes from the patient and healthcare_pro tables
+    """
+    build_search_index(replace=True)
+    print('Search indexes are rebuilt')
+
+
+def recount_patients():
+    """
+    Recount the number of patients of each doctor from the patient table
+    """
+    Doctor.recount_patients()
+    print('Numbers of patients are recounted')
+
+
+def export(resource: str, path: str, date_from: str = None, date_to: str = None):
+    """
+    Export rows of the resource into a file
+    The format is chosen by the extension of the file.
+    """
+    if resource not in EXPORTS:
+        print(f'Unknown resource: {resource}. Choose from {", ".join(EXPORTS)}')
+        return
+
+    args = {'date_from': date_from or '', 'date_to': date_to or ''}
+    if path == '-':
+        export_to(sys.stdout, resource, 'csv', args)
+        return
+    export_format = 'ndjson' if os.path.splitext(path)[1] in ('.ndjson', '.jsonl') else 'csv'
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        export_to(file, resource, export_format, args)
+    print(f'Exported {resource} into {path}')
+
+
+def archive(batch_size: int = None):
+    """
+    Move appointments and prescriptions older than the horizons in configuration into archive tables
+    """
+    for resource, moved in archive_all(batch_size=batch_size).items():
+        print(f'Archived {resource}: {moved}')
+
+
+def rebuild_analytics():
+    """
+    Rebuild daily rollups of prescriptions from the prescription and prescription_archive tables
+    """
+    count = rebuild_rollups()
+    print(f'Analytics are rebuilt from {count} prescriptions')
+
+
+def run_worker(threads: int = None):
+    """
+    Run worker threads of background jobs until the process is interrupted
+    Running jobs are finished before the process exits.
+    """
+    runner = start_runner(threads)
+    print('Worker is running. Press Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print('Stopping after running jobs finish')
+        runner.stop()
+
+
+def submit(kind: str, *args: str):
+    """
+    Submit a background job with arguments given as name=value
+    """
+    if kind not in JOB_FUNCTIONS:
+        print(f'Unknown kind of job: {kind}. Choose from {", ".join(JOB_FUNCTIONS)}')
+        return
+
+    job_id = submit_job(kind, dict(arg.split('=', 1) for arg in args), created_by='initialize.py')
+    print(f'Submitted job {job_id}')
+
+
 def drop_all():
     """
     Drop all tables
@@ -54,4 +164,20 @@ if __name__ == '__main__':
         add_doctor()
         add_user()
     elif mode == 'drop':
-        drop_all()
\ No newline at end of file
+        drop_all()
+    elif mode == 'import-patients':
+        import_patients(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    elif mode == 'search-index':
+        rebuild_search_index()
+    elif mode == 'recount-patients':
+        recount_patients()
+    elif mode == 'archive':
+        archive(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    elif mode == 'rebuild-analytics':
+        rebuild_analytics()
+    elif mode == 'worker':
+        run_worker(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    elif mode == 'submit':
+        submit(*sys.argv[2:])
+    elif mode == 'export':
+        export(*sys.argv[2:6])
\ No newline at end of file
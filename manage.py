@@ -1,9 +1,31 @@
+import os
+import sys
 from surgery import app, db
 from surgery.models import User, Patient, Appointment, HealthcareProfessional
 
-# Run the application
-app.run(host='127.0.0.1', port=5000, debug=True)
+"""
+This script runs the application
+
+[Usage]
+python manage.py
+ ->Run the development server with the debugger on http://127.0.0.1:5000/
+python manage.py serve
+ ->Run threads in one process without the debugger, for hosts where gunicorn cannot be used.
+   The address is given by SURGERY_HOST and SURGERY_PORT.
+gunicorn -c gunicorn.conf.py surgery:app
+ ->Run worker processes in production. See gunicorn.conf.py
+"""
+
 
 @app.shell_context_processor
 def make_shell_context():
-    return {'db': db, 'User': User}
\ No newline at end of file
+    return {'db': db, 'User': User}
+
+
+if __name__ == '__main__':
+    # Run the application
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        app.run(host=os.environ.get('SURGERY_HOST', '127.0.0.1'), port=int(os.environ.get('SURGERY_PORT', 8000)),
+                debug=False, threaded=True)
+    else:
+        app.run(host='127.0.0.1', port=5000, debug=True)
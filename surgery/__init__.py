@@ -1,19 +1,30 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
+from surgery.database import SurgerySQLAlchemy
 
 app = Flask(__name__)
 
 # Setting configuration
 app.config.from_object('surgery.config')
+# Settings of a deployment can be given by a Python file named by SURGERY_SETTINGS
+app.config.from_envvar('SURGERY_SETTINGS', silent=True)
 
 # DB initialization
-db = SQLAlchemy(app)
+db = SurgerySQLAlchemy(app)
 migrate = Migrate(app, db)
 
 # Login Initialization
 login = LoginManager(app)
 login.login_view = 'login'
 
-import surgery.routes
\ No newline at end of file
+import surgery.routes
+import surgery.metrics
+import surgery.search
+import surgery.versions
+import surgery.analytics
+import surgery.api
+import surgery.board
+import surgery.export
+import surgery.cache
+import surgery.jobs
@@ -0,0 +1,278 @@
+from datetime import date, timedelta
+from sqlalchemy import event, inspect, select, func, union_all, cast, literal, bindparam, or_, and_, Integer
+from sqlalchemy.dialects.sqlite import insert
+from surgery import app, db
+from surgery.models import Prescription, PrescriptionArchive, PrescriptionRollup, PrescriptionHistogram, \
+    HealthcareProfessional, UnitOfWork
+from surgery.pagination import date_from_arg
+from surgery.routes import filter_by_name
+from surgery.versions import mark_changed
+
+"""
+This script defines analytics of prescriptions
+Counts and totals of prescriptions are kept per day, doctor and type in prescription_rollup,
+and the distributions of quantity and dosage are kept in buckets of ANALYTICS_BUCKETS in prescription_histogram.
+Both are also kept per month, and are updated in the transaction that issues or cancels a prescription.
+A report reads monthly rows for whole months in its range and daily rows only for the days at its ends,
+so a report over years reads a few rows per month instead of every prescription. Days are of created_at in UTC.
+Archival moves prescriptions without changing rollups, since rollups count archived prescriptions too.
+rebuild_rollups() counts them again from the prescription and prescription_archive tables,
+which is used after prescriptions are written without the session, or to repair rollups.
+"""
+
+# Measures whose distributions are kept
+MEASURES = ('quantity', 'dosage')
+# Columns that reports can be grouped by
+GROUPS = {
+    'day': func.strftime('%Y-%m-%d', PrescriptionRollup.day),
+    'month': func.strftime('%Y-%m', PrescriptionRollup.day),
+    'year': func.strftime('%Y', PrescriptionRollup.day),
+    'doctor': PrescriptionRollup.doctor_id,
+    'type': PrescriptionRollup.type,
+}
+DEFAULT_GROUPS = ('month', 'type')
+# Groups that need daily rows
+DAILY_GROUPS = ('day', )
+
+
+def bucket_of(measure: str, value) -> float:
+    """
+    Get the lower bound of the bucket of a quantity or dosage
+    It is truncated in the same way as CAST AS INTEGER of SQLite, so that rebuilt buckets are the same.
+    """
+    width = app.config['ANALYTICS_BUCKETS'][measure]
+
+    return float(int(float(value) / width) * width)
+
+
+def add_to_rollups(connection, values: dict, delta: int):
+    """
+    Add a prescription to rollups on the connection, or remove it by a negative delta
+    Counts are updated by expressions, so concurrent transactions do not lose each other's changes.
+    Rows whose count falls to 0 are deleted.
+
+    :param connection:
+    :param values: dict of doctor_id, type, quantity, dosage and created_at of the prescription
+    :param delta: 1 when issued, -1 when cancelled
+    """
+    if values['doctor_id'] is None or values['created_at'] is None:
+        return
+    day = values['created_at'].date()
+    keys = [{'grain': 'day', 'day': day, 'doctor_id': values['doctor_id'], 'type': values['type'] or ''},
+            {'grain': 'month', 'day': day.replace(day=1), 'doctor_id': values['doctor_id'], 'type': values['type'] or ''}]
+
+    rollup = PrescriptionRollup.__table__
+    statement = insert(rollup)
+    statement = statement.on_conflict_do_update(index_elements=[rollup.c.grain, rollup.c.day, rollup.c.doctor_id,
+                                                                rollup.c.type], set_={
+        'count': rollup.c.count + statement.excluded.count,
+        'total_quantity': rollup.c.total_quantity + statement.excluded.total_quantity,
+        'total_dosage': rollup.c.total_dosage + statement.excluded.total_dosage,
+    })
+    connection.execute(statement, [dict(key, count=delta, total_quantity=delta * (values['quantity'] or 0),
+                                        total_dosage=delta * float(values['dosage'] or 0)) for key in keys])
+    changed = {rollup: keys}
+
+    histogram = PrescriptionHistogram.__table__
+    rows = [dict(key, measure=measure, bucket=bucket_of(measure, values[measure]), count=delta)
+            for key in keys for measure in MEASURES if values[measure] is not None]
+    if rows:
+        statement = insert(histogram)
+        statement = statement.on_conflict_do_update(index_elements=[histogram.c.grain, histogram.c.measure, histogram.c.bucket,
+                                                                    histogram.c.day, histogram.c.doctor_id, histogram.c.type],
+                                                    set_={'count': histogram.c.count + statement.excluded.count})
+        connection.execute(statement, rows)
+        changed[histogram] = rows
+
+    if delta < 0:
+        # Rows are deleted by their primary keys
+        for table, changed_rows in changed.items():
+            names = [column.name for column in table.primary_key]
+            connection.execute(table.delete().where(*[table.c[name] == bindparam(f'key_{name}') for name in names],
+                                                    table.c.count <= 0),
+                               [{f'key_{name}': row[name] for name in names} for row in changed_rows])
+
+
+def rollup_values(prescription) -> dict:
+    """
+    Get the columns of a prescription that rollups are kept by
+    """
+    return {'doctor_id': prescription.doctor_id, 'type': prescription.type, 'quantity': prescription.quantity,
+            'dosage': prescription.dosage, 'created_at': prescription.created_at}
+
+
+@event.listens_for(Prescription, 'after_insert')
+def _count_issued_prescription(mapper, connection, target):
+    add_to_rollups(connection, rollup_values(target), 1)
+
+
+@event.listens_for(Prescription, 'after_delete')
+def _count_cancelled_prescription(mapper, connection, target):
+    add_to_rollups(connection, rollup_values(target), -1)
+
+
+@event.listens_for(Prescription, 'after_update')
+def _count_changed_prescription(mapper, connection, target):
+    # Histories are empty unless the columns are changed
+    state = inspect(target)
+    current = rollup_values(target)
+    previous = {name: state.attrs[name].history.deleted[0] if state.attrs[name].history.deleted else value
+                for name, value in current.items()}
+    if previous != current:
+        add_to_rollups(connection, previous, -1)
+        add_to_rollups(connection, current, 1)
+
+
+def rebuild_rollups() -> int:
+    """
+    Count rollups of every prescription again, including archived ones, in one transaction
+
+    :return:
+     count: number of prescriptions counted
+    """
+    rollup = PrescriptionRollup.__table__
+    histogram = PrescriptionHistogram.__table__
+    prescriptions = union_all(*[select(table.c.doctor_id, table.c.type, table.c.quantity, table.c.dosage, table.c.created_at)
+                                .where(table.c.doctor_id.isnot(None), table.c.created_at.isnot(None))
+                                for table in (Prescription.__table__, PrescriptionArchive.__table__)]).subquery()
+    prescription_type = func.coalesce(prescriptions.c.type, '')
+
+    with UnitOfWork():
+        db.session.execute(rollup.delete())
+        db.session.execute(histogram.delete())
+        for grain, day in (('day', func.date(prescriptions.c.created_at)),
+                           ('month', func.date(prescriptions.c.created_at, 'start of month'))):
+            db.session.execute(rollup.insert().from_select(
+                ['grain', 'day', 'doctor_id', 'type', 'count', 'total_quantity', 'total_dosage'],
+                select(literal(grain), day, prescriptions.c.doctor_id, prescription_type, func.count(),
+                       func.coalesce(func.sum(prescriptions.c.quantity), 0),
+                       func.coalesce(func.sum(prescriptions.c.dosage), 0))
+                .group_by(day, prescriptions.c.doctor_id, prescription_type)))
+            for measure in MEASURES:
+                width = app.config['ANALYTICS_BUCKETS'][measure]
+                bucket = cast(prescriptions.c[measure] * 1.0 / width, Integer) * width
+                db.session.execute(histogram.insert().from_select(
+                    ['grain', 'day', 'doctor_id', 'type', 'measure', 'bucket', 'count'],
+                    select(literal(grain), day, prescriptions.c.doctor_id, prescription_type, literal(measure), bucket,
+                           func.count())
+                    .where(prescriptions.c[measure].isnot(None))
+                    .group_by(day, prescriptions.c.doctor_id, prescription_type, bucket)))
+        # Rows are written by statements, so caches of both tables are invalidated here
+        mark_changed(rollup.name, histogram.name)
+        count = db.session.execute(select(func.coalesce(func.sum(rollup.c.count), 0))
+                                   .where(rollup.c.grain == 'day')).scalar()
+
+    return count
+
+
+def rollup_ranges(date_from: date, date_to: date, daily: bool = False) -> list[tuple]:
+    """
+    Split a range of days into whole months and the days at its ends
+
+    :param date_from: the first day, or None for no limit
+    :param date_to: the last day, or None for no limit
+    :param daily: True if only daily rows are read
+    :return:
+     ranges: list of (grain, first day, last day). The ends may be None for no limit.
+    """
+    if daily:
+        return [('day', date_from, date_to)]
+
+    first_month = date_from
+    if date_from and date_from.day != 1:
+        first_month = (date_from.replace(day=1) + timedelta(days=31)).replace(day=1)
+    # The first day of the month after the whole months
+    end_month = date_to
+    if date_to:
+        end_month = date_to.replace(day=1)
+        if (date_to + timedelta(days=1)).day == 1:
+            end_month = date_to + timedelta(days=1)
+    if first_month and end_month and first_month >= end_month:
+        return [('day', date_from, date_to)]
+
+    ranges = [('month', first_month, end_month - timedelta(days=1) if end_month else None)]
+    if date_from and date_from < first_month:
+        ranges.append(('day', date_from, first_month - timedelta(days=1)))
+    if date_to and end_month <= date_to:
+        ranges.append(('day', end_month, date_to))
+
+    return ranges
+
+
+def filter_rollups(query, model, args, daily: bool = False):
+    """
+    Filter a query on rollups by date_from, date_to, staff and type in request arguments
+    Both ends of the date range are inclusive days.
+
+    :param query:
+    :param model: PrescriptionRollup or PrescriptionHistogram
+    :param args: request arguments
+    :param daily: True if only daily rows are read
+    :return:
+     query
+    """
+    conditions = []
+    for grain, first, last in rollup_ranges(date_from_arg(args, 'date_from'), date_from_arg(args, 'date_to'), daily):
+        condition = [model.grain == grain]
+        if first:
+            condition.append(model.day >= first)
+        if last:
+            condition.append(model.day <= last)
+        conditions.append(and_(*condition))
+    query = query.filter(or_(*conditions))
+    query = filter_by_name(query, model.doctor_id, HealthcareProfessional, args.get('staff'))
+    if args.get('type'):
+        query = query.filter(model.type == args.get('type'))
+
+    return query
+
+
+def prescription_report(args) -> dict:
+    """
+    Report counts, totals and averages of prescriptions, and distributions of quantity and dosage
+    Rows are grouped by group in request arguments, a comma separated list of day, month, year, doctor and type.
+
+    :param args: request arguments with filters(date_from, date_to, staff, type) and group
+    :return:
+     report: dict of groups, items, total and distributions
+    """
+    groups = [name for name in dict.fromkeys((args.get('group') or ','.join(DEFAULT_GROUPS)).split(',')) if name in GROUPS]
+    columns = [GROUPS[name].label(name) for name in groups]
+    totals = [func.sum(PrescriptionRollup.count).label('count'),
+              func.sum(PrescriptionRollup.total_quantity).label('total_quantity'),
+              func.sum(PrescriptionRollup.total_dosage).label('total_dosage')]
+
+    daily = any(name in DAILY_GROUPS for name in groups)
+    query = filter_rollups(db.session.query(*columns, *totals), PrescriptionRollup, args, daily)
+    rows = query.group_by(*columns).order_by(*columns).all() if columns else query.all()
+    items = [summary(row._asdict()) for row in rows if row.count]
+    total = summary({name: sum(item[name] for item in items) for name in ('count', 'total_quantity', 'total_dosage')})
+    if 'doctor' in groups:
+        names = dict(db.session.query(HealthcareProfessional.id, HealthcareProfessional.name)
+                     .filter(HealthcareProfessional.id.in_({item['doctor'] for item in items})).all())
+        for item in items:
+            item['doctor_name'] = names.get(item['doctor'])
+
+    query = filter_rollups(db.session.query(PrescriptionHistogram.measure, PrescriptionHistogram.bucket,
+                                            func.sum(PrescriptionHistogram.count)), PrescriptionHistogram, args, daily)
+    distributions = {measure: [] for measure in MEASURES}
+    for measure, bucket, count in query.group_by(PrescriptionHistogram.measure, PrescriptionHistogram.bucket) \
+            .order_by(PrescriptionHistogram.measure, PrescriptionHistogram.bucket):
+        if count:
+            distributions[measure].append({'from': bucket, 'to': bucket + app.config['ANALYTICS_BUCKETS'][measure],
+                                           'count': count})
+
+    return {'groups': groups, 'items': items, 'total': total, 'distributions': distributions}
+
+
+def summary(values: dict) -> dict:
+    """
+    Add averages of quantity and dosage to counts and totals
+    """
+    count = values['count'] or 0
+    values.update(count=count, total_quantity=values['total_quantity'] or 0,
+                  total_dosage=round(values['total_dosage'] or 0, 6))
+    values['average_quantity'] = values['total_quantity'] / count if count else None
+    values['average_dosage'] = values['total_dosage'] / count if count else None
+
+    return values
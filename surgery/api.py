@@ -0,0 +1,328 @@
+import hashlib
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from flask import request, jsonify
+from flask_login import current_user
+from surgery import app
+from surgery.auth import current_identity
+from surgery.pagination import page_url
+from surgery.models import AppointmentSchedule, Receptionist, UnitOfWork, SlotUnavailableError, BookingConflict, \
+    APPOINTMENT_TYPES
+from surgery.routes import appointment_page, prescription_page, patient_page, healthcare_pro_page, doctor_page
+from surgery.analytics import prescription_report
+from surgery.versions import table_versions
+
+"""
+This script defines the JSON API (version 1) for list resources, booking and reports
+Each resource accepts the same filters, sort, cursor and page_size as its list screen.
+Responses carry a strong ETag and Last-Modified derived from the change counters of the tables they read,
+so a client polling with If-None-Match or If-Modified-Since gets 304 Not Modified by one query on table_version.
+"""
+
+API_PREFIX = '/api/v1'
+
+
+def api_login_required(doctor: bool = False):
+    """
+    Decorator for API functions that need a signed in user
+    Unlike login_required, it answers with a JSON error instead of redirecting to the Sign In page.
+
+    :param doctor: True if only doctor user is allowed
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_user.is_authenticated:
+                return jsonify({'error': 'Please sign in to use the API.'}), 401
+            if doctor and not current_identity().is_doctor:
+                return jsonify({'error': 'You are not authorized to perform this operation.'}), 403
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def entity_tag(resource: str, versions: dict) -> str:
+    """
+    Build the ETag of a response from the versions of the tables and the request arguments
+
+    :param resource: name of the resource
+    :param versions: versions keyed by table name
+    :return:
+     etag: str
+    """
+    args = sorted(request.args.items(multi=True))
+    digest = hashlib.sha1(repr(args).encode()).hexdigest()[:16]
+
+    return '-'.join([resource] + [str(versions[table]) for table in sorted(versions)] + [digest])
+
+
+def is_not_modified(etag: str, last_modified) -> bool:
+    """
+    Check the conditional headers of the request
+    If-None-Match takes precedence over If-Modified-Since.
+
+    :return:
+     True if the client has the current representation
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        since = request.if_modified_since
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        # HTTP dates have no fraction of seconds
+        return last_modified.replace(microsecond=0) <= since
+
+    return False
+
+
+def list_response(resource: str, tables: tuple, read_page):
+    """
+    Answer a list request, or 304 Not Modified if none of the tables has changed since the client read it
+
+    :param resource: name of the resource
+    :param tables: tables whose rows are in the response
+    :param read_page: function(args) that returns a KeysetPage
+    :return:
+     response
+    """
+    def read(args) -> dict:
+        page = read_page(args)
+        return {
+            'items': [item.to_dict() for item in page],
+            'sort': page.sort,
+            'page_size': page.page_size,
+            'next': page_url(cursor=page.next_cursor) if page.next_cursor else None,
+            'prev': page_url(cursor=page.prev_cursor) if page.prev_cursor else None,
+        }
+
+    return conditional_response(resource, tables, read)
+
+
+def conditional_response(resource: str, tables: tuple, read):
+    """
+    Answer a request by JSON, or 304 Not Modified if none of the tables has changed since the client read it
+
+    :param resource: name of the resource
+    :param tables: tables read by the response
+    :param read: function(args) that returns a dict of the response
+    :return:
+     response
+    """
+    versions, last_modified = table_versions(tables)
+    etag = entity_tag(resource, versions)
+    if is_not_modified(etag, last_modified):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(read(request.args))
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Clients may keep the response, but must revalidate it before use
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    return response
+
+
+@app.route(API_PREFIX + '/appointments')
+@api_login_required()
+def api_appointments():
+    """
+    API for appointments
+    Filters(date_from, date_to, staff, patient, type), sort, cursor, page_size and history are given by request arguments
+    """
+    return list_response('appointments', ('appointment', 'appointment_archive', 'healthcare_pro', 'patient'),
+                         appointment_page)
+
+
+@app.route(API_PREFIX + '/prescriptions')
+@api_login_required(doctor=True)
+def api_prescriptions():
+    """
+    API for prescriptions
+    Filters(date_from, date_to, staff, patient, type), sort, cursor, page_size and history are given by request arguments
+    """
+    return list_response('prescriptions', ('prescription', 'prescription_archive', 'healthcare_pro', 'patient'),
+                         prescription_page)
+
+
+@app.route(API_PREFIX + '/patients')
+@api_login_required(doctor=True)
+def api_patients():
+    """
+    API for patients
+    Filters(date_from, date_to, staff, patient), sort, cursor and page_size are given by request arguments
+    """
+    return list_response('patients', ('patient', 'healthcare_pro'), patient_page)
+
+
+@app.route(API_PREFIX + '/staff')
+@api_login_required(doctor=True)
+def api_staff():
+    """
+    API for healthcare professionals
+    Filters(date_from, date_to, staff, type), sort, cursor and page_size are given by request arguments
+    """
+    return list_response('staff', ('healthcare_pro', ), healthcare_pro_page)
+
+
+@app.route(API_PREFIX + '/doctors/capacity')
+@api_login_required()
+def api_doctor_capacity():
+    """
+    API for the number of patients and the remaining capacity of each doctor
+    Counts are stored with doctors, so patients are not counted. Filters(staff), sort, cursor and page_size are
+    given by request arguments.
+    """
+    # Counts change with patients, so the version of patient table is a part of the ETag
+    return list_response('doctor_capacity', ('doctor', 'healthcare_pro', 'patient'), doctor_page)
+
+
+@app.route(API_PREFIX + '/analytics/prescriptions')
+@api_login_required(doctor=True)
+def api_prescription_analytics():
+    """
+    API for counts, totals and averages of prescriptions, and distributions of quantity and dosage
+    Filters(date_from, date_to, staff, type) and groups(group, such as "month,type" or "doctor") are given by
+    request arguments. Reports are read from daily rollups, so they do not read prescriptions.
+    """
+    return conditional_response('prescription_analytics', ('prescription', 'prescription_rollup',
+                                                           'prescription_histogram', 'healthcare_pro'),
+                                prescription_report)
+
+
+@app.route(API_PREFIX + '/availability')
+@api_login_required()
+def api_availability():
+    """
+    API for the soonest slots in which staff can be booked
+    The number of options(n), staff name(staff) and staff type(type) are given by request arguments.
+    """
+    n = min(max(request.args.get('n', app.config['APPOINTMENT_OPTIONS'], type=int), 1), app.config['APPOINTMENT_MAX_OPTIONS'])
+    options = AppointmentSchedule().soonest(n, staff_type=request.args.get('type') or None,
+                                            staff_name=request.args.get('staff') or None)
+
+    return jsonify({'items': [{'date': slot.isoformat(), 'staff_id': staff_id, 'staff_name': staff_name}
+                              for slot, staff_id, staff_name in options]})
+
+
+def booking_response(receptionist: Receptionist, bookings: list[tuple], conflicts: list[BookingConflict],
+                     positions: list[int] = None):
+    """
+    Make the bookings and answer with the appointments made and the conflicts
+    Appointments are converted in the transaction, so that their staff and patients are not read again.
+
+    :param receptionist:
+    :param bookings: list of (appointment type, staff, patient, appointment date)
+    :param conflicts: conflicts found before booking, such as unknown names
+    :param positions: positions of the bookings in the request, if some items of the request are not booked
+    :return:
+     response: 201 if any appointment is made, 409 if none is made
+    """
+    try:
+        with UnitOfWork():
+            appointments, rejected = receptionist.make_appointments(bookings) if bookings else ([], [])
+            created = [appointment.to_dict() for appointment in appointments]
+    except SlotUnavailableError as e:
+        return jsonify({'error': str(e)}), 409
+
+    if positions is not None:
+        for conflict in rejected:
+            conflict.index = positions[conflict.index]
+    conflicts = sorted(conflicts + rejected, key=lambda conflict: conflict.index)
+    response = jsonify({'created': created, 'conflicts': [conflict.to_dict() for conflict in conflicts]})
+    response.status_code = 201 if created else 409
+
+    return response
+
+
+def parse_date(value) -> datetime:
+    """
+    Parse a date of the API in ISO 8601, such as 2022-01-31T09:00
+    Dates are local times of the surgery, so a date with a UTC offset is not accepted.
+
+    :return:
+     date: datetime (None if it is not a local date)
+    """
+    try:
+        date = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+    return date if date.tzinfo is None else None
+
+
+@app.route(API_PREFIX + '/appointments/recurring', methods=['POST'])
+@api_login_required()
+def api_recurring_appointments():
+    """
+    API for booking a recurring appointment
+    type, staff(name), patient(name), date of the first occurrence, every, unit(days or weeks) and count are given
+    by a JSON body or form data. Occurrences whose slots are taken are reported as conflicts, and the others are made.
+    """
+    data = request.get_json(silent=True) or request.form
+    receptionist = Receptionist(name=current_user.username, employee_num=current_user.employee_num)
+    first_date = parse_date(data.get('date'))
+    try:
+        every = int(data.get('every', 1))
+        count = int(data.get('count', 1))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'every and count must be numbers.'}), 400
+    if first_date is None or data.get('unit', 'weeks') not in ('days', 'weeks') or every < 1 \
+            or not 1 <= count <= app.config['APPOINTMENT_MAX_OCCURRENCES'] \
+            or data.get('type', 'Consultation') not in APPOINTMENT_TYPES:
+        return jsonify({'error': f"Give a local date without an offset, a type of {', '.join(APPOINTMENT_TYPES)}, "
+                                 f"every of 1 or more, unit of days or weeks and count of 1 to "
+                                 f"{app.config['APPOINTMENT_MAX_OCCURRENCES']}."}), 400
+
+    staff = receptionist.find_staff(name=data.get('staff'))
+    patient = receptionist.find_patient(name=data.get('patient'))
+    if staff is None or patient is None:
+        return jsonify({'error': 'Cannot find the staff or the patient. Please confirm the names.'}), 404
+
+    dates = AppointmentSchedule.recurring_dates(first_date, timedelta(**{data.get('unit', 'weeks'): every}), count)
+
+    return booking_response(receptionist, [(data.get('type', 'Consultation'), staff, patient, occurrence)
+                                           for occurrence in dates], [])
+
+
+@app.route(API_PREFIX + '/appointments/bulk', methods=['POST'])
+@api_login_required()
+def api_bulk_appointments():
+    """
+    API for booking several appointments at once
+    A JSON body has items, each of which has type, staff(name), patient(name) and date.
+    Staff and patients are read by one query each, and slots are checked by one query.
+    Items that cannot be booked are reported as conflicts with their index, and the others are made.
+    """
+    items = (request.get_json(silent=True) or {}).get('items')
+    if not isinstance(items, list) or not 1 <= len(items) <= app.config['APPOINTMENT_MAX_BULK'] \
+            or not all(isinstance(item, dict) for item in items):
+        return jsonify({'error': f"Give 1 to {app.config['APPOINTMENT_MAX_BULK']} items to book."}), 400
+    dates = [parse_date(item.get('date')) for item in items]
+    if None in dates:
+        return jsonify({'error': f'The date of item {dates.index(None)} is not a local date without an offset.'}), 400
+    types = [item.get('type', 'Consultation') in APPOINTMENT_TYPES for item in items]
+    if not all(types):
+        return jsonify({'error': f"The type of item {types.index(False)} is not one of "
+                                 f"{', '.join(APPOINTMENT_TYPES)}."}), 400
+
+    receptionist = Receptionist(name=current_user.username, employee_num=current_user.employee_num)
+    staff = receptionist.find_staff_by_names([str(item.get('staff')) for item in items])
+    patients = receptionist.find_patients_by_names([str(item.get('patient')) for item in items])
+    bookings = []
+    positions = []
+    conflicts = []
+    for index, (item, appointment_date) in enumerate(zip(items, dates)):
+        member = staff.get(str(item.get('staff')))
+        patient = patients.get(str(item.get('patient')))
+        if member is None or patient is None:
+            conflicts.append(BookingConflict(index, appointment_date, 'unknown_patient' if member else 'unknown_staff',
+                                             staff=member, patient=patient))
+            continue
+        bookings.append((item.get('type', 'Consultation'), member, patient, appointment_date))
+        positions.append(index)
+
+    return booking_response(receptionist, bookings, conflicts, positions)
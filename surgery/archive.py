@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, literal
+from surgery import app, db
+from surgery.models import Appointment, AppointmentArchive, Prescription, PrescriptionArchive, UnitOfWork
+from surgery.versions import mark_changed
+
+"""
+This script defines archival of past appointments and old prescriptions
+Rows older than the horizons in configuration are moved into archive tables with the same ids,
+so that the tables read by screens and availability checks stay at the size of the horizon however long the history is.
+Rows are moved in batches of ARCHIVE_BATCH_SIZE. Each batch is copied and deleted in its own short transaction,
+so a row is never lost or in both tables, and bookings are not blocked while a long history is archived.
+Archived rows are read as history by list screens and the API with history=1.
+"""
+
+# Tables that are archived, keyed by resource
+# (model, archive model, column compared with the horizon, setting of the horizon in days, current time)
+# Appointment dates are local time, and prescriptions are stamped in UTC.
+ARCHIVES = {
+    'appointments': (Appointment, AppointmentArchive, 'date', 'ARCHIVE_APPOINTMENT_DAYS', datetime.now),
+    'prescriptions': (Prescription, PrescriptionArchive, 'created_at', 'ARCHIVE_PRESCRIPTION_DAYS', datetime.utcnow),
+}
+
+
+def archive_horizon(resource: str) -> datetime:
+    """
+    Get the time before which rows of the resource are archived
+
+    :param resource: key of ARCHIVES
+    :return:
+     horizon: datetime
+    """
+    _, _, _, setting, now = ARCHIVES[resource]
+
+    return now() - timedelta(days=app.config[setting])
+
+
+def count_archivable(resource: str, before: datetime = None) -> int:
+    """
+    Count rows of the resource that are older than the horizon
+    """
+    model, _, column, _, _ = ARCHIVES[resource]
+    table = model.__table__
+    before = before or archive_horizon(resource)
+
+    return db.session.execute(select(func.count()).select_from(table).where(table.c[column] < before)).scalar()
+
+
+def archive_rows(resource: str, before: datetime = None, batch_size: int = None, on_batch=None) -> int:
+    """
+    Move rows of the resource older than the horizon into its archive table in batches
+
+    :param resource: key of ARCHIVES
+    :param before: rows before it are moved, archive_horizon() by default
+    :param batch_size: number of rows moved by one transaction, ARCHIVE_BATCH_SIZE by default
+    :param on_batch: function(number of rows) called after each batch is committed
+    :return:
+     moved: number of rows moved
+    """
+    model, archive_model, column, _, _ = ARCHIVES[resource]
+    table = model.__table__
+    archive = archive_model.__table__
+    before = before or archive_horizon(resource)
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    columns = [c.name for c in table.columns]
+    # The oldest rows are read by a range of the index on the column, and deleting them moves the range forward
+    oldest = select(table.c.id).where(table.c[column] < before).order_by(table.c[column]).limit(batch_size)
+
+    moved = 0
+    while True:
+        with UnitOfWork():
+            ids = db.session.execute(oldest).scalars().all()
+            if ids:
+                copied = select(*[table.c[name] for name in columns],
+                                literal(datetime.utcnow(), db.DateTime)).where(table.c.id.in_(ids))
+                db.session.execute(archive.insert().from_select(columns + ['archived_at'], copied))
+                db.session.execute(table.delete().where(table.c.id.in_(ids)))
+                # Rows are moved by statements, so caches of both tables are invalidated here
+                mark_changed(table.name, archive.name)
+        if not ids:
+            return moved
+        moved += len(ids)
+        if on_batch is not None:
+            on_batch(len(ids))
+
+
+def archive_all(batch_size: int = None, on_batch=None) -> dict:
+    """
+    Move rows older than the horizons of every resource into archive tables
+
+    :param batch_size: number of rows moved by one transaction, ARCHIVE_BATCH_SIZE by default
+    :param on_batch: function(number of rows) called after each batch is committed
+    :return:
+     moved: dict of the number of rows moved keyed by resource
+    """
+    return {resource: archive_rows(resource, batch_size=batch_size, on_batch=on_batch) for resource in ARCHIVES}
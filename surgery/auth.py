@@ -0,0 +1,190 @@
+import threading
+import time
+from functools import wraps
+from flask import current_app, flash, g, redirect, url_for
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from surgery import db, login
+from surgery.models import User, HealthcareProfessional, Doctor
+from surgery.versions import table_versions
+
+"""
+This script defines authorization used by Controller functions
+The user and the role of the signed in user are resolved once and cached for IDENTITY_CACHE_TTL seconds.
+The cache is cleared when User or HealthcareProfessional records are changed by the process.
+Changes made by other worker processes, such as a deleted user, are found by reading the versions of user and
+healthcare_pro tables at most once every IDENTITY_VERSION_CHECK_SECONDS, and identities cached at older versions
+are resolved again.
+"""
+
+# Tables whose versions are the stamp of cached identities
+IDENTITY_TABLES = ('user', 'healthcare_pro')
+
+
+class Identity(object):
+    """
+    Class that represents who the signed in user is during a request
+    """
+    def __init__(self, user: User, staff: HealthcareProfessional):
+        self.__user = user
+        self.__staff = staff
+
+    @property
+    def user(self) -> User:
+        return self.__user
+
+    @property
+    def role(self) -> str:
+        """
+        Employee type of the user, doctor or nurse. None if the user is not a healthcare professional.
+        """
+        return self.__staff.employee_type if self.__staff is not None else None
+
+    @property
+    def is_doctor(self) -> bool:
+        return isinstance(self.__staff, Doctor)
+
+    @property
+    def doctor(self) -> Doctor:
+        """
+        Doctor instance of the user. None if the user is not a doctor.
+        """
+        return self.__staff if self.is_doctor else None
+
+
+class IdentityCache(object):
+    """
+    Process-local cache of users and their staff records keyed by user id
+    Cached instances are detached from a session and merged into the session of each request without a query.
+    """
+    def __init__(self):
+        self.__entries: dict[int, tuple] = {}
+        self.__lock = threading.Lock()
+        # (database, versions of IDENTITY_TABLES) and when it is read
+        self.__stamp: tuple = None
+        self.__checked_at = 0.0
+
+    def get(self, user_id: int) -> Identity:
+        """
+        Get the identity of the user, resolving it from a database if it is not cached or expired
+
+        :param user_id:
+        :return:
+         identity: Identity (None if the user does not exist)
+        """
+        stamp = self.__current_stamp()
+        with self.__lock:
+            entry = self.__entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic() or entry[3] != stamp:
+            entry = self.__resolve(user_id, stamp)
+            if entry is None:
+                return None
+
+        _, user, staff, _ = entry
+        # merge(load=False) attaches a copy of the cached instance to the session without emitting SQL
+        user = db.session.merge(user, load=False)
+        staff = db.session.merge(staff, load=False) if staff is not None else None
+
+        return Identity(user=user, staff=staff)
+
+    def __current_stamp(self) -> tuple:
+        # Versions are read before rows, so a change made while resolving is resolved again at the next check
+        stamp = self.__stamp
+        database = current_app.config['SQLALCHEMY_DATABASE_URI']
+        if stamp is not None and stamp[0] == database and \
+                time.monotonic() < self.__checked_at + current_app.config['IDENTITY_VERSION_CHECK_SECONDS']:
+            return stamp
+
+        versions, _ = table_versions(IDENTITY_TABLES)
+        stamp = (database, tuple(versions[table] for table in IDENTITY_TABLES))
+        with self.__lock:
+            self.__stamp = stamp
+            self.__checked_at = time.monotonic()
+
+        return stamp
+
+    def __resolve(self, user_id: int, stamp: tuple) -> tuple:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        staff = HealthcareProfessional.query.filter_by(employee_num=user.employee_num).first()
+
+        # Detach the instances so that they can be shared across requests
+        db.session.expunge(user)
+        if staff is not None:
+            db.session.expunge(staff)
+        entry = (time.monotonic() + current_app.config['IDENTITY_CACHE_TTL'], user, staff, stamp)
+        with self.__lock:
+            self.__entries[user_id] = entry
+
+        return entry
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            # The versions are read again, since the change is counted by the same commit
+            self.__stamp = None
+
+
+identity_cache = IdentityCache()
+
+
+@login.user_loader
+def load_user(id):
+    identity = identity_cache.get(int(id))
+    if identity is None:
+        return None
+    g.identity = identity
+
+    return identity.user
+
+
+def current_identity() -> Identity:
+    """
+    Get the identity of the signed in user for the current request
+
+    :return:
+     identity: Identity
+    """
+    if 'identity' not in g:
+        g.identity = identity_cache.get(int(current_user.get_id()))
+
+    return g.identity
+
+
+def doctor_required(redirect_to: str = 'index'):
+    """
+    Decorator for Controller functions that only doctor user is allowed to perform
+    Use it after login_required.
+
+    :param redirect_to: endpoint that other users are redirected to
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_identity().is_doctor:
+                flash('You are not authorized to perform this operation.')
+                return redirect(url_for(redirect_to))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _mark_identity_changed(mapper, connection, target):
+    # Clear now and again after commit, so that nothing read before the commit stays in the cache
+    identity_cache.clear()
+    session = object_session(target)
+    if session is not None:
+        session.info['identity_changed'] = True
+
+
+def _clear_identity_cache(session):
+    if session.info.pop('identity_changed', False):
+        identity_cache.clear()
+
+
+for model in (User, HealthcareProfessional):
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, name, _mark_identity_changed, propagate=True)
+event.listen(db.session, 'after_commit', _clear_identity_cache)
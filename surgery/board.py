@@ -0,0 +1,208 @@
+import json
+import threading
+import time
+from datetime import datetime
+from flask import request, Response, stream_with_context
+from flask_login import login_required
+from sqlalchemy import event, func
+from sqlalchemy.orm import object_session
+from surgery import app, db
+from surgery.models import AppointmentChange
+
+"""
+This script defines the live reception board
+/reception/events is a Server-Sent Events stream of appointments made or cancelled after the client's last event id.
+Deltas are read from the change log written by Receptionist, so no list is read or rendered again.
+A commit that logs changes wakes up streams of the same process at once.
+Changes made by other worker processes are found by a small indexed query every RECEPTION_EVENTS_POLL_SECONDS.
+An open stream holds a thread of the worker, so at most RECEPTION_MAX_STREAMS streams are kept open in a process.
+Above the cap, the stream sends the changes made so far and ends, and the browser polls by reconnecting.
+"""
+
+
+class ChangeNotifier(object):
+    """
+    Class that wakes up streams waiting for changes committed in this process
+    """
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__latest_id = 0
+
+    def notify(self, change_id: int):
+        """
+        Tell waiting streams that changes up to change_id are committed
+        """
+        with self.__condition:
+            self.__latest_id = max(self.__latest_id, change_id)
+            self.__condition.notify_all()
+
+    def wait(self, last_id: int, timeout: float) -> bool:
+        """
+        Wait until a change after last_id is committed
+
+        :param last_id:
+        :param timeout: seconds
+        :return:
+         True if a change is notified, False on timeout
+        """
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__latest_id > last_id, timeout=timeout)
+
+
+class StreamSlots(object):
+    """
+    Class that counts streams kept open in this process
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__count = 0
+
+    def acquire(self, limit: int) -> bool:
+        """
+        Take a slot if fewer than limit streams are open
+
+        :param limit:
+        :return:
+         True if a slot is taken, False if the limit is reached
+        """
+        with self.__lock:
+            if self.__count >= limit:
+                return False
+            self.__count += 1
+            return True
+
+    def release(self):
+        """
+        Give back a slot taken by acquire
+        """
+        with self.__lock:
+            self.__count -= 1
+
+
+notifier = ChangeNotifier()
+slots = StreamSlots()
+
+
+@event.listens_for(AppointmentChange, 'after_insert')
+def _remember_change(mapper, connection, target):
+    session = object_session(target)
+    session.info['appointment_change_id'] = max(session.info.get('appointment_change_id', 0), target.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _notify_changes(session):
+    change_id = session.info.pop('appointment_change_id', None)
+    if change_id is not None:
+        notifier.notify(change_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('appointment_change_id', None)
+
+
+def read_changes(last_id: int = None, since: datetime = None) -> list[AppointmentChange]:
+    """
+    Read changes after the last event id, or changes made at or after the date
+
+    :param last_id:
+    :param since:
+    :return:
+     changes: list[AppointmentChange] in the order of ids
+    """
+    query = AppointmentChange.query
+    if last_id is not None:
+        query = query.filter(AppointmentChange.id > last_id)
+    else:
+        query = query.filter(AppointmentChange.changed_at >= since)
+    changes = query.order_by(AppointmentChange.id).limit(app.config['RECEPTION_EVENTS_BATCH']).all()
+    # Release the connection while waiting, and let the next read see new commits
+    db.session.close()
+
+    return changes
+
+
+def format_events(changes: list[AppointmentChange]):
+    """
+    Generate a Server-Sent Event for each change
+    """
+    for change in changes:
+        yield f'id: {change.id}\nevent: appointment\ndata: {json.dumps(change.to_dict())}\n\n'
+
+
+def stream_changes(last_id: int = None, since: datetime = None):
+    """
+    Generate Server-Sent Events of changes until RECEPTION_EVENTS_TIMEOUT passes
+    The browser reconnects after the stream ends, sending the id of the last event it received.
+    If RECEPTION_MAX_STREAMS streams are open in this process, the stream ends after sending the changes made so far.
+
+    :param last_id: id of the last event the client received
+    :param since: date when the client is rendered, used if last_id is not known
+    """
+    # The slot is taken inside the generator, so that it is given back whenever the stream is closed
+    keep_open = slots.acquire(app.config['RECEPTION_MAX_STREAMS'])
+    try:
+        yield f"retry: {app.config['RECEPTION_EVENTS_RETRY_MS']}\n\n"
+        yield from _stream_changes(last_id, since, keep_open)
+    finally:
+        if keep_open:
+            slots.release()
+
+
+def _stream_changes(last_id: int, since: datetime, keep_open: bool):
+    """
+    Generate events of stream_changes, ending after the changes made so far unless keep_open
+    """
+    deadline = time.monotonic() + app.config['RECEPTION_EVENTS_TIMEOUT']
+    batch = app.config['RECEPTION_EVENTS_BATCH']
+
+    if last_id is None:
+        # Changes made after the page is rendered are sent first, and the following changes are read by id
+        # The latest id is read before them, so that a change committed in between is read again rather than lost
+        latest_id = db.session.query(func.coalesce(func.max(AppointmentChange.id), 0)).scalar()
+        changes = read_changes(since=since)
+        yield from format_events(changes)
+        last_id = changes[-1].id if len(changes) == batch else max([latest_id] + [change.id for change in changes])
+
+    while time.monotonic() < deadline:
+        changes = read_changes(last_id=last_id)
+        yield from format_events(changes)
+        if changes:
+            last_id = changes[-1].id
+        if len(changes) == batch:
+            continue
+        if not keep_open:
+            # The browser reads later changes when it reconnects
+            break
+
+        timeout = min(app.config['RECEPTION_EVENTS_POLL_SECONDS'], deadline - time.monotonic())
+        if timeout > 0 and not notifier.wait(last_id, timeout=timeout):
+            # A comment keeps proxies from closing an idle stream
+            yield ': keep-alive\n\n'
+
+
+@app.route('/reception/events')
+@login_required
+def reception_events():
+    """
+    Controller for the Server-Sent Events stream of the reception board
+    The last event id is given by the Last-Event-ID header on reconnection, or by last_event_id argument.
+    On the first connection, since argument is the date when the page is rendered.
+    """
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('last_event_id', type=int)
+    since = None
+    if last_id is None:
+        try:
+            since = datetime.fromisoformat(request.args.get('since', ''))
+        except ValueError:
+            # Without a position, only changes from now are sent
+            since = datetime.utcnow()
+
+    response = Response(stream_with_context(stream_changes(last_id=last_id, since=since)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Ask nginx not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+
+    return response
@@ -0,0 +1,211 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import request
+from markupsafe import Markup
+from sqlalchemy import event
+from surgery import app, db
+
+"""
+This script defines the cache of rendered fragments of list screens
+A fragment is keyed by the screen, its request arguments and the generations of the tables it shows.
+A commit that changes a table increments the generation of the table and drops fragments showing it,
+so a fragment read by a later request is always rendered from the current rows.
+A hit skips both the SQL statement and template rendering of the list.
+
+FRAGMENT_CACHE in configuration selects the backend.
+ - memory: LRU in each process. Changes made by other worker processes are not seen, so use it with one process.
+ - sqlite: a local SQLite file shared by the worker processes of a host.
+ - None: fragments are not cached.
+"""
+
+
+class MemoryCache(object):
+    """
+    Cache of fragments in the memory of a process, evicting the least recently used one
+    """
+    def __init__(self, max_entries: int):
+        self.__max_entries = max_entries
+        # key -> (tables, fragment)
+        self.__entries: OrderedDict = OrderedDict()
+        self.__generations: dict[str, int] = {}
+        self.__lock = threading.Lock()
+
+    def generations(self, tables: list[str]) -> list[int]:
+        """
+        Get the generations of the tables
+        """
+        with self.__lock:
+            return [self.__generations.get(table, 0) for table in tables]
+
+    def get(self, key: str) -> str:
+        """
+        Get a fragment
+
+        :return:
+         fragment: str (None if it is not cached)
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            self.__entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, tables: list[str], fragment: str):
+        """
+        Cache a fragment rendered from the tables
+        """
+        with self.__lock:
+            self.__entries[key] = (tables, fragment)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, tables: set[str]):
+        """
+        Increment the generations of the tables and drop fragments rendered from them
+        """
+        with self.__lock:
+            for table in tables:
+                self.__generations[table] = self.__generations.get(table, 0) + 1
+            for key in [key for key, (entry_tables, _) in self.__entries.items() if tables.intersection(entry_tables)]:
+                del self.__entries[key]
+
+    def clear(self):
+        """
+        Drop all fragments
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+
+class SQLiteCache(object):
+    """
+    Cache of fragments in a local SQLite file, shared by the worker processes of a host
+    When it is full, the fragments cached first are evicted.
+    """
+    def __init__(self, path: str, max_entries: int):
+        self.__path = path
+        self.__max_entries = max_entries
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Each thread uses its own connection
+        self.__local = threading.local()
+        with self.__connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS fragment '
+                               '(key TEXT PRIMARY KEY, tables TEXT, fragment TEXT, created_at REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_fragment_created_at ON fragment (created_at)')
+            connection.execute('CREATE TABLE IF NOT EXISTS generation (table_name TEXT PRIMARY KEY, value INTEGER)')
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.__path, timeout=5)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self.__local.connection = connection
+
+        return connection
+
+    def generations(self, tables: list[str]) -> list[int]:
+        """
+        Get the generations of the tables
+        """
+        rows = dict(self.__connection().execute(
+            f"SELECT table_name, value FROM generation WHERE table_name IN ({', '.join('?' * len(tables))})", tables))
+
+        return [rows.get(table, 0) for table in tables]
+
+    def get(self, key: str) -> str:
+        """
+        Get a fragment
+
+        :return:
+         fragment: str (None if it is not cached)
+        """
+        row = self.__connection().execute('SELECT fragment FROM fragment WHERE key = ?', (key, )).fetchone()
+
+        return row[0] if row else None
+
+    def put(self, key: str, tables: list[str], fragment: str):
+        """
+        Cache a fragment rendered from the tables
+        """
+        with self.__connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO fragment VALUES (?, ?, ?, ?)',
+                               (key, ''.join(f'|{table}|' for table in tables), fragment, time.time()))
+            connection.execute('DELETE FROM fragment WHERE key IN (SELECT key FROM fragment ORDER BY created_at DESC '
+                               'LIMIT -1 OFFSET ?)', (self.__max_entries, ))
+
+    def invalidate(self, tables: set[str]):
+        """
+        Increment the generations of the tables and drop fragments rendered from them
+        """
+        with self.__connection() as connection:
+            for table in tables:
+                connection.execute('INSERT INTO generation VALUES (?, 1) '
+                                   'ON CONFLICT(table_name) DO UPDATE SET value = value + 1', (table, ))
+                connection.execute('DELETE FROM fragment WHERE tables LIKE ?', (f'%|{table}|%', ))
+
+    def clear(self):
+        """
+        Drop all fragments
+        """
+        with self.__connection() as connection:
+            connection.execute('DELETE FROM fragment')
+
+
+def get_cache():
+    """
+    Get the fragment cache of the application, creating it by configuration on first use
+
+    :return:
+     cache: MemoryCache, SQLiteCache or None if fragments are not cached
+    """
+    if 'fragment_cache' not in app.extensions:
+        backend = app.config['FRAGMENT_CACHE']
+        if backend == 'memory':
+            cache = MemoryCache(app.config['FRAGMENT_CACHE_SIZE'])
+        elif backend == 'sqlite':
+            cache = SQLiteCache(app.config['FRAGMENT_CACHE_PATH'], app.config['FRAGMENT_CACHE_SIZE'])
+        else:
+            cache = None
+        app.extensions['fragment_cache'] = cache
+
+    return app.extensions['fragment_cache']
+
+
+def cached_fragment(name: str, tables: tuple, render) -> Markup:
+    """
+    Get a fragment of the current request from the cache, or render and cache it
+
+    :param name: name of the fragment, such as the endpoint
+    :param tables: tables whose rows are shown in the fragment
+    :param render: function() that renders the fragment
+    :return:
+     fragment: Markup
+    """
+    cache = get_cache()
+    if cache is None:
+        return Markup(render())
+
+    tables = sorted(tables)
+    # Generations are read before rendering, so a fragment rendered while a table changes is stored under the old key
+    key = json.dumps([app.config['SQLALCHEMY_DATABASE_URI'], name, cache.generations(tables),
+                      sorted(request.args.items(multi=True))])
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = render()
+        cache.put(key, tables, fragment)
+
+    return Markup(fragment)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_fragments(session):
+    tables = session.info.pop('changed_tables', None)
+    if tables and get_cache() is not None:
+        get_cache().invalidate(tables)
@@ -7,6 +7,175 @@ This script defines configuration used in the application
 # Setting for DB
 basedir = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+# Directory of files written while the application runs, such as the job queue and the fragment cache
+# It is kept out of the package and of version control, and is created on first use.
+INSTANCE_DIR = os.environ.get('SURGERY_INSTANCE_DIR', os.path.join(os.path.dirname(basedir), 'instance'))
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+# Engine profile, default or production. See surgery/database.py
+# It can be selected by SURGERY_DATABASE_PROFILE environment variable.
+DATABASE_PROFILE = os.environ.get('SURGERY_DATABASE_PROFILE', 'default')
+# Pragmas set on each connection in the production profile
+SQLITE_PRAGMAS = {
+    # Milliseconds to wait for a lock instead of failing with "database is locked"
+    'busy_timeout': 5000,
+    # Readers do not block a writer and a writer does not block readers
+    'journal_mode': 'WAL',
+    # Safe with WAL, and commits do not wait for fsync of the database file
+    'synchronous': 'NORMAL',
+    # 256MB of the database file is read through memory mapping
+    'mmap_size': 268435456,
+    # 64MB of page cache per connection (negative value is KiB)
+    'cache_size': -65536,
+    'temp_store': 'MEMORY',
+}
+# Connections kept by the pool in the production profile, about the number of serving threads
+DATABASE_POOL_SIZE = 10
+DATABASE_POOL_OVERFLOW = 20
+DATABASE_POOL_TIMEOUT = 30
 # Setting for secret key to protect against CSRF
-SECRET_KEY = os.urandom(24)
\ No newline at end of file
+# Sessions and CSRF tokens are signed by it, so every worker process and restart must use the same key.
+# It is read from SURGERY_SECRET_KEY, or from the file SURGERY_SECRET_KEY_FILE, which is created on first use.
+SECRET_KEY_FILE = os.environ.get('SURGERY_SECRET_KEY_FILE', os.path.join(INSTANCE_DIR, 'secret_key'))
+
+
+def _load_secret_key(path: str) -> str:
+    """
+    Read the secret key from the file, or create the file with a random key if it does not exist
+    The file is written under another name and linked, so processes starting at once agree on one key.
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}'
+        with open(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+            file.write(os.urandom(32).hex())
+        try:
+            os.link(temporary, path)
+        except FileExistsError:
+            # Another process has created it first
+            pass
+        finally:
+            os.remove(temporary)
+    with open(path) as file:
+        return file.read().strip()
+
+
+SECRET_KEY = os.environ.get('SURGERY_SECRET_KEY') or _load_secret_key(SECRET_KEY_FILE)
+# Setting for list screens
+# Number of rows displayed in a page and sizes selectable on screens
+LIST_PAGE_SIZE = 50
+LIST_PAGE_SIZES = [20, 50, 100, 200]
+
+# Setting for authorization
+# Seconds for which the signed in user and the role are cached without querying a database
+IDENTITY_CACHE_TTL = 300
+# Seconds between reads of the versions of users and staff, which find changes made by other worker processes
+IDENTITY_VERSION_CHECK_SECONDS = 1.0
+
+# Setting for the staff roster
+# Seconds between reads of the version of staff made by other worker processes
+# Staff are looked up without a query between the reads, and changes made by the same process are seen at once.
+ROSTER_VERSION_CHECK_SECONDS = 1.0
+
+# Setting for bulk import
+# Number of rows written by one statement
+IMPORT_BATCH_SIZE = 1000
+
+# Setting for archival
+# Appointments older than ARCHIVE_APPOINTMENT_DAYS days and prescriptions issued more than ARCHIVE_PRESCRIPTION_DAYS
+# days ago are moved into archive tables, ARCHIVE_BATCH_SIZE rows per transaction
+ARCHIVE_APPOINTMENT_DAYS = 30
+ARCHIVE_PRESCRIPTION_DAYS = 365
+ARCHIVE_BATCH_SIZE = 1000
+
+# Setting for prescription analytics
+# Width of buckets of quantity and dosage distributions
+ANALYTICS_BUCKETS = {'quantity': 5, 'dosage': 0.5}
+
+# Setting for metrics
+# Requests and SQL statements are measured and exposed by /metrics
+METRICS_ENABLED = True
+# Client addresses allowed to read /metrics. Metrics are kept per worker process and labelled by pid.
+METRICS_ALLOWED_ADDRESSES = ['127.0.0.1', '::1']
+# SQL statements slower than this are written to the slow query log
+SLOW_QUERY_THRESHOLD_MS = 100
+# File of the slow query log. If None, the log goes to the 'surgery.slow_query' logger only.
+SLOW_QUERY_LOG = None
+
+# Setting for appointments
+# Number of the soonest free slots shown on Make Appointment page, and the maximum that the API can ask for
+APPOINTMENT_OPTIONS = 5
+APPOINTMENT_MAX_OPTIONS = 50
+# Number of occurrences of a recurring appointment, and of appointments in a bulk booking of the API
+APPOINTMENT_MAX_OCCURRENCES = 52
+APPOINTMENT_MAX_BULK = 200
+
+# Setting for search
+# Number of results returned by typeahead search, and the maximum that a request can ask for
+SEARCH_RESULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+# Number of matches ranked for a query. Matches after them are not returned.
+SEARCH_CANDIDATES = 200
+
+# Setting for the live reception board
+# Seconds between checks for changes made by other worker processes
+RECEPTION_EVENTS_POLL_SECONDS = 5
+# Seconds after which a stream ends and the browser reconnects, so that a stream does not hold a worker forever
+RECEPTION_EVENTS_TIMEOUT = 300
+# Milliseconds that the browser waits before reconnecting
+RECEPTION_EVENTS_RETRY_MS = 3000
+# Number of changes read by one query
+RECEPTION_EVENTS_BATCH = 100
+# Number of streams kept open in a worker process, below the number of its threads (SURGERY_THREADS in gunicorn.conf.py),
+# so that other requests are served while streams are open. Other streams end at once and the browser polls.
+RECEPTION_MAX_STREAMS = 2
+
+# Setting for exports
+# Number of rows read from the cursor and written out at a time
+EXPORT_BATCH_SIZE = 1000
+
+# Setting for the fragment cache of list screens
+# memory: LRU in each process, sqlite: a file shared by worker processes, None: not cached
+# Worker processes of the production profile share the cache file, so that a change made by one is seen by all
+FRAGMENT_CACHE = os.environ.get('SURGERY_FRAGMENT_CACHE', 'sqlite' if DATABASE_PROFILE == 'production' else 'memory')
+# Number of fragments kept in the cache
+FRAGMENT_CACHE_SIZE = 1000
+# File of the sqlite backend
+FRAGMENT_CACHE_PATH = os.environ.get('SURGERY_FRAGMENT_CACHE_PATH', os.path.join(INSTANCE_DIR, 'fragment_cache.db'))
+
+# Setting for background jobs
+# thread: workers run in each web process, process: workers run in `python initialize.py worker` only
+# In the production profile, jobs run in a separate process, so that they do not slow down requests
+JOB_RUNNER = os.environ.get('SURGERY_JOB_RUNNER', 'process' if DATABASE_PROFILE == 'production' else 'thread')
+# Whether the thread runner is started by the first request. It is not started under the test client,
+# and test scripts and benchmarks turn it off, so that they start workers only when they need them.
+JOB_RUNNER_AUTOSTART = True
+# File of the job queue, shared by the web and worker processes of a host
+JOB_QUEUE_PATH = os.environ.get('SURGERY_JOB_QUEUE_PATH', os.path.join(INSTANCE_DIR, 'jobs.db'))
+# Directory where files made by jobs, such as exports, are written
+JOB_OUTPUT_DIR = os.environ.get('SURGERY_JOB_OUTPUT_DIR', os.path.join(INSTANCE_DIR, 'job_output'))
+# Number of worker threads in a process
+JOB_WORKERS = 2
+# Number of jobs running at once over all processes
+JOB_CONCURRENCY = 2
+# Number of times a job is tried before it fails
+JOB_MAX_ATTEMPTS = 3
+# Seconds before the first retry, doubled at each retry up to JOB_RETRY_MAX_SECONDS
+JOB_RETRY_SECONDS = 5
+JOB_RETRY_MAX_SECONDS = 300
+# Seconds for which a running job is held by its worker. The lease is renewed while the job runs,
+# and a job whose worker has died is run again after it expires.
+JOB_LEASE_SECONDS = 60
+# Seconds between checks for jobs submitted by other processes
+JOB_POLL_SECONDS = 2
+
+# Setting for passwords
+# Method of werkzeug.security.generate_password_hash, with the number of iterations of pbkdf2
+# A hash made by another method or number of iterations is replaced when the user signs in.
+PASSWORD_HASH_METHOD = os.environ.get('SURGERY_PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+# Number of passwords being hashed or waiting for the pool in a process
+PASSWORD_HASH_PLACES = int(os.environ.get('SURGERY_PASSWORD_HASH_PLACES', 8))
+# Seconds a sign-in waits for a place before it is refused with 503
+# A waiting sign-in holds its request thread, so it is kept short.
+PASSWORD_HASH_WAIT_SECONDS = float(os.environ.get('SURGERY_PASSWORD_HASH_WAIT_SECONDS', 1.0))
+# Number of passwords hashed at once, so that sign-ins leave CPU for other requests
+PASSWORD_HASH_WORKERS = min(max((os.cpu_count() or 2) // 2, 1), PASSWORD_HASH_PLACES)
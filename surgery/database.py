@@ -0,0 +1,75 @@
+import atexit
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+"""
+This script defines how the database engine is created
+DATABASE_PROFILE in configuration selects the engine profile.
+ - default: SQLite as it is. A connection is opened for each session.
+ - production: WAL mode, tuned pragmas(SQLITE_PRAGMAS) and a connection pool shared by serving threads.
+   PRAGMA optimize is run when pooled connections are closed.
+"""
+
+
+class SurgerySQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy extension that applies the engine profile when an engine is created
+    """
+    def __init__(self, *args, **kwargs):
+        # Pragmas of engines to be created, keyed by the database url
+        self.__pragmas: dict[str, dict] = {}
+        super().__init__(*args, **kwargs)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        if app.config['DATABASE_PROFILE'] != 'production' or sa_url.drivername != 'sqlite' \
+                or sa_url.database in (None, '', ':memory:'):
+            return sa_url, options
+
+        pragmas = dict(app.config['SQLITE_PRAGMAS'])
+        options['poolclass'] = QueuePool
+        options['pool_size'] = app.config['DATABASE_POOL_SIZE']
+        options['max_overflow'] = app.config['DATABASE_POOL_OVERFLOW']
+        options['pool_timeout'] = app.config['DATABASE_POOL_TIMEOUT']
+        connect_args = options.setdefault('connect_args', {})
+        # Pooled connections are used by every serving thread
+        connect_args['check_same_thread'] = False
+        if 'busy_timeout' in pragmas:
+            connect_args['timeout'] = pragmas['busy_timeout'] / 1000
+        self.__pragmas[str(sa_url)] = pragmas
+
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        pragmas = self.__pragmas.pop(str(sa_url), None)
+        if pragmas is not None:
+            event.listen(engine, 'connect', lambda dbapi_connection, record: set_pragmas(dbapi_connection, pragmas))
+            event.listen(engine, 'close', lambda dbapi_connection, record: optimize(dbapi_connection))
+            # Closing pooled connections at exit runs PRAGMA optimize
+            atexit.register(engine.dispose)
+
+        return engine
+
+
+def set_pragmas(dbapi_connection, pragmas: dict):
+    """
+    Set pragmas on a new connection
+    busy_timeout is set first, so that setting journal_mode waits for other connections.
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in sorted(pragmas.items(), key=lambda item: item[0] != 'busy_timeout'):
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+def optimize(dbapi_connection):
+    """
+    Let SQLite update statistics used by the query planner before a connection is closed
+    """
+    try:
+        dbapi_connection.execute('PRAGMA optimize')
+    except Exception:
+        # The connection may be already broken
+        pass
@@ -0,0 +1,221 @@
+import csv
+import io
+import json
+from datetime import datetime, date
+from flask import request, Response, stream_with_context
+from flask_login import login_required
+from sqlalchemy import select, func
+from surgery import app, db
+from surgery.auth import doctor_required
+from surgery.models import HealthcareProfessional, Patient, Prescription, Appointment, PrescriptionArchive, \
+    AppointmentArchive
+from surgery.pagination import filter_date_range
+
+"""
+This script defines complete extracts of appointments, prescriptions and patients as CSV or NDJSON
+Rows are read by a streaming cursor in batches of EXPORT_BATCH_SIZE and written out batch by batch by a generator,
+so memory used by an export does not depend on the size of the table.
+Names of staff and patients are joined in the same statement.
+"""
+
+# Media types and file extensions of export formats
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+
+def appointment_select(args):
+    """
+    Statement of appointments with staff and patient names, and the column filtered by date range
+    Archived appointments are read instead if history is given.
+    """
+    appointment = (AppointmentArchive if args.get('history') else Appointment).__table__
+    staff = HealthcareProfessional.__table__
+    patient = Patient.__table__
+    statement = select(appointment.c.id, appointment.c.type, appointment.c.date, appointment.c.staff_id,
+                       staff.c.name.label('staff_name'), appointment.c.patient_id, patient.c.name.label('patient_name'),
+                       appointment.c.created_by, appointment.c.created_at) \
+        .select_from(appointment.outerjoin(staff, staff.c.id == appointment.c.staff_id)
+                     .outerjoin(patient, patient.c.id == appointment.c.patient_id))
+
+    return statement, appointment.c.date
+
+
+def prescription_select(args):
+    """
+    Statement of prescriptions with doctor and patient names, and the column filtered by date range
+    Archived prescriptions are read instead if history is given.
+    """
+    prescription = (PrescriptionArchive if args.get('history') else Prescription).__table__
+    doctor = HealthcareProfessional.__table__
+    patient = Patient.__table__
+    statement = select(prescription.c.id, prescription.c.type, prescription.c.quantity, prescription.c.dosage,
+                       prescription.c.doctor_id, doctor.c.name.label('doctor_name'), prescription.c.patient_id,
+                       patient.c.name.label('patient_name'), prescription.c.created_at) \
+        .select_from(prescription.outerjoin(doctor, doctor.c.id == prescription.c.doctor_id)
+                     .outerjoin(patient, patient.c.id == prescription.c.patient_id))
+
+    return statement, prescription.c.created_at
+
+
+def patient_select(args):
+    """
+    Statement of patients with primary doctor names, and the column filtered by date range
+    """
+    patient = Patient.__table__
+    doctor = HealthcareProfessional.__table__
+    statement = select(patient.c.id, patient.c.name, patient.c.address, patient.c.phone, patient.c.doctor_id,
+                       doctor.c.name.label('doctor_name'), patient.c.created_at) \
+        .select_from(patient.outerjoin(doctor, doctor.c.id == patient.c.doctor_id))
+
+    return statement, patient.c.created_at
+
+
+# Statements of resources that can be exported
+EXPORTS = {
+    'appointments': appointment_select,
+    'prescriptions': prescription_select,
+    'patients': patient_select,
+}
+
+
+def read_batches(resource: str, args, on_batch=None):
+    """
+    Read rows of the resource in batches by a streaming cursor
+
+    :param resource: key of EXPORTS
+    :param args: date_from and date_to (YYYY-MM-DD) and history, such as request arguments
+    :param on_batch: function(number of rows) called after each batch is read
+    :return:
+     columns: list[str]
+     batches: generator of lists of rows, in the order of ids
+    """
+    statement, date_column = EXPORTS[resource](args)
+    statement = filter_date_range(statement, date_column, args).order_by(statement.selected_columns.id)
+    columns = [column.name for column in statement.selected_columns]
+
+    def batches():
+        with db.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(statement)
+            for rows in result.partitions(app.config['EXPORT_BATCH_SIZE']):
+                yield rows
+                if on_batch is not None:
+                    on_batch(len(rows))
+
+    return columns, batches()
+
+
+def value_of(value):
+    """
+    Convert a value into the text written into an export
+    """
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+
+    return value
+
+
+def generate_csv(resource: str, args, on_batch=None):
+    """
+    Generate CSV text of the resource, a batch of rows at a time
+    """
+    columns, batches = read_batches(resource, args, on_batch)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows([value_of(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def generate_ndjson(resource: str, args, on_batch=None):
+    """
+    Generate NDJSON text of the resource, a batch of rows at a time
+    """
+    columns, batches = read_batches(resource, args, on_batch)
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, map(value_of, row)))) + '\n' for row in rows)
+
+
+# Generators of export formats
+GENERATORS = {
+    'csv': generate_csv,
+    'ndjson': generate_ndjson,
+}
+
+
+def count_rows(resource: str, args) -> int:
+    """
+    Count rows of the resource that an export writes
+    """
+    statement, date_column = EXPORTS[resource](args)
+    statement = filter_date_range(statement, date_column, args)
+
+    return db.session.execute(select(func.count()).select_from(statement.subquery())).scalar()
+
+
+def export_to(file, resource: str, export_format: str, args, on_batch=None) -> None:
+    """
+    Write an export of the resource into a file object
+
+    :param file: text file object
+    :param resource: key of EXPORTS
+    :param export_format: csv or ndjson
+    :param args: date_from and date_to (YYYY-MM-DD) and history
+    :param on_batch: function(number of rows) called after each batch is read
+    """
+    for text in GENERATORS[export_format](resource, args, on_batch):
+        file.write(text)
+
+
+def export_response(resource: str):
+    """
+    Stream an export of the resource in the format given by format argument(csv by default)
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        export_format = 'csv'
+    mimetype, extension = EXPORT_FORMATS[export_format]
+
+    response = Response(stream_with_context(GENERATORS[export_format](resource, request.args)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={resource}-{date.today().isoformat()}.{extension}'
+
+    return response
+
+
+@app.route('/export/appointments')
+@login_required
+def export_appointments():
+    """
+    Controller for the export of appointments
+    Filters(date_from, date_to) are given by request arguments and applied to appointment dates
+    Archived appointments are exported if history is given.
+    """
+    return export_response('appointments')
+
+
+@app.route('/export/prescriptions')
+@login_required
+@doctor_required()
+def export_prescriptions():
+    """
+    Controller for the export of prescriptions
+    Filters(date_from, date_to) are given by request arguments and applied to issued dates
+    Archived prescriptions are exported if history is given.
+    """
+    return export_response('prescriptions')
+
+
+@app.route('/export/patients')
+@login_required
+@doctor_required()
+def export_patients():
+    """
+    Controller for the export of patients
+    Filters(date_from, date_to) are given by request arguments and applied to registered dates
+    """
+    return export_response('patients')
@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, SelectField, DateField, IntegerField, DecimalField
-from wtforms.validators import DataRequired, Length, NumberRange
+from wtforms.validators import DataRequired, Length, NumberRange, Optional
 
 """
 This script defines form classes for getting input data from screen
@@ -33,6 +33,10 @@ class AppointmentForm(FlaskForm):
     date = DateField('Appointment Date', validators=[DataRequired()])
     # Time should be selected from the below
     time = SelectField('Appointment Time', choices=[("9:00", "9:00"), ("11:00", "11:00"), ("14:00", "14:00"), ("16:00", "16:00")], validators=[DataRequired()])
+    # A recurring appointment is booked when occurrences are more than 1
+    repeat_every = IntegerField('Repeat Every', default=1, validators=[Optional(), NumberRange(min=1, message='Repeat every must be 1 or more')])
+    repeat_unit = SelectField('Repeat Unit', choices=[("weeks", "weeks"), ("days", "days")], default="weeks")
+    occurrences = IntegerField('Occurrences', default=1, validators=[Optional(), NumberRange(min=1, message='Occurrences must be 1 or more')])
     submit = SubmitField('Register')
 
 
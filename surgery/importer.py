@@ -0,0 +1,180 @@
+import csv
+import json
+import os
+from datetime import datetime
+from werkzeug.datastructures import MultiDict
+from surgery import app, db
+from surgery.forms import PatientForm
+from surgery.models import Doctor, Patient, UnitOfWork, PATIENT_QUOTA
+from surgery.versions import mark_changed
+
+"""
+This script defines bulk import of patients
+Input files are read row by row, so the memory used does not depend on the file size.
+Rows are written in batches inside a single transaction.
+"""
+
+
+class ImportReport(object):
+    """
+    Class that represents the result of an import
+    """
+    def __init__(self):
+        self.imported = 0
+        # (line number, name, message) of rows that are not imported
+        self.errors: list[tuple] = []
+
+    def add_error(self, line: int, name: str, message: str):
+        self.errors.append((line, name, message))
+
+    def print(self):
+        for line, name, message in sorted(self.errors, key=lambda error: error[0]):
+            print(f'line {line}: {name}: {message}')
+        print(f'Imported: {self.imported} Errors: {len(self.errors)}')
+
+
+class PatientImporter(object):
+    """
+    Class that imports patients from a CSV or JSONL file
+    Each row has name, address, phone and doctor_name, the same as the Register Patient page.
+    """
+    def __init__(self, batch_size: int = None):
+        self.__batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+        # doctor name -> [doctor id, number of registered patients]
+        self.__doctors: dict[str, list] = {}
+
+    def read_rows(self, path: str):
+        """
+        Read rows from a file one by one
+
+        :param path: CSV file, or JSONL file if the extension is .jsonl or .ndjson
+        :return:
+         generator of (line number, row)
+        """
+        with open(path, newline='', encoding='utf-8') as file:
+            if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson'):
+                for line, text in enumerate(file, start=1):
+                    if text.strip():
+                        try:
+                            yield line, json.loads(text)
+                        except ValueError:
+                            yield line, None
+            else:
+                reader = csv.DictReader(file)
+                for row in reader:
+                    yield reader.line_num, row
+
+    @staticmethod
+    def normalize(row) -> dict:
+        """
+        Convert values of a row into strings as if they were input from a screen
+
+        :param row:
+        :return:
+         row: dict (None if the row is not an object)
+        """
+        if not isinstance(row, dict):
+            return None
+
+        return {key: str(value).strip() for key, value in row.items() if key and value is not None}
+
+    def validate(self, row: dict) -> str:
+        """
+        Validate a row by the rules of PatientForm
+
+        :param row: normalized row
+        :return:
+         message: str (None if the row is valid)
+        """
+        form = PatientForm(formdata=MultiDict(row), meta={'csrf': False})
+        if not form.validate():
+            return ' '.join(f'{name}: {error}' for name, errors in form.errors.items() for error in errors)
+
+        return None
+
+    def find_doctor(self, name: str) -> list:
+        """
+        Find the doctor by the name with the stored number of patients
+        The result is kept in memory and counted up while importing.
+
+        :param name:
+        :return:
+         [doctor id, number of patients] (None if the doctor is not registered)
+        """
+        if name not in self.__doctors:
+            doctor = Doctor.query.filter_by(name=name).first()
+            self.__doctors[name] = [doctor.id, doctor.patient_count] if doctor else None
+
+        return self.__doctors[name]
+
+    def run(self, path: str) -> ImportReport:
+        """
+        Import patients from the file
+        Everything is committed at the end, or nothing if an unexpected error occurs.
+
+        :param path:
+        :return:
+         report: ImportReport
+        """
+        report = ImportReport()
+        batch: list[tuple] = []
+        # Form validation needs a request context
+        with app.test_request_context(), UnitOfWork():
+            for line, row in self.read_rows(path):
+                row = self.normalize(row)
+                if row is None:
+                    report.add_error(line, None, 'The row cannot be read.')
+                    continue
+                message = self.validate(row)
+                if message:
+                    report.add_error(line, row.get('name'), message)
+                    continue
+                batch.append((line, row))
+                if len(batch) >= self.__batch_size:
+                    self.__write(batch, report)
+                    batch = []
+            self.__write(batch, report)
+
+        return report
+
+    def __write(self, batch: list, report: ImportReport):
+        """
+        Check names and quotas of a batch and insert valid rows by one statement
+        """
+        if not batch:
+            return
+
+        # Names already registered, including the ones written by previous batches
+        names = [row['name'] for _, row in batch]
+        registered = {name for (name, ) in db.session.query(Patient.name).filter(Patient.name.in_(names))}
+
+        records = []
+        # Number of patients imported for each doctor id
+        counts: dict[int, int] = {}
+        for line, row in batch:
+            name = row['name']
+            if name in registered:
+                report.add_error(line, name, 'This name is already registered.')
+                continue
+            doctor = self.find_doctor(row['doctor_name'])
+            if doctor is None:
+                report.add_error(line, name, 'The doctor is not registered.')
+                continue
+            if doctor[1] >= PATIENT_QUOTA:
+                report.add_error(line, name, f'Less than {PATIENT_QUOTA} patients can be registered by a doctor.')
+                continue
+
+            registered.add(name)
+            doctor[1] += 1
+            counts[doctor[0]] = counts.get(doctor[0], 0) + 1
+            records.append({'name': name, 'address': row['address'], 'phone': row['phone'], 'doctor_id': doctor[0],
+                            'created_at': datetime.utcnow()})
+
+        if records:
+            db.session.execute(Patient.__table__.insert(), records)
+            # Rows inserted by a statement are not counted by mapper events either
+            for doctor_id, count in counts.items():
+                Doctor.add_patient_count(db.session.connection(), doctor_id, count)
+            # Rows inserted by a statement are not counted by the session
+            mark_changed(Patient.__tablename__)
+            report.imported += len(records)
@@ -0,0 +1,578 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, date
+from flask import request, jsonify, url_for, send_file
+from flask_login import current_user
+from surgery import app
+from surgery.api import API_PREFIX, api_login_required
+from surgery.archive import ARCHIVES, archive_all, count_archivable
+from surgery.analytics import rebuild_rollups
+from surgery.auth import current_identity
+from surgery.export import EXPORTS, EXPORT_FORMATS, export_to, count_rows
+from surgery.importer import PatientImporter
+from surgery.models import Doctor
+from surgery.search import build_search_index
+
+"""
+This script defines background jobs for long-running work, such as exports, imports and maintenance
+Jobs are kept in a durable queue in a local SQLite file, so a submitted job survives a restart.
+Worker threads claim jobs one by one, and at most JOB_CONCURRENCY jobs run at once over all processes.
+A job that raises an error is tried again after a delay doubled at each attempt, up to JOB_MAX_ATTEMPTS.
+
+JOB_RUNNER in configuration selects where workers run.
+ - thread: JOB_WORKERS threads in each web process, started by the first request
+ - process: only `python initialize.py worker`, so that jobs do not compete with requests
+"""
+
+# Statuses of jobs
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+# Functions of jobs keyed by kind
+JOB_FUNCTIONS = {}
+
+
+class JobQueue(object):
+    """
+    Durable queue of jobs in a local SQLite file, shared by the processes of a host
+    A worker claims a job with a lease and renews it while the job runs.
+    A running job whose lease has expired is claimed again, as its worker has died.
+    """
+    def __init__(self, path: str):
+        self.__path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Each thread uses its own connection
+        self.__local = threading.local()
+        connection = self.__connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS job (id INTEGER PRIMARY KEY, kind TEXT, args TEXT, status TEXT, '
+                           'progress REAL, message TEXT, result TEXT, error TEXT, attempts INTEGER, max_attempts INTEGER, '
+                           'run_at REAL, lease_until REAL, created_by TEXT, created_at REAL, started_at REAL, '
+                           'finished_at REAL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_job_status_run_at ON job (status, run_at)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_job_created_by ON job (created_by, id)')
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            # Transactions are begun explicitly, so that a claim takes the write lock before reading
+            connection = sqlite3.connect(self.__path, timeout=5, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self.__local.connection = connection
+
+        return connection
+
+    @staticmethod
+    def __to_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job['args'] = json.loads(job['args'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+
+        return job
+
+    def submit(self, kind: str, args: dict, created_by: str, max_attempts: int) -> int:
+        """
+        Add a job to the queue
+
+        :param kind: key of JOB_FUNCTIONS
+        :param args: keyword arguments of the job function
+        :param created_by: name of the user who submits the job
+        :param max_attempts: number of times the job is tried before it fails
+        :return:
+         job_id: int
+        """
+        now = time.time()
+        cursor = self.__connection().execute(
+            'INSERT INTO job (kind, args, status, progress, attempts, max_attempts, run_at, created_by, created_at) '
+            'VALUES (?, ?, ?, 0, 0, ?, ?, ?, ?)', (kind, json.dumps(args), QUEUED, max_attempts, now, created_by, now))
+
+        return cursor.lastrowid
+
+    def claim(self, concurrency: int, lease_seconds: float) -> dict:
+        """
+        Take the next job that is due, unless as many jobs as concurrency are running
+
+        :param concurrency: number of jobs running at once over all processes
+        :param lease_seconds: seconds for which the job is held unless the lease is renewed
+        :return:
+         job: dict (None if there is no job to run)
+        """
+        connection = self.__connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # A job whose worker has died on its last attempt is not run again
+            connection.execute('UPDATE job SET status = ?, error = ?, lease_until = NULL, finished_at = ? '
+                               'WHERE status = ? AND lease_until <= ? AND attempts >= max_attempts',
+                               (FAILED, 'The worker stopped while running the job.', now, RUNNING, now))
+            running = connection.execute('SELECT COUNT(*) FROM job WHERE status = ? AND lease_until > ?',
+                                         (RUNNING, now)).fetchone()[0]
+            row = None
+            if running < concurrency:
+                row = connection.execute('SELECT * FROM job WHERE (status = ? AND run_at <= ?) '
+                                         'OR (status = ? AND lease_until <= ?) ORDER BY run_at, id LIMIT 1',
+                                         (QUEUED, now, RUNNING, now)).fetchone()
+            if row is not None:
+                connection.execute('UPDATE job SET status = ?, attempts = attempts + 1, lease_until = ?, started_at = ? '
+                                   'WHERE id = ?', (RUNNING, now + lease_seconds, now, row['id']))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        if row is None:
+            return None
+        job = self.__to_dict(row)
+        job.update({'status': RUNNING, 'attempts': row['attempts'] + 1, 'started_at': now})
+
+        return job
+
+    def renew(self, job_ids: list[int], lease_seconds: float):
+        """
+        Extend the leases of running jobs
+        """
+        if job_ids:
+            self.__connection().execute(
+                f"UPDATE job SET lease_until = ? WHERE status = ? AND id IN ({', '.join('?' * len(job_ids))})",
+                [time.time() + lease_seconds, RUNNING] + list(job_ids))
+
+    def progress(self, job_id: int, attempt: int, progress: float, message: str):
+        """
+        Record the progress of a running job
+
+        :param progress: 0 to 1
+        """
+        self.__connection().execute('UPDATE job SET progress = ?, message = ? WHERE id = ? AND attempts = ? AND status = ?',
+                                    (progress, message, job_id, attempt, RUNNING))
+
+    def finish(self, job_id: int, attempt: int, result):
+        """
+        Mark a running job as succeeded with its result
+        Nothing is changed if the job has been claimed again by another worker.
+        """
+        self.__connection().execute('UPDATE job SET status = ?, progress = 1, result = ?, error = NULL, '
+                                    'lease_until = NULL, finished_at = ? WHERE id = ? AND attempts = ? AND status = ?',
+                                    (SUCCEEDED, json.dumps(result), time.time(), job_id, attempt, RUNNING))
+
+    def fail(self, job_id: int, attempt: int, error: str, retry_at: float = None):
+        """
+        Mark a running job as failed, or queue it again to be retried at retry_at
+        Nothing is changed if the job has been claimed again by another worker.
+        """
+        if retry_at is None:
+            self.__connection().execute('UPDATE job SET status = ?, error = ?, lease_until = NULL, finished_at = ? '
+                                        'WHERE id = ? AND attempts = ? AND status = ?',
+                                        (FAILED, error, time.time(), job_id, attempt, RUNNING))
+        else:
+            self.__connection().execute('UPDATE job SET status = ?, error = ?, lease_until = NULL, run_at = ? '
+                                        'WHERE id = ? AND attempts = ? AND status = ?',
+                                        (QUEUED, error, retry_at, job_id, attempt, RUNNING))
+
+    def get(self, job_id: int) -> dict:
+        """
+        Get a job
+
+        :return:
+         job: dict (None if it does not exist)
+        """
+        row = self.__connection().execute('SELECT * FROM job WHERE id = ?', (job_id, )).fetchone()
+
+        return self.__to_dict(row) if row else None
+
+    def latest(self, created_by: str = None, limit: int = 20) -> list[dict]:
+        """
+        Get the latest jobs, of the user if created_by is given
+        """
+        if created_by is None:
+            rows = self.__connection().execute('SELECT * FROM job ORDER BY id DESC LIMIT ?', (limit, ))
+        else:
+            rows = self.__connection().execute('SELECT * FROM job WHERE created_by = ? ORDER BY id DESC LIMIT ?',
+                                               (created_by, limit))
+
+        return [self.__to_dict(row) for row in rows]
+
+
+class JobContext(object):
+    """
+    Class given to a job function to know its job and report progress
+    """
+    def __init__(self, queue: JobQueue, job: dict):
+        self.__queue = queue
+        self.id = job['id']
+        self.attempt = job['attempts']
+        self.__reported_at = 0.0
+
+    def progress(self, done: int, total: int = None, message: str = None):
+        """
+        Report the progress of the job
+        Reports are written at most twice a second, except the last one.
+
+        :param done: amount of work done
+        :param total: amount of all work (None if it is not known)
+        :param message: text shown with the progress, "done / total" by default
+        """
+        finished = total is not None and done >= total
+        if not finished and time.monotonic() - self.__reported_at < 0.5:
+            return
+        self.__reported_at = time.monotonic()
+        progress = min(done / total, 1.0) if total else 0.0
+        self.__queue.progress(self.id, self.attempt, progress, message or (f'{done} / {total}' if total else f'{done}'))
+
+
+class JobRunner(object):
+    """
+    Pool of worker threads that run jobs from the queue
+    A thread renews the leases of jobs running in this process.
+    """
+    def __init__(self, queue: JobQueue, workers: int):
+        self.__queue = queue
+        self.__workers = workers
+        self.__condition = threading.Condition()
+        self.__stopping = False
+        self.__threads: list[threading.Thread] = []
+        # ids of jobs running in this process
+        self.__running: set[int] = set()
+
+    def start(self):
+        """
+        Start worker threads and the thread renewing leases
+        """
+        self.__threads = [threading.Thread(target=self.__work, name=f'job-worker-{i}', daemon=True)
+                          for i in range(self.__workers)]
+        self.__threads.append(threading.Thread(target=self.__renew_leases, name='job-lease', daemon=True))
+        for thread in self.__threads:
+            thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Stop taking new jobs and wait for running ones to finish
+        """
+        with self.__condition:
+            self.__stopping = True
+            self.__condition.notify_all()
+        for thread in self.__threads:
+            thread.join(timeout)
+
+    def wake(self):
+        """
+        Tell waiting workers that a job is submitted or finished
+        """
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def __wait(self, seconds: float):
+        with self.__condition:
+            if not self.__stopping:
+                self.__condition.wait(seconds)
+
+    def __work(self):
+        while not self.__stopping:
+            try:
+                job = self.__queue.claim(app.config['JOB_CONCURRENCY'], app.config['JOB_LEASE_SECONDS'])
+            except sqlite3.OperationalError:
+                # The queue is locked by other processes for too long, so try again later
+                app.logger.exception('Failed to claim a job')
+                job = None
+            if job is None:
+                self.__wait(app.config['JOB_POLL_SECONDS'])
+                continue
+            self.run(job)
+            # A worker waiting for a free slot can take the next job
+            self.wake()
+
+    def __renew_leases(self):
+        while not self.__stopping:
+            self.__wait(app.config['JOB_LEASE_SECONDS'] / 3)
+            try:
+                self.__queue.renew(list(self.__running), app.config['JOB_LEASE_SECONDS'])
+            except sqlite3.OperationalError:
+                app.logger.exception('Failed to renew leases of jobs')
+
+    def run(self, job: dict):
+        """
+        Run a claimed job, and record its result or retry it later if it raises an error
+        """
+        function = JOB_FUNCTIONS.get(job['kind'])
+        if function is None:
+            self.__queue.fail(job['id'], job['attempts'], f"Unknown kind of job: {job['kind']}")
+            return
+
+        self.__running.add(job['id'])
+        try:
+            with app.app_context():
+                result = function(JobContext(self.__queue, job), **job['args'])
+            self.__queue.finish(job['id'], job['attempts'], result)
+        except Exception as e:
+            app.logger.exception(f"Job {job['id']} ({job['kind']}) failed on attempt {job['attempts']}")
+            retry_at = None
+            if job['attempts'] < job['max_attempts']:
+                delay = min(app.config['JOB_RETRY_SECONDS'] * 2 ** (job['attempts'] - 1), app.config['JOB_RETRY_MAX_SECONDS'])
+                retry_at = time.time() + delay
+            self.__queue.fail(job['id'], job['attempts'], f'{type(e).__name__}: {e}', retry_at)
+        finally:
+            self.__running.discard(job['id'])
+
+
+def job_function(kind: str):
+    """
+    Decorator that registers a function as a kind of job
+    The function is called with a JobContext and the arguments of the job, inside an application context.
+    It returns a result that can be converted into JSON.
+    """
+    def decorator(function):
+        JOB_FUNCTIONS[kind] = function
+        return function
+    return decorator
+
+
+def get_queue() -> JobQueue:
+    """
+    Get the job queue of the application, creating it on first use
+    """
+    if 'job_queue' not in app.extensions:
+        app.extensions['job_queue'] = JobQueue(app.config['JOB_QUEUE_PATH'])
+
+    return app.extensions['job_queue']
+
+
+def start_runner(workers: int = None) -> JobRunner:
+    """
+    Start worker threads of this process, unless they are running
+
+    :param workers: number of threads, JOB_WORKERS by default
+    :return:
+     runner: JobRunner
+    """
+    if 'job_runner' not in app.extensions:
+        runner = JobRunner(get_queue(), workers or app.config['JOB_WORKERS'])
+        runner.start()
+        app.extensions['job_runner'] = runner
+
+    return app.extensions['job_runner']
+
+
+def submit_job(kind: str, args: dict = None, created_by: str = None) -> int:
+    """
+    Submit a job to the queue
+
+    :param kind: key of JOB_FUNCTIONS
+    :param args: keyword arguments of the job function
+    :param created_by: name of the user who submits the job
+    :return:
+     job_id: int
+    """
+    if kind not in JOB_FUNCTIONS:
+        raise ValueError(f'Unknown kind of job: {kind}')
+    job_id = get_queue().submit(kind, args or {}, created_by, app.config['JOB_MAX_ATTEMPTS'])
+    # Workers of this process start the job at once, and workers of other processes find it by polling
+    runner = app.extensions.get('job_runner')
+    if runner is not None:
+        runner.wake()
+
+    return job_id
+
+
+@job_function('export')
+def run_export(context: JobContext, resource: str, export_format: str = 'csv', date_from: str = '',
+               date_to: str = '', history: str = '') -> dict:
+    """
+    Export rows of the resource, or its archived rows if history is given, into a file in JOB_OUTPUT_DIR
+    """
+    args = {'date_from': date_from, 'date_to': date_to, 'history': history}
+    total = count_rows(resource, args)
+    done = 0
+
+    def on_batch(rows: int):
+        nonlocal done
+        done += rows
+        context.progress(done, total)
+
+    os.makedirs(app.config['JOB_OUTPUT_DIR'], exist_ok=True)
+    filename = f'{resource}-{date.today().isoformat()}-{context.id}.{EXPORT_FORMATS[export_format][1]}'
+    path = os.path.join(app.config['JOB_OUTPUT_DIR'], filename)
+    # The file is renamed when it is complete, so a failed attempt does not leave a part of it
+    with open(path + '.part', 'w', newline='', encoding='utf-8') as file:
+        export_to(file, resource, export_format, args, on_batch)
+    os.replace(path + '.part', path)
+
+    return {'filename': filename, 'rows': done}
+
+
+@job_function('import-patients')
+def run_import_patients(context: JobContext, path: str, batch_size=None) -> dict:
+    """
+    Import patients from a file on the server
+    """
+    # Arguments given on the command line are text
+    report = PatientImporter(batch_size=int(batch_size) if batch_size else None).run(path)
+
+    return {'imported': report.imported,
+            'errors': [{'line': line, 'name': name, 'message': message} for line, name, message in report.errors]}
+
+
+@job_function('search-index')
+def run_search_index(context: JobContext) -> dict:
+    """
+    Rebuild search indexes of patients and staff
+    """
+    build_search_index(replace=True)
+
+    return {}
+
+
+@job_function('recount-patients')
+def run_recount_patients(context: JobContext) -> dict:
+    """
+    Recount the number of patients of each doctor
+    """
+    Doctor.recount_patients()
+
+    return {}
+
+
+@job_function('archive')
+def run_archive(context: JobContext, batch_size=None) -> dict:
+    """
+    Move past appointments and old prescriptions into archive tables
+    """
+    total = sum(count_archivable(resource) for resource in ARCHIVES)
+    done = 0
+
+    def on_batch(rows: int):
+        nonlocal done
+        done += rows
+        context.progress(done, total)
+
+    # Arguments given on the command line are text
+    return archive_all(batch_size=int(batch_size) if batch_size else None, on_batch=on_batch)
+
+
+@job_function('rebuild-analytics')
+def run_rebuild_analytics(context: JobContext) -> dict:
+    """
+    Rebuild daily rollups of prescriptions for analytics
+    """
+    return {'prescriptions': rebuild_rollups()}
+
+
+def timestamp(value: float) -> str:
+    """
+    Convert seconds since the epoch into ISO format in UTC
+    """
+    return datetime.utcfromtimestamp(value).isoformat() if value else None
+
+
+def job_to_dict(job: dict) -> dict:
+    """
+    Convert a job into a dict for the JSON API
+    """
+    result = {
+        'id': job['id'], 'kind': job['kind'], 'args': job['args'], 'status': job['status'],
+        'progress': job['progress'], 'message': job['message'], 'error': job['error'], 'result': job['result'],
+        'attempts': job['attempts'], 'max_attempts': job['max_attempts'], 'created_by': job['created_by'],
+        'created_at': timestamp(job['created_at']), 'started_at': timestamp(job['started_at']),
+        'finished_at': timestamp(job['finished_at']),
+        'retry_at': timestamp(job['run_at']) if job['status'] == QUEUED and job['attempts'] else None,
+        'url': url_for('api_job', job_id=job['id']),
+    }
+    if job['kind'] == 'export' and job['status'] == SUCCEEDED:
+        result['download'] = url_for('api_job_download', job_id=job['id'])
+
+    return result
+
+
+def find_job(job_id: int) -> dict:
+    """
+    Get a job that the current user can see. Doctors can see every job.
+
+    :return:
+     job: dict (None if it does not exist or the user cannot see it)
+    """
+    job = get_queue().get(job_id)
+    if job is None or (job['created_by'] != current_user.username and not current_identity().is_doctor):
+        return None
+
+    return job
+
+
+@app.before_first_request
+def _start_job_runner():
+    if app.config['JOB_RUNNER'] == 'thread' and app.config['JOB_RUNNER_AUTOSTART'] and not app.testing:
+        start_runner()
+
+
+@app.route(API_PREFIX + '/jobs', methods=['GET', 'POST'])
+@api_login_required()
+def api_jobs():
+    """
+    API for background jobs
+    GET lists the latest jobs of the user.
+    POST submits a job, with kind and its arguments given by a JSON body or form data.
+     - export: resource(appointments, prescriptions or patients), format(csv or ndjson), date_from, date_to, history
+     - search-index, recount-patients, archive, rebuild-analytics: only doctors can submit them
+    """
+    if request.method == 'GET':
+        return jsonify({'items': [job_to_dict(job) for job in get_queue().latest(created_by=current_user.username)]})
+
+    data = request.get_json(silent=True) or request.form
+    kind = data.get('kind')
+    if kind == 'export':
+        resource = data.get('resource')
+        export_format = data.get('format', 'csv')
+        if resource not in EXPORTS or export_format not in EXPORT_FORMATS:
+            return jsonify({'error': 'Choose a resource and a format to export.'}), 400
+        # Only doctors can read prescriptions and patients
+        if resource != 'appointments' and not current_identity().is_doctor:
+            return jsonify({'error': 'You are not authorized to perform this operation.'}), 403
+        args = {'resource': resource, 'export_format': export_format, 'date_from': data.get('date_from', ''),
+                'date_to': data.get('date_to', ''), 'history': data.get('history', '')}
+    elif kind in ('search-index', 'recount-patients', 'archive', 'rebuild-analytics'):
+        if not current_identity().is_doctor:
+            return jsonify({'error': 'You are not authorized to perform this operation.'}), 403
+        args = {}
+    else:
+        return jsonify({'error': f'Unknown kind of job: {kind}'}), 400
+
+    job_id = submit_job(kind, args, created_by=current_user.username)
+    response = jsonify(job_to_dict(get_queue().get(job_id)))
+    response.status_code = 202
+    response.headers['Location'] = url_for('api_job', job_id=job_id)
+
+    return response
+
+
+@app.route(API_PREFIX + '/jobs/<int:job_id>')
+@api_login_required()
+def api_job(job_id: int):
+    """
+    API for the status and progress of a job
+    """
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'The job is not found.'}), 404
+
+    return jsonify(job_to_dict(job))
+
+
+@app.route(API_PREFIX + '/jobs/<int:job_id>/download')
+@api_login_required()
+def api_job_download(job_id: int):
+    """
+    API for the file written by an export job
+    """
+    job = find_job(job_id)
+    if job is None or job['kind'] != 'export':
+        return jsonify({'error': 'The job is not found.'}), 404
+    if job['status'] != SUCCEEDED:
+        return jsonify({'error': f"The job is {job['status']}."}), 409
+
+    mimetype, _ = EXPORT_FORMATS[job['args']['export_format']]
+    path = os.path.join(app.config['JOB_OUTPUT_DIR'], job['result']['filename'])
+
+    return send_file(path, mimetype=mimetype, as_attachment=True, download_name=job['result']['filename'])
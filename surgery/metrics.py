@@ -0,0 +1,180 @@
+import logging
+import os
+import threading
+import time
+from flask import g, request, has_request_context, Response, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from surgery import app
+
+"""
+This script defines instrumentation of requests and SQL statements
+For each request, the number of SQL statements, total SQL time and latency are recorded per route.
+They are exposed in Prometheus text format by /metrics, and slow statements are written to a slow query log.
+Metrics are kept per process. Under gunicorn each scrape is answered by one of the workers, so every series has
+a pid label, and the counters of a host are the sum over pids. A worker replaced after max_requests starts new series.
+/metrics is answered only to METRICS_ALLOWED_ADDRESSES, such as a scraper on the same host.
+"""
+
+# Upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_query_logger = logging.getLogger('surgery.slow_query')
+
+
+class RouteStats(object):
+    """
+    Class that accumulates metrics of a route
+    """
+    __slots__ = ('requests', 'latency_sum', 'latency_buckets', 'sql_queries', 'sql_seconds', 'slow_queries')
+
+    def __init__(self):
+        self.requests = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.slow_queries = 0
+
+
+class MetricsRegistry(object):
+    """
+    Class that keeps metrics of all routes in a process
+    """
+    def __init__(self):
+        # (endpoint, method, status) -> RouteStats
+        self.__routes: dict[tuple, RouteStats] = {}
+        self.__lock = threading.Lock()
+
+    def record(self, endpoint: str, method: str, status: int, latency: float, sql_queries: int, sql_seconds: float,
+               slow_queries: int):
+        """
+        Record a finished request
+        """
+        with self.__lock:
+            stats = self.__routes.get((endpoint, method, status))
+            if stats is None:
+                stats = self.__routes[(endpoint, method, status)] = RouteStats()
+            stats.requests += 1
+            stats.latency_sum += latency
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.latency_buckets[i] += 1
+            stats.sql_queries += sql_queries
+            stats.sql_seconds += sql_seconds
+            stats.slow_queries += slow_queries
+
+    def render(self) -> str:
+        """
+        Render metrics in Prometheus text format
+
+        :return:
+         text: str
+        """
+        # Scrapes are rare, so metrics are rendered while holding the lock
+        with self.__lock:
+            return self.__render(sorted(self.__routes.items()))
+
+    @staticmethod
+    def __render(routes: list) -> str:
+        pid = os.getpid()
+        lines = [
+            '# HELP surgery_request_duration_seconds Latency of requests.',
+            '# TYPE surgery_request_duration_seconds histogram',
+        ]
+        for (endpoint, method, status), stats in routes:
+            labels = f'endpoint="{escape(endpoint)}",method="{method}",status="{status}",pid="{pid}"'
+            for bound, count in zip(LATENCY_BUCKETS, stats.latency_buckets):
+                lines.append(f'surgery_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'surgery_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.requests}')
+            lines.append(f'surgery_request_duration_seconds_sum{{{labels}}} {stats.latency_sum:.6f}')
+            lines.append(f'surgery_request_duration_seconds_count{{{labels}}} {stats.requests}')
+
+        for name, description, attribute, spec in (
+                ('surgery_request_sql_queries_total', 'SQL statements executed by requests.', 'sql_queries', 'd'),
+                ('surgery_request_sql_seconds_total', 'Time spent on SQL statements by requests.', 'sql_seconds', '.6f'),
+                ('surgery_request_slow_queries_total', 'SQL statements slower than the threshold.', 'slow_queries', 'd')):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} counter')
+            for (endpoint, method, status), stats in routes:
+                labels = f'endpoint="{escape(endpoint)}",method="{method}",status="{status}",pid="{pid}"'
+                lines.append(f'{name}{{{labels}}} {getattr(stats, attribute):{spec}}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value: str) -> str:
+    """
+    Escape a label value of Prometheus text format
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # The execution context is kept with the start time, so that a failed statement is dropped by handle_error
+    conn.info.setdefault('query_started', []).append((context, time.perf_counter()))
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _, started = conn.info['query_started'].pop()
+    if not has_request_context() or 'sql_queries' not in g:
+        return
+
+    elapsed = time.perf_counter() - started
+    g.sql_queries += 1
+    g.sql_seconds += elapsed
+    if elapsed * 1000 >= app.config['SLOW_QUERY_THRESHOLD_MS']:
+        g.slow_queries += 1
+        slow_query_logger.warning('%.1fms %s %s: %s', elapsed * 1000, request.method, request.path, statement)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _forget_failed_statement(context):
+    # A failed statement has no after_cursor_execute, so its start time is dropped here.
+    # Statements that failed before before_cursor_execute have pushed nothing.
+    started = context.connection.info.get('query_started') if context.connection is not None else None
+    if started and context.execution_context is not None and started[-1][0] is context.execution_context:
+        started.pop()
+
+
+@app.before_request
+def _start_request():
+    if app.config['METRICS_ENABLED']:
+        g.request_started = time.perf_counter()
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+        g.slow_queries = 0
+
+
+@app.after_request
+def _finish_request(response):
+    if 'request_started' in g and request.endpoint not in (None, 'static', 'metrics'):
+        registry.record(endpoint=request.endpoint, method=request.method, status=response.status_code,
+                        latency=time.perf_counter() - g.request_started, sql_queries=g.sql_queries,
+                        sql_seconds=g.sql_seconds, slow_queries=g.slow_queries)
+
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Controller for metrics in Prometheus text format
+    Metrics are of the process serving the request. See the description of this script.
+    """
+    if request.remote_addr not in app.config['METRICS_ALLOWED_ADDRESSES']:
+        abort(403)
+
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Write slow statements to a file if it is configured
+if app.config.get('SLOW_QUERY_LOG'):
+    handler = logging.FileHandler(app.config['SLOW_QUERY_LOG'])
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_query_logger.addHandler(handler)
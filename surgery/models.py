@@ -1,6 +1,10 @@
-from surgery import db, login
+import threading
+import time as timer
+from surgery import app, db
+from surgery.passwords import hash_password, verify_password, needs_rehash
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, inspect, select, func, case, and_
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, date, time, timedelta
 
 
@@ -10,6 +14,52 @@ Model classes perform manipulating a database and business logics
 For manipulating a database, sqlalchemy is used as ORM
 """
 
+# Number of patients that a doctor can register
+PATIENT_QUOTA = 500
+
+
+class UnitOfWork(object):
+    """
+    Context manager that runs several operations as one transaction
+    Inside it, persist() and delete() of models only flush changes, and everything is committed once at the end.
+    If an error occurs, everything is rolled back. Units of work can be nested, and the outermost one commits.
+
+    with UnitOfWork():
+        patient = receptionist.add_patient(...)
+        receptionist.make_appointment(..., patient=patient, ...)
+    """
+    def __enter__(self):
+        db.session.info['unit_of_work'] = db.session.info.get('unit_of_work', 0) + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        depth = db.session.info.pop('unit_of_work') - 1
+        if depth:
+            db.session.info['unit_of_work'] = depth
+            return False
+
+        if exc_type is not None:
+            db.session.rollback()
+            return False
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        return False
+
+
+def commit_or_flush():
+    """
+    Commit changes of the session, or only flush them inside a unit of work
+    Flushing gives ids to new records, so that they can be referred to by the following operations.
+    """
+    if db.session.info.get('unit_of_work'):
+        db.session.flush()
+    else:
+        db.session.commit()
+
 
 class User(UserMixin, db.Model):
     """
@@ -26,21 +76,27 @@ class User(UserMixin, db.Model):
         """
         Generate a hash for hiding password
         """
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password: str):
         """
         Check if input password matches
         """
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
 
-    def __repr__(self):
-        return '<User {}>'.format(self.username)
+    def rehash_password(self, password: str):
+        """
+        Replace the hash if it is made by old parameters
+        This is called after the password is checked, since the password is known only then.
 
+        :param password: password that has been checked
+        """
+        if needs_rehash(self.password_hash):
+            self.set_password(password)
+            commit_or_flush()
 
-@login.user_loader
-def load_user(id):
-    return User.query.get(int(id))
+    def __repr__(self):
+        return '<User {}>'.format(self.username)
 
 
 class Patient(db.Model):
@@ -49,33 +105,44 @@ class Patient(db.Model):
     Created by Doctor class
     """
     __tablename__ = 'patient'
+    # Each sortable column of the list is indexed with id, which breaks ties, so a page is read from the index
+    __table_args__ = (db.Index('ix_patient_created_at_id', 'created_at', 'id'), )
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(32), index=True, unique=True)
+    name = db.Column(db.String(32), index=True, unique=True, nullable=False)
     address = db.Column(db.String(64))
     phone = db.Column(db.String(15))
     # This is used to be associated with HealthcareProfessional staff
-    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'))
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), index=True)
     appointment = db.relationship('Appointment', backref='patient', lazy='dynamic', \
                                   primaryjoin="Patient.id == Appointment.patient_id")
     prescription = db.relationship('Prescription', backref='patient', lazy='dynamic', \
                                   primaryjoin="Patient.id == Prescription.patient_id")
     # This is used to record when the patient is registered, set by default when creating instance
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def to_dict(self) -> dict:
+        """
+        Convert into a dict for the JSON API
+        The primary doctor should be loaded with the patient.
+        """
+        return {'id': self.id, 'name': self.name, 'address': self.address, 'phone': self.phone,
+                'doctor_id': self.doctor_id, 'doctor_name': self.doctor.name if self.doctor else None,
+                'created_at': self.created_at.isoformat() if self.created_at else None}
 
     def persist(self):
         """
         Inserting a record into a database is performed
         """
         db.session.add(self)
-        db.session.commit()
+        commit_or_flush()
 
     def delete(self):
         """
         Deleting a record from a database is performed
         """
         db.session.delete(self)
-        db.session.commit()
+        commit_or_flush()
 
 
 class Prescription(db.Model):
@@ -84,34 +151,49 @@ class Prescription(db.Model):
     Created by Doctor class
     """
     __tablename__ = 'prescription'
+    # Each sortable column of the list is indexed with id, which breaks ties, so a page is read from the index
+    __table_args__ = (db.Index('ix_prescription_type_id', 'type', 'id'),
+                      db.Index('ix_prescription_quantity_id', 'quantity', 'id'))
 
     id = db.Column(db.Integer, primary_key=True)
     # This represents prescription type.
-    type = db.Column(db.String(12))
+    type = db.Column(db.String(12), nullable=False)
     # This is used to be associated with patient
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'))
     # This is used to be associated with Doctor
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'))
     # This is quantity of medicine
-    quantity = db.Column(db.Integer)
+    quantity = db.Column(db.Integer, nullable=False)
     # This is dosage of medicine
     dosage = db.Column(db.Float)
     # This is used to record when the prescription is registered, set by default when creating instance
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Indexed so that old prescriptions can be archived by a range query
+    # The index of a column is ordered by (column, id), since id is the rowid, so it also serves the sorted list
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True, nullable=False)
+
+    def to_dict(self) -> dict:
+        """
+        Convert into a dict for the JSON API
+        The doctor and the patient should be loaded with the prescription.
+        """
+        return {'id': self.id, 'type': self.type, 'patient_id': self.patient_id,
+                'patient_name': self.patient.name if self.patient else None, 'doctor_id': self.doctor_id,
+                'doctor_name': self.doctor.name if self.doctor else None, 'quantity': self.quantity,
+                'dosage': self.dosage, 'created_at': self.created_at.isoformat() if self.created_at else None}
 
     def persist(self):
         """
         Inserting a record into a database is performed
         """
         db.session.add(self)
-        db.session.commit()
+        commit_or_flush()
 
     def delete(self):
         """
         Deleting a record from a database is performed
         """
         db.session.delete(self)
-        db.session.commit()
+        commit_or_flush()
 
 
 class HealthcareProfessional(db.Model):
@@ -119,34 +201,43 @@ class HealthcareProfessional(db.Model):
     Class that represents HealthcareProfessional staff
     """
     __tablename__ = 'healthcare_pro'
+    # Each sortable column of the list is indexed with id, which breaks ties, so a page is read from the index
+    __table_args__ = (db.Index('ix_healthcare_pro_created_at_id', 'created_at', 'id'), )
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(32), index=True, unique=True)
-    employee_num = db.Column(db.String(5), index=True, unique=True)
+    name = db.Column(db.String(32), index=True, unique=True, nullable=False)
+    employee_num = db.Column(db.String(5), index=True, unique=True, nullable=False)
     employee_type = db.Column(db.String(20))
     appointment = db.relationship('Appointment', backref='healthcare_pro', lazy='dynamic', \
                                   primaryjoin="HealthcareProfessional.id == Appointment.staff_id")
     # This is used to record when the healthcare_pro is registered, set by default when creating instance
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
     __mapper_args__ = {
         'polymorphic_identity':'healthcare_pro',
         'polymorphic_on':employee_type
     }
 
+    def to_dict(self) -> dict:
+        """
+        Convert into a dict for the JSON API
+        """
+        return {'id': self.id, 'name': self.name, 'employee_num': self.employee_num, 'type': self.employee_type,
+                'created_at': self.created_at.isoformat() if self.created_at else None}
+
     def persist(self):
         """
         Inserting a record into a database is performed
         """
         db.session.add(self)
-        db.session.commit()
+        commit_or_flush()
 
     def delete(self):
         """
         Deleting a record from a database is performed
         """
         db.session.delete(self)
-        db.session.commit()
+        commit_or_flush()
 
     # I did not implement a concrete logic as it is not the essence of this assignment
     def conduct_consultation(self) -> str:
@@ -160,6 +251,8 @@ class Doctor(HealthcareProfessional):
     __tablename__ = 'doctor'
 
     id = db.Column(db.Integer, db.ForeignKey('healthcare_pro.id'), primary_key=True)
+    # Number of registered patients, kept up to date in the transaction that registers, deletes or reassigns them
+    patient_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     patient = db.relationship('Patient', backref='doctor', lazy='dynamic', \
                                   primaryjoin="Doctor.id == Patient.doctor_id")
     prescription = db.relationship('Prescription', backref='doctor', lazy='dynamic', \
@@ -190,8 +283,65 @@ class Doctor(HealthcareProfessional):
         :param phone:
         :param doctor_id:
         """
-        patient = Patient(name=name, address=address, phone=phone, doctor_id=doctor_id)
-        patient.persist()
+        with UnitOfWork():
+            patient = Patient(name=name, address=address, phone=phone, doctor_id=doctor_id)
+            patient.persist()
+            # The count is incremented by the insert, which also locks it until the end of the transaction
+            # A staff without a doctor row has no count
+            count = Doctor.count_patients(doctor_id)
+            if count is None:
+                raise UnregisteredDoctorError()
+            if count > PATIENT_QUOTA:
+                raise PatientQuotaError()
+
+    def to_dict(self) -> dict:
+        """
+        Convert into a dict for the JSON API, with the remaining capacity of patients
+        """
+        result = super().to_dict()
+        result.update({'patient_count': self.patient_count, 'patient_quota': PATIENT_QUOTA,
+                       'remaining_capacity': max(PATIENT_QUOTA - self.patient_count, 0)})
+
+        return result
+
+    @staticmethod
+    def count_patients(doctor_id: int) -> int:
+        """
+        Read the stored number of patients of the doctor from the database
+
+        :param doctor_id:
+        :return:
+         count: int
+        """
+        return db.session.query(Doctor.patient_count).filter(Doctor.id == doctor_id).scalar()
+
+    @staticmethod
+    def add_patient_count(connection, doctor_id: int, delta: int):
+        """
+        Add delta to the number of patients of the doctor on the connection
+        The count is updated by an expression, so concurrent transactions do not lose each other's changes.
+        """
+        if doctor_id is not None and delta:
+            table = Doctor.__table__
+            connection.execute(table.update().where(table.c.id == doctor_id)
+                               .values(patient_count=table.c.patient_count + delta))
+
+    @staticmethod
+    def recount_patients():
+        """
+        Recount the patients of every doctor by one statement
+        This is used after patients are written without the session, or to repair counts.
+        """
+        # surgery.versions imports this module, so it is imported when it is used
+        from surgery.versions import mark_changed
+
+        table = Doctor.__table__
+        patient = Patient.__table__
+        count = db.select(db.func.count(patient.c.id)).where(patient.c.doctor_id == table.c.id).scalar_subquery()
+        db.session.execute(table.update().values(patient_count=count))
+        # The statement bypasses the session, so responses of the counts are invalidated here
+        mark_changed(table.name)
+        commit_or_flush()
 
     def delete_patient(self, patient_id: int):
         """
@@ -223,6 +373,26 @@ class Doctor(HealthcareProfessional):
         prescription.delete()
 
 
+@event.listens_for(Patient, 'after_insert')
+def _count_registered_patient(mapper, connection, target):
+    Doctor.add_patient_count(connection, target.doctor_id, 1)
+
+
+@event.listens_for(Patient, 'after_delete')
+def _count_deleted_patient(mapper, connection, target):
+    Doctor.add_patient_count(connection, target.doctor_id, -1)
+
+
+@event.listens_for(Patient, 'after_update')
+def _count_reassigned_patient(mapper, connection, target):
+    # The history is empty unless the primary doctor is changed
+    history = inspect(target).attrs.doctor_id.history
+    for doctor_id in history.deleted:
+        Doctor.add_patient_count(connection, doctor_id, -1)
+    for doctor_id in history.added:
+        Doctor.add_patient_count(connection, doctor_id, 1)
+
+
 class Nurse(HealthcareProfessional):
     """
     Class that represents doctors, inheriting HealthcareProfessional class.
@@ -242,69 +412,639 @@ class Appointment(db.Model):
     Created by Receptionist class
     """
     __tablename__ = 'appointment'
+    # A staff cannot have two appointments in the same slot
+    # The database rejects the second booking even when receptionists book at the same time
+    # Each sortable column of the list is indexed with id, which breaks ties, so a page is read from the index
+    __table_args__ = (db.UniqueConstraint('staff_id', 'date', name='uq_appointment_staff_date'),
+                      db.Index('ix_appointment_type_id', 'type', 'id'),
+                      db.Index('ix_appointment_created_at_id', 'created_at', 'id'))
 
     id = db.Column(db.Integer, primary_key=True)
     # This represents appointment type. Should select the below.
     # Consultation/Prescription/Surgery
-    type = db.Column(db.String(12))
+    type = db.Column(db.String(12), nullable=False)
     # This is used to be associated with HealthcareProfessional
     staff_id = db.Column(db.Integer, db.ForeignKey('healthcare_pro.id'))
     # This is used to be associated with patient
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'))
     # Appointment date
-    date = db.Column(db.DateTime)
+    # Indexed so that availability checks can run range queries over future dates
+    date = db.Column(db.DateTime, index=True, nullable=False)
     # This is used to record the name of the receptionist making appointment
     created_by = db.Column(db.String(32))
     # This is used to record when the appointment is made, set by default when creating instance
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def to_dict(self) -> dict:
+        """
+        Convert into a dict for the JSON API
+        The staff and the patient should be loaded with the appointment.
+        """
+        return {'id': self.id, 'type': self.type, 'staff_id': self.staff_id,
+                'staff_name': self.healthcare_pro.name if self.healthcare_pro else None, 'patient_id': self.patient_id,
+                'patient_name': self.patient.name if self.patient else None,
+                'date': self.date.isoformat() if self.date else None, 'created_by': self.created_by,
+                'created_at': self.created_at.isoformat() if self.created_at else None}
 
     def persist(self):
         """
         Inserting a record into a database is performed
         """
         db.session.add(self)
-        db.session.commit()
+        commit_or_flush()
 
     def delete(self):
         """
         Deleting a record from a database is performed
         """
         db.session.delete(self)
-        db.session.commit()
+        commit_or_flush()
+
+
+class AppointmentChange(db.Model):
+    """
+    Class that represents a change of appointments, which is sent to reception boards as a delta
+    Created by Receptionist class in the transaction that makes or cancels the appointment
+    The appointment is copied, so that a delta is sent without reading other tables.
+    """
+    __tablename__ = 'appointment_change'
+
+    # This is used as the event id of the delta
+    id = db.Column(db.Integer, primary_key=True)
+    # This represents what happened. Should select the below.
+    # created/cancelled
+    action = db.Column(db.String(10))
+    # Cancelled appointments are deleted, so this is not a foreign key
+    appointment_id = db.Column(db.Integer)
+    type = db.Column(db.String(12))
+    staff_id = db.Column(db.Integer)
+    staff_name = db.Column(db.String(32))
+    patient_id = db.Column(db.Integer)
+    patient_name = db.Column(db.String(32))
+    date = db.Column(db.DateTime)
+    created_by = db.Column(db.String(32))
+    created_at = db.Column(db.DateTime)
+    # This is used to record when the change is made, set by default when creating instance
+    # Indexed so that a board can read the changes after it is rendered
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    @classmethod
+    def of(cls, action: str, appointment: Appointment, staff: HealthcareProfessional, patient: Patient):
+        """
+        Create a change of the appointment
+
+        :param action: created or cancelled
+        :param appointment:
+        :param staff: staff of the appointment
+        :param patient: patient of the appointment
+        :return:
+         change: AppointmentChange
+        """
+        return cls(action=action, appointment_id=appointment.id, type=appointment.type, staff_id=appointment.staff_id,
+                   staff_name=staff.name if staff else None, patient_id=appointment.patient_id,
+                   patient_name=patient.name if patient else None, date=appointment.date,
+                   created_by=appointment.created_by, created_at=appointment.created_at)
+
+    def to_dict(self) -> dict:
+        """
+        Convert into a dict sent as a delta
+        The appointment has the same keys as Appointment.to_dict().
+        """
+        return {'action': self.action, 'appointment': {
+            'id': self.appointment_id, 'type': self.type, 'staff_id': self.staff_id, 'staff_name': self.staff_name,
+            'patient_id': self.patient_id, 'patient_name': self.patient_name,
+            'date': self.date.isoformat() if self.date else None, 'created_by': self.created_by,
+            'created_at': self.created_at.isoformat() if self.created_at else None}}
+
+    def persist(self):
+        """
+        Inserting a record into a database is performed
+        """
+        db.session.add(self)
+        commit_or_flush()
+
+
+class TableVersion(db.Model):
+    """
+    Class that represents the change counter of a table
+    The version is incremented in the transaction that changes the table, so every worker process sees the same version.
+    """
+    __tablename__ = 'table_version'
+
+    # Name of the counted table
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # This is used to record when the table is changed last
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class AppointmentArchive(db.Model):
+    """
+    Class that represents a past appointment moved out of appointment table
+    Rows are moved by surgery.archive with the same ids, and are only read as history.
+    """
+    __tablename__ = 'appointment_archive'
+    # Sortable columns are indexed with id, the same as appointment table
+    __table_args__ = (db.Index('ix_appointment_archive_type_id', 'type', 'id'),
+                      db.Index('ix_appointment_archive_created_at_id', 'created_at', 'id'))
+
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(12), nullable=False)
+    staff_id = db.Column(db.Integer, db.ForeignKey('healthcare_pro.id'), index=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), index=True)
+    date = db.Column(db.DateTime, index=True, nullable=False)
+    created_by = db.Column(db.String(32))
+    created_at = db.Column(db.DateTime, nullable=False)
+    # This is used to record when the appointment is archived
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    healthcare_pro = db.relationship('HealthcareProfessional', viewonly=True)
+    patient = db.relationship('Patient', viewonly=True)
+
+    def to_dict(self) -> dict:
+        """
+        Convert into a dict for the JSON API
+        It has the same keys as Appointment.to_dict() and archived_at.
+        """
+        return dict(Appointment.to_dict(self), archived_at=self.archived_at.isoformat() if self.archived_at else None)
+
+
+class PrescriptionArchive(db.Model):
+    """
+    Class that represents an old prescription moved out of prescription table
+    Rows are moved by surgery.archive with the same ids, and are only read as history.
+    """
+    __tablename__ = 'prescription_archive'
+    # Sortable columns are indexed with id, the same as prescription table
+    __table_args__ = (db.Index('ix_prescription_archive_type_id', 'type', 'id'),
+                      db.Index('ix_prescription_archive_quantity_id', 'quantity', 'id'))
+
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(12), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), index=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    dosage = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, index=True, nullable=False)
+    # This is used to record when the prescription is archived
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    doctor = db.relationship('Doctor', viewonly=True)
+    patient = db.relationship('Patient', viewonly=True)
+
+    def to_dict(self) -> dict:
+        """
+        Convert into a dict for the JSON API
+        It has the same keys as Prescription.to_dict() and archived_at.
+        """
+        return dict(Prescription.to_dict(self), archived_at=self.archived_at.isoformat() if self.archived_at else None)
+
+
+class PrescriptionRollup(db.Model):
+    """
+    Class that represents the number and totals of prescriptions issued by a doctor in a day or a month, by type
+    Kept up to date by surgery.analytics in the transaction that issues or cancels a prescription.
+    """
+    __tablename__ = 'prescription_rollup'
+    # Rows are stored in the order of the primary key, so a range of it is read without lookups
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    # day or month. Reports over long ranges read monthly rows.
+    grain = db.Column(db.String(5), primary_key=True)
+    # The day, or the first day of the month
+    day = db.Column(db.Date, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), primary_key=True)
+    type = db.Column(db.String(12), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total_quantity = db.Column(db.Integer, nullable=False, default=0)
+    total_dosage = db.Column(db.Float, nullable=False, default=0)
+
+
+class PrescriptionHistogram(db.Model):
+    """
+    Class that represents the number of prescriptions whose quantity or dosage is in a bucket,
+    issued by a doctor in a day or a month, by type
+    Kept up to date by surgery.analytics in the transaction that issues or cancels a prescription.
+    """
+    __tablename__ = 'prescription_histogram'
+    # Rows are stored in the order of the primary key, so a distribution is summed in the order of buckets
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    # day or month, the same as PrescriptionRollup
+    grain = db.Column(db.String(5), primary_key=True)
+    # quantity or dosage
+    measure = db.Column(db.String(8), primary_key=True)
+    # Lower bound of the bucket
+    bucket = db.Column(db.Float, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), primary_key=True)
+    type = db.Column(db.String(12), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
 
 
 """
 The below is classes mainly for business logic
 These are not migrated into a database
 """
+# Hours available for appointment
+APPOINTMENT_HOURS: list[int] = [9, 11, 14, 16]
+# Types of appointment, the same as the choices of AppointmentForm
+APPOINTMENT_TYPES: list[str] = ['Consultation', 'Prescription', 'Surgery']
+# Number of days read by one query when searching for the next available date
+AVAILABILITY_WINDOW_DAYS = 14
+# Reasons why an appointment of a recurring or bulk booking is not made
+BOOKING_CONFLICTS = {
+    'booked': 'the staff already has an appointment',
+    'duplicate': 'the slot is requested more than once',
+    'past': 'the date is before tomorrow',
+    'not_a_slot': 'the time is not a slot for appointment',
+    'unknown_staff': 'the staff is not found',
+    'unknown_patient': 'the patient is not found',
+}
+
+
+class SlotUnavailableError(Exception):
+    """
+    Error raised when the slot of an appointment is already taken
+    It carries the next slot that is free for the same staff.
+    """
+    def __init__(self, date: datetime, next_available_date: datetime):
+        super().__init__(f'{date} is not available. Next available date is {next_available_date}')
+        self.date = date
+        self.next_available_date = next_available_date
+
+
+class PatientQuotaError(Exception):
+    """
+    Error raised when a doctor already has as many patients as PATIENT_QUOTA
+    """
+    def __init__(self):
+        super().__init__(f'Less than {PATIENT_QUOTA} patients can be registered by a doctor.')
+
+
+class UnregisteredDoctorError(PatientQuotaError):
+    """
+    Error raised when patients are registered to a staff who is not registered as a doctor
+    It is a PatientQuotaError, since such a staff can have no patients.
+    """
+    def __init__(self):
+        Exception.__init__(self, 'The doctor you entered is not registered.')
+
+
+class BookingConflict(object):
+    """
+    Appointment of a recurring or bulk booking that is not made, and the reason
+    """
+    def __init__(self, index: int, date: datetime, reason: str, staff: HealthcareProfessional = None,
+                 patient: Patient = None):
+        """
+        :param index: position of the appointment in the booking
+        :param date:
+        :param reason: key of BOOKING_CONFLICTS
+        :param staff:
+        :param patient:
+        """
+        self.index = index
+        self.date = date
+        self.reason = reason
+        self.staff = staff
+        self.patient = patient
+
+    def to_dict(self) -> dict:
+        """
+        Convert into a dict for the JSON API
+        """
+        return {'index': self.index, 'date': self.date.isoformat() if self.date else None,
+                'staff_id': self.staff.id if self.staff else None, 'staff_name': self.staff.name if self.staff else None,
+                'patient_id': self.patient.id if self.patient else None,
+                'patient_name': self.patient.name if self.patient else None,
+                'reason': self.reason, 'message': BOOKING_CONFLICTS[self.reason]}
+
+    def __str__(self):
+        staff_name = self.staff.name if self.staff else None
+        return f'{self.date} ({staff_name}) is not booked: {BOOKING_CONFLICTS[self.reason]}'
+
+
+class Occupancy(object):
+    """
+    Booked and free slots of each staff over a range of days, read by AppointmentSchedule.occupancy()
+    Slots of a staff on a day are kept as a bit mask, where bit i is set if APPOINTMENT_HOURS[i] is booked.
+    """
+    def __init__(self, days: list[date], staff: list[tuple], masks: dict):
+        """
+        :param days: days in the range
+        :param staff: (id, name, employee type) of staff
+        :param masks: bit masks of booked slots keyed by (staff id, day)
+        """
+        self.days = days
+        self.staff = staff
+        self.__masks = masks
+        # Numbers of booked slots summed up by staff, by day and by slot
+        self.__staff_booked: dict[int, int] = {}
+        self.__day_booked: dict[date, int] = {}
+        self.__slot_booked: dict[tuple, int] = {}
+        for (staff_id, day), mask in masks.items():
+            count = bin(mask).count('1')
+            self.__staff_booked[staff_id] = self.__staff_booked.get(staff_id, 0) + count
+            self.__day_booked[day] = self.__day_booked.get(day, 0) + count
+            for i, hour in enumerate(APPOINTMENT_HOURS):
+                if mask >> i & 1:
+                    self.__slot_booked[(day, hour)] = self.__slot_booked.get((day, hour), 0) + 1
+
+    def is_booked(self, staff_id: int, day: date, hour: int) -> bool:
+        """
+        Check if the staff has an appointment in the slot
+        """
+        return bool(self.__masks.get((staff_id, day), 0) >> APPOINTMENT_HOURS.index(hour) & 1)
+
+    def booked(self, staff_id: int = None, day: date = None) -> int:
+        """
+        Get the number of booked slots of the staff on the day
+        Slots of every staff, or of every day in the range, are counted if they are not specified.
+        """
+        if staff_id is not None and day is not None:
+            return bin(self.__masks.get((staff_id, day), 0)).count('1')
+        if staff_id is not None:
+            return self.__staff_booked.get(staff_id, 0)
+        if day is not None:
+            return self.__day_booked.get(day, 0)
+
+        return sum(self.__day_booked.values())
+
+    def free(self, staff_id: int = None, day: date = None) -> int:
+        """
+        Get the number of free slots of the staff on the day
+        Slots of every staff, or of every day in the range, are counted if they are not specified.
+        """
+        staff = 1 if staff_id is not None else len(self.staff)
+        days = 1 if day is not None else len(self.days)
+
+        return staff * days * len(APPOINTMENT_HOURS) - self.booked(staff_id, day)
+
+    def slot_booked(self, day: date, hour: int) -> int:
+        """
+        Get the number of staff who have an appointment in the slot
+        """
+        return self.__slot_booked.get((day, hour), 0)
+
+    def slot_free(self, day: date, hour: int) -> int:
+        """
+        Get the number of staff who are free in the slot
+        """
+        return len(self.staff) - self.slot_booked(day, hour)
+
+
+class FreeBusy(object):
+    """
+    Free/busy matrix of staff x day x slot over a range of days, read by AppointmentSchedule.free_busy()
+    Each staff has a row with a bit for every slot from the first day, in the order of days and APPOINTMENT_HOURS.
+    A row is an int used as an array of bits, so a search over all staff is a few operations on whole rows.
+    """
+    def __init__(self, first_day: date, days: int, first_slot: datetime, staff: list[tuple], busy: dict):
+        """
+        :param first_day: day of the first bit
+        :param days: number of days in the matrix
+        :param first_slot: slots before it cannot be booked and are regarded as busy
+        :param staff: (id, name, employee type) of staff in the order of ids
+        :param busy: rows of booked slots keyed by staff id
+        """
+        self.first_day = first_day
+        self.days = days
+        self.staff = staff
+        self.__names = {staff_id: name for staff_id, name, _ in staff}
+        # Bits of slots that can be booked, which are the slots at or after first_slot
+        size = days * len(APPOINTMENT_HOURS)
+        start = (first_slot.date() - first_day).days * len(APPOINTMENT_HOURS) + \
+            sum(1 for hour in APPOINTMENT_HOURS if time(hour=hour) < first_slot.time())
+        bookable = ((1 << size) - 1) & ~((1 << min(max(start, 0), size)) - 1)
+        self.__free = {staff_id: ~busy.get(staff_id, 0) & bookable for staff_id, _, _ in staff}
+
+    def index_of(self, slot: datetime) -> int:
+        """
+        Get the bit of the slot
+
+        :return:
+         index: int (None if the slot is not in the matrix)
+        """
+        if slot.hour not in APPOINTMENT_HOURS or slot.minute or slot.second:
+            return None
+        day = (slot.date() - self.first_day).days
+        if not 0 <= day < self.days:
+            return None
+
+        return day * len(APPOINTMENT_HOURS) + APPOINTMENT_HOURS.index(slot.hour)
+
+    def date_of(self, index: int) -> datetime:
+        """
+        Get the slot of the bit
+        """
+        day, slot = divmod(index, len(APPOINTMENT_HOURS))
+
+        return datetime.combine(self.first_day + timedelta(days=day), time(hour=APPOINTMENT_HOURS[slot]))
+
+    def __rows(self, staff_ids: list[int] = None) -> list[tuple]:
+        if staff_ids is None:
+            return list(self.__free.items())
+
+        return [(staff_id, self.__free[staff_id]) for staff_id in staff_ids if staff_id in self.__free]
+
+    def is_free(self, staff_id: int, slot: datetime) -> bool:
+        """
+        Check if the staff can be booked in the slot
+        """
+        index = self.index_of(slot)
+
+        return index is not None and bool(self.__free.get(staff_id, 0) >> index & 1)
+
+    def free_staff(self, slot: datetime) -> list[int]:
+        """
+        Get ids of staff who can be booked in the slot
+        """
+        index = self.index_of(slot)
+        if index is None:
+            return []
+
+        return [staff_id for staff_id, row in self.__free.items() if row >> index & 1]
+
+    def earliest(self, staff_ids: list[int] = None) -> tuple:
+        """
+        Find the earliest slot in which any of the staff can be booked
+        Ties are broken by staff id.
+
+        :param staff_ids: staff to search. Every staff in the matrix is searched if it is not specified.
+        :return:
+         (slot: datetime, staff id, staff name) (None if no slot is free)
+        """
+        options = self.soonest(1, staff_ids)
+
+        return options[0] if options else None
+
+    def soonest(self, n: int, staff_ids: list[int] = None) -> list[tuple]:
+        """
+        Find the n soonest pairs of a slot and a staff who can be booked in it
+
+        :param n: number of options
+        :param staff_ids: staff to search. Every staff in the matrix is searched if it is not specified.
+        :return:
+         options: list of (slot: datetime, staff id, staff name) in the order of slots and staff ids
+        """
+        rows = self.__rows(staff_ids)
+        # Slots in which any of the staff is free
+        free = 0
+        for _, row in rows:
+            free |= row
+
+        options = []
+        while free and len(options) < n:
+            index = (free & -free).bit_length() - 1
+            slot = self.date_of(index)
+            for staff_id, row in rows:
+                if row >> index & 1:
+                    options.append((slot, staff_id, self.__names[staff_id]))
+                    if len(options) == n:
+                        break
+            # Clear the lowest bit
+            free &= free - 1
+
+        return options
+
+
 class AppointmentSchedule(object):
     """
     Model class that manages the schedule of appointments
+    Appointments are not loaded from a database until they are needed.
+    Availability is checked by range queries over future dates, so the cost does not grow with the table size.
     """
     def __init__(self):
-        # Get all appointments from a database
-        self.__appointments: list[Appointment] = Appointment.query.all()
+        # Appointments are loaded lazily by the getter
+        self.__appointments: list[Appointment] = None
 
     @property
     def appointments(self):
         """
         Getter for an instance value
+        Get all appointments from a database when it is called first
 
         :return:
          self.__appointments: Appointment
         """
+        if self.__appointments is None:
+            self.__appointments = Appointment.query.all()
+
         return self.__appointments
 
     def add_appointment(self, appointment: Appointment):
         """
         Add a new appointment and insert into database
+        The slot is reserved by inserting first. If the staff already has an appointment in the slot,
+        the unique constraint rejects the insert and SlotUnavailableError is raised.
+        The transaction is rolled back in that case, including changes of the unit of work.
 
         :param appointment:
         """
         # Inserting a record into a database is performed
-        appointment.persist()
+        staff_id, appointment_date = appointment.staff_id, appointment.date
+        try:
+            appointment.persist()
+        except IntegrityError as e:
+            db.session.rollback()
+            # Other integrity errors are not about the slot
+            if 'appointment.staff_id, appointment.date' not in str(e.orig):
+                raise
+            raise SlotUnavailableError(appointment_date, self.find_next_available(staff_id=staff_id)) from e
+        # Add the record to the appointment list(instance value) if it is already loaded
+        if self.__appointments is not None:
+            self.__appointments.append(appointment)
+
+    def add_appointments(self, appointments: list[Appointment]) -> tuple[list[Appointment], list[tuple]]:
+        """
+        Add appointments and insert into database by one flush
+        Slots of all appointments are checked against booked ones by one query, and appointments that cannot be booked
+        are left out and returned with the reason. The others are inserted in one transaction.
+        If another receptionist books one of the slots between the check and the insert, the unique constraint rejects it,
+        the transaction is rolled back and SlotUnavailableError is raised, the same as add_appointment().
 
-        self.__appointments = Appointment.query.all()
+        :param appointments:
+        :return:
+         added: list of Appointment inserted
+         rejected: list of (index of the appointment, key of BOOKING_CONFLICTS)
+        """
+        first_slot = self.first_slot()
+        candidates = []
+        rejected = []
+        requested = set()
+        for index, appointment in enumerate(appointments):
+            slot = (appointment.staff_id, appointment.date)
+            if appointment.date.hour not in APPOINTMENT_HOURS or appointment.date.time() != time(hour=appointment.date.hour):
+                rejected.append((index, 'not_a_slot'))
+            elif appointment.date < first_slot:
+                rejected.append((index, 'past'))
+            elif slot in requested:
+                rejected.append((index, 'duplicate'))
+            else:
+                requested.add(slot)
+                candidates.append((index, appointment))
+
+        taken = self.taken_slots(list(requested))
+        added = []
+        for index, appointment in candidates:
+            if (appointment.staff_id, appointment.date) in taken:
+                rejected.append((index, 'booked'))
+            else:
+                added.append(appointment)
+        rejected.sort()
+        if not added:
+            return added, rejected
+
+        slots = [(appointment.staff_id, appointment.date) for appointment in added]
+        db.session.add_all(added)
+        try:
+            commit_or_flush()
+        except IntegrityError as e:
+            db.session.rollback()
+            # Other integrity errors are not about the slot
+            if 'appointment.staff_id, appointment.date' not in str(e.orig):
+                raise
+            # The slot booked in the meantime is read again, since the error does not tell which one it is
+            staff_id, appointment_date = min(self.taken_slots(slots) or slots, key=lambda slot: slot[1])
+            raise SlotUnavailableError(appointment_date, self.find_next_available(staff_id=staff_id)) from e
+        # Add the records to the appointment list(instance value) if it is already loaded
+        if self.__appointments is not None:
+            self.__appointments.extend(added)
+
+        return added, rejected
+
+    @staticmethod
+    def taken_slots(slots: list[tuple]) -> set[tuple]:
+        """
+        Find which of the slots are already booked by one query
+        Staff and dates are given as two lists, so that SQLite looks up each pair in the unique index on (staff_id, date).
+        A list of pairs makes it scan the whole index instead. Pairs that are not asked for are dropped after reading.
+
+        :param slots: list of (staff id, date)
+        :return:
+         taken: set of (staff id, date) that have an appointment
+        """
+        if not slots:
+            return set()
+        statement = select(Appointment.staff_id, Appointment.date) \
+            .where(Appointment.staff_id.in_({staff_id for staff_id, _ in slots}),
+                   Appointment.date.in_({appointment_date for _, appointment_date in slots}))
+        slots = set(slots)
+
+        return {(staff_id, appointment_date) for staff_id, appointment_date in db.session.execute(statement)
+                if (staff_id, appointment_date) in slots}
+
+    @staticmethod
+    def recurring_dates(first_date: datetime, interval: timedelta, occurrences: int) -> list[datetime]:
+        """
+        Get the dates of a recurring appointment
+
+        :param first_date: date of the first occurrence
+        :param interval: time between occurrences, such as 7 days
+        :param occurrences: number of occurrences
+        :return:
+         dates: list of datetime
+        """
+        return [first_date + interval * i for i in range(occurrences)]
 
     def cancel_appointment(self, appointment: Appointment):
         """
@@ -314,64 +1054,319 @@ class AppointmentSchedule(object):
         """
         # Deleting a record from a database is performed
         appointment.delete()
-        # remove the record from the appointment list(instance value)
-        self.__appointments.remove(appointment)
+        # remove the record from the appointment list(instance value) if it is already loaded
+        if self.__appointments is not None and appointment in self.__appointments:
+            self.__appointments.remove(appointment)
 
-    def find_next_available(self) -> datetime:
+    @staticmethod
+    def first_slot() -> datetime:
         """
-        Find the next available date for appointment
+        Get the first date that can be booked, which is the first hour of tomorrow
 
         :return:
-         next_available_date: datetime
+         first_slot: datetime
         """
-        scheduled_dates: list[datetime] = []
-        # Hours available for appointment
-        appointment_hours: list[int] = [9, 11, 14, 16]
-        # Initialize next possible date
-        next_available_date = date.today() + timedelta(days=1)
-        next_available_date = datetime.combine(next_available_date, time())
-        next_available_date = next_available_date.replace(hour=appointment_hours[0])
+        return datetime.combine(date.today() + timedelta(days=1), time(hour=APPOINTMENT_HOURS[0]))
 
-        if not self.__appointments:
-            return next_available_date
+    @staticmethod
+    def free_busy(first_slot: datetime = None, days: int = AVAILABILITY_WINDOW_DAYS, staff_id: int = None,
+                  staff_type: str = None, staff_name: str = None) -> FreeBusy:
+        """
+        Read the free/busy matrix of staff over days from the day of first_slot by one grouped range query
 
-        # Make list for scheduled dates of appointments
-        for appointment in self.__appointments:
-            scheduled_dates.append(appointment.date)
+        :param first_slot: the first slot that can be booked, AppointmentSchedule.first_slot() by default
+        :param days: number of days in the matrix
+        :param staff_id: read only this staff if it is specified
+        :param staff_type: doctor or nurse. Every staff is read if it is not specified.
+        :param staff_name: read only this staff if it is specified
+        :return:
+         free_busy: FreeBusy
+        """
+        first_slot = first_slot or AppointmentSchedule.first_slot()
+        first_day = first_slot.date()
+        staff, masks = AppointmentSchedule.booked_masks(first_day, first_day + timedelta(days=days - 1), staff_id=staff_id,
+                                                        staff_type=staff_type, staff_name=staff_name)
+        # Masks of days are put side by side into a row of each staff
+        busy = {}
+        for (row_staff_id, day), mask in masks.items():
+            busy[row_staff_id] = busy.get(row_staff_id, 0) | mask << (day - first_day).days * len(APPOINTMENT_HOURS)
+
+        return FreeBusy(first_day, days, first_slot, sorted(staff), busy)
+
+    def soonest(self, n: int, staff_id: int = None, staff_type: str = None, staff_name: str = None) -> list[tuple]:
+        """
+        Find the n soonest pairs of a slot and a staff who can be booked in it
+        Matrices are read one by one until n options are found, and each matrix is twice as long as the previous one,
+        so a schedule booked far ahead is read by a few queries.
+
+        :param n: number of options
+        :param staff_id: search only this staff if it is specified
+        :param staff_type: doctor or nurse. Every staff is searched if it is not specified.
+        :param staff_name: search only this staff if it is specified
+        :return:
+         options: list of (slot: datetime, staff id, staff name). It is empty if no staff is found.
+        """
+        first_slot = self.first_slot()
+        days = AVAILABILITY_WINDOW_DAYS
+        options = []
+        while len(options) < n:
+            matrix = self.free_busy(first_slot, days, staff_id=staff_id, staff_type=staff_type, staff_name=staff_name)
+            if not matrix.staff:
+                break
+            options += matrix.soonest(n - len(options))
+            first_slot = datetime.combine(first_slot.date() + timedelta(days=days), time(hour=APPOINTMENT_HOURS[0]))
+            days *= 2
+
+        return options
+
+    def find_next_available(self, staff_id: int = None) -> datetime:
+        """
+        Find the next available date for appointment
 
-        # Sort by date
-        scheduled_dates.sort()
+        :param staff_id: find the next date free for this staff. Dates free for any staff are found if it is not specified.
+        :return:
+         next_available_date: datetime (None if no staff is registered)
+        """
+        options = self.soonest(1, staff_id=staff_id)
 
-        '''
-        Iterate scheduled_dates, appointment_hours and next_possible_date
-        Check if it matches next_possible_date.
-        If matched, pass. If not matched, return next_possible_date as the next available date.
-        '''
-        while True:
-            for dt in scheduled_dates:
-                for h in appointment_hours:
-                    next_available_date = next_available_date.replace(hour=h)
-                    if next_available_date == dt:
-                        continue
-                    else:
-                        return next_available_date
+        return options[0][0] if options else None
 
-                next_available_date = next_available_date + timedelta(days=1)
+    @staticmethod
+    def booked_masks(first_day: date, last_day: date, staff_id: int = None, staff_type: str = None,
+                     staff_name: str = None) -> tuple[list[tuple], dict]:
+        """
+        Read booked slots of each staff from first_day to last_day by one grouped query
+        Staff are outer joined with their appointments in the range, so staff without appointments are included.
+        Each staff's appointments are read by a range of the unique index on (staff_id, date),
+        and summed up into a row per staff and day.
+
+        :param first_day:
+        :param last_day: the last day included in the range
+        :param staff_id: read only this staff if it is specified
+        :param staff_type: doctor or nurse. Every staff is read if it is not specified.
+        :param staff_name: read only this staff if it is specified
+        :return:
+         staff: list of (id, name, employee type) in the order of types and names
+         masks: bit masks of booked slots keyed by (staff id, day). Bit i is set if APPOINTMENT_HOURS[i] is booked.
+        """
+        staff = HealthcareProfessional.__table__
+        appointment = Appointment.__table__
+        day = func.date(appointment.c.date)
+        hour = func.strftime('%H', appointment.c.date)
+        # Booked slots of a staff on a day are summed up into a bit mask
+        # Appointments outside the slots, such as ones made before slots are fixed, do not take a slot
+        mask = func.sum(case(*[(hour == f'{h:02d}', 1 << i) for i, h in enumerate(APPOINTMENT_HOURS)], else_=0))
+        statement = select(staff.c.id, staff.c.name, staff.c.employee_type, day, mask) \
+            .select_from(staff.outerjoin(appointment, and_(
+                appointment.c.staff_id == staff.c.id,
+                appointment.c.date >= datetime.combine(first_day, time()),
+                appointment.c.date < datetime.combine(last_day + timedelta(days=1), time())))) \
+            .group_by(staff.c.id, day).order_by(staff.c.employee_type, staff.c.name)
+        if staff_id is not None:
+            statement = statement.where(staff.c.id == staff_id)
+        if staff_type:
+            statement = statement.where(staff.c.employee_type == staff_type)
+        if staff_name:
+            statement = statement.where(staff.c.name == staff_name)
+
+        staff_list = []
+        masks = {}
+        for row_staff_id, name, employee_type, booked_day, booked_mask in db.session.execute(statement):
+            if not staff_list or staff_list[-1][0] != row_staff_id:
+                staff_list.append((row_staff_id, name, employee_type))
+            if booked_day is not None:
+                masks[(row_staff_id, date.fromisoformat(booked_day))] = booked_mask
+
+        return staff_list, masks
+
+    @staticmethod
+    def occupancy(first_day: date, last_day: date, staff_type: str = None, staff_name: str = None) -> Occupancy:
+        """
+        Read booked slots of each staff from first_day to last_day by one grouped query
 
-    def is_date_available(self, date: datetime) -> bool:
+        :param first_day:
+        :param last_day: the last day included in the range
+        :param staff_type: doctor or nurse. Every staff is read if it is not specified.
+        :param staff_name: read only this staff if it is specified
+        :return:
+         occupancy: Occupancy
+        """
+        staff, masks = AppointmentSchedule.booked_masks(first_day, last_day, staff_type=staff_type, staff_name=staff_name)
+        days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+
+        return Occupancy(days, staff, masks)
+
+    def is_date_available(self, date: datetime, staff_id: int = None) -> bool:
         """
         Check if the input date is available
 
         :param date:
+        :param staff_id: check the date of this staff. The date is available if any staff is free if it is not specified.
         :return:
          True: Available
          False: Unavailable
         """
-        appointment = Appointment.query.filter_by(date=date).first()
-        if appointment:
-            return False
-        else:
-            return True
+        if staff_id is not None:
+            query = Appointment.query.filter_by(date=date, staff_id=staff_id)
+            return not db.session.query(query.exists()).scalar()
+
+        # Each staff has one appointment at most in a slot, so someone is free if there are fewer appointments than staff
+        booked = select(func.count()).select_from(Appointment.__table__).where(Appointment.date == date).scalar_subquery()
+        staff = select(func.count()).select_from(HealthcareProfessional.__table__).scalar_subquery()
+
+        return db.session.execute(select(booked < staff)).scalar()
+
+
+class StaffRecord(object):
+    """
+    Compact record of a healthcare professional kept in the roster
+    It has the attributes of HealthcareProfessional that identify the staff, and can be given where staff is booked.
+    is_doctor is True only if the staff also has a row in doctor table, which keeps the number of patients.
+    """
+    __slots__ = ('id', 'name', 'employee_num', 'employee_type', 'is_doctor')
+
+    def __init__(self, id: int, name: str, employee_num: str, employee_type: str, has_doctor_row: bool):
+        self.id = id
+        self.name = name
+        self.employee_num = employee_num
+        self.employee_type = employee_type
+        self.is_doctor = employee_type == 'doctor' and bool(has_doctor_row)
+
+
+class Roster(object):
+    """
+    Process-local index of staff records keyed by id, name and employee number
+    The index is loaded on first use with the versions of healthcare_pro and doctor tables, and is loaded again when
+    either of them is changed. Commits of the process that change staff drop the index at once, and changes made by other worker
+    processes are found by reading the version at most once every ROSTER_VERSION_CHECK_SECONDS,
+    so lookups between the checks run no query.
+    """
+    # Tables whose versions the index is loaded at
+    TABLES = ('healthcare_pro', 'doctor')
+
+    def __init__(self, check_seconds: float):
+        self.__check_seconds = check_seconds
+        # (database, versions, records by id, by name, by employee number), replaced as a whole
+        self.__index: tuple = None
+        self.__checked_at = 0.0
+        self.__lock = threading.Lock()
+
+    def by_id(self, staff_id: int) -> StaffRecord:
+        """
+        Find a staff by the id
+
+        :return:
+         staff: StaffRecord (None if not registered)
+        """
+        return self.__current()[2].get(staff_id)
+
+    def by_name(self, name: str) -> StaffRecord:
+        """
+        Find a staff by the name
+
+        :return:
+         staff: StaffRecord (None if not registered)
+        """
+        return self.__current()[3].get(name)
+
+    def by_employee_num(self, employee_num: str) -> StaffRecord:
+        """
+        Find a staff by the employee number
+
+        :return:
+         staff: StaffRecord (None if not registered)
+        """
+        return self.__current()[4].get(employee_num)
+
+    def by_names(self, names: list[str]) -> dict:
+        """
+        Find staff by their names
+
+        :return:
+         staff: dict of StaffRecord keyed by name. Names that are not found are not in it.
+        """
+        records = self.__current()[3]
+
+        return {name: records[name] for name in names if name in records}
+
+    @property
+    def version(self) -> tuple:
+        """
+        Database and versions of TABLES that the loaded index is at, used to tell if cached staff are stale
+        The versions are not read again, so it runs no query.
+
+        :return:
+         (database, versions) (None if the index is not loaded)
+        """
+        index = self.__index
+
+        return index[:2] if index is not None else None
+
+    def invalidate(self):
+        """
+        Drop the index, so that the next lookup loads it again
+        """
+        with self.__lock:
+            self.__index = None
+
+    def __current(self) -> tuple:
+        index = self.__index
+        database = app.config['SQLALCHEMY_DATABASE_URI']
+        if index is not None and index[0] == database and timer.monotonic() < self.__checked_at + self.__check_seconds:
+            return index
+
+        rows = dict(db.session.query(TableVersion.table_name, TableVersion.version)
+                    .filter(TableVersion.table_name.in_(self.TABLES)).all())
+        versions = tuple(rows.get(table, 0) for table in self.TABLES)
+        if index is None or index[:2] != (database, versions):
+            index = self.__load(database, versions)
+        with self.__lock:
+            self.__index = index
+            self.__checked_at = timer.monotonic()
+
+        return index
+
+    @staticmethod
+    def __load(database: str, versions: tuple) -> tuple:
+        # The versions are read first, so rows changed after them are loaded again by the next check
+        # Staff registered without a doctor row are not doctors that patients can be registered to
+        table = HealthcareProfessional.__table__
+        doctor = Doctor.__table__
+        records = [StaffRecord(*row) for row in db.session.execute(
+            select(table.c.id, table.c.name, table.c.employee_num, table.c.employee_type, doctor.c.id.isnot(None))
+            .select_from(table.outerjoin(doctor, doctor.c.id == table.c.id)))]
+
+        return (database, versions, {record.id: record for record in records},
+                {record.name: record for record in records}, {record.employee_num: record for record in records})
+
+
+def get_roster() -> Roster:
+    """
+    Get the staff roster of the application, creating it by configuration on first use
+    """
+    if 'roster' not in app.extensions:
+        app.extensions['roster'] = Roster(app.config['ROSTER_VERSION_CHECK_SECONDS'])
+
+    return app.extensions['roster']
+
+
+def _mark_roster_changed(mapper, connection, target):
+    # Drop now and again after commit, so that nothing read before the commit stays in the roster
+    get_roster().invalidate()
+    session = inspect(target).session
+    if session is not None:
+        session.info['roster_changed'] = True
+
+
+def _drop_roster(session):
+    if session.info.pop('roster_changed', False):
+        get_roster().invalidate()
+
+
+for name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(HealthcareProfessional, name, _mark_roster_changed, propagate=True)
+event.listen(db.session, 'after_commit', _drop_roster)
+event.listen(db.session, 'after_rollback', _drop_roster)
 
 
 class Receptionist(object):
@@ -384,15 +1379,15 @@ class Receptionist(object):
         self.__employee_num = employee_num
         self.__scheduler = AppointmentSchedule()
 
-    def find_staff(self, name) -> HealthcareProfessional:
+    def find_staff(self, name) -> StaffRecord:
         """
-        Find doctor by the name.
+        Find doctor by the name in the roster, without a query
         :param name:
 
         :return:
-         staff: HealthcareProfessional
+         staff: StaffRecord
         """
-        staff = HealthcareProfessional.query.filter_by(name=name).first()
+        staff = get_roster().by_name(name)
 
         return staff
 
@@ -408,6 +1403,28 @@ class Receptionist(object):
 
         return patient
 
+    def find_staff_by_names(self, names: list[str]) -> dict:
+        """
+        Find staff by their names in the roster, without a query
+
+        :param names:
+        :return:
+         staff: dict of StaffRecord keyed by name. Names that are not found are not in it.
+        """
+        return get_roster().by_names(names)
+
+    def find_patients_by_names(self, names: list[str]) -> dict:
+        """
+        Find patients by their names with one query
+
+        :param names:
+        :return:
+         patients: dict of Patient keyed by name. Names that are not found are not in it.
+        """
+        patients = Patient.query.filter(Patient.name.in_(set(names))).all()
+
+        return {patient.name: patient for patient in patients}
+
     def add_patient(self, name, address, phone) -> Patient:
         """
         Add a new patient into database.
@@ -427,16 +1444,49 @@ class Receptionist(object):
                          appointment_date: datetime) -> Appointment:
         """
         Make a new appointment by using AppointmentSchedule.
+        SlotUnavailableError is raised if the staff already has an appointment at the date.
         :param appointment_type:
         :param staff:
         :param patient:
         """
         appointment = Appointment(type=appointment_type, staff_id=staff.id, patient_id=patient.id, \
                                   created_by=self.__name, date=appointment_date)
-        self.__scheduler.add_appointment(appointment)
+        # The change is logged in the same transaction, so that boards see exactly the committed appointments
+        with UnitOfWork():
+            self.__scheduler.add_appointment(appointment)
+            AppointmentChange.of('created', appointment, staff=staff, patient=patient).persist()
 
         return appointment
 
+    def make_appointments(self, bookings: list[tuple]) -> tuple[list[Appointment], list[BookingConflict]]:
+        """
+        Make several appointments at once by using AppointmentSchedule, such as a recurring appointment
+        Slots are checked by one query and the appointments that can be booked are made in one transaction.
+        The others are not made and reported as conflicts.
+        SlotUnavailableError is raised if one of the slots is booked by someone else at the same time.
+
+        :param bookings: list of (appointment type, staff, patient, appointment date)
+        :return:
+         appointments: list of Appointment made
+         conflicts: list of BookingConflict in the order of bookings
+        """
+        appointments = [Appointment(type=appointment_type, staff_id=staff.id, patient_id=patient.id,
+                                    created_by=self.__name, date=appointment_date)
+                        for appointment_type, staff, patient, appointment_date in bookings]
+        # Changes are logged in the same transaction, so that boards see exactly the committed appointments
+        with UnitOfWork():
+            added, rejected = self.__scheduler.add_appointments(appointments)
+            booked = {id(appointment) for appointment in added}
+            db.session.add_all([AppointmentChange.of('created', appointment, staff=staff, patient=patient)
+                                for appointment, (_, staff, patient, _) in zip(appointments, bookings)
+                                if id(appointment) in booked])
+            commit_or_flush()
+
+        conflicts = [BookingConflict(index, bookings[index][3], reason, staff=bookings[index][1], patient=bookings[index][2])
+                     for index, reason in rejected]
+
+        return added, conflicts
+
     def cancel_appointment(self, appointment_id: int):
         """
         Cancel the specified appointment by using AppointmentSchedule.
@@ -444,24 +1494,40 @@ class Receptionist(object):
         :param appointment:
         """
         appointment = Appointment.query.filter_by(id=appointment_id).first()
-        self.__scheduler.cancel_appointment(appointment)
+        with UnitOfWork():
+            AppointmentChange.of('cancelled', appointment, staff=appointment.healthcare_pro, patient=appointment.patient).persist()
+            self.__scheduler.cancel_appointment(appointment)
 
-    def find_next_available(self) -> datetime:
+    def find_next_available(self, staff: HealthcareProfessional = None) -> datetime:
         """
         Find next available date
 
+        :param staff: find the next date free for this staff. Dates free for any staff are found if it is not specified.
         :return:
          next available date
         """
-        return self.__scheduler.find_next_available()
+        return self.__scheduler.find_next_available(staff_id=staff.id if staff else None)
+
+    def soonest_options(self, n: int, staff: HealthcareProfessional = None, staff_type: str = None) -> list[tuple]:
+        """
+        Find the n soonest slots with a staff who can be booked in each
+
+        :param n: number of options
+        :param staff: search only this staff if it is specified
+        :param staff_type: doctor or nurse. Every staff is searched if it is not specified.
+        :return:
+         options: list of (slot: datetime, staff id, staff name)
+        """
+        return self.__scheduler.soonest(n, staff_id=staff.id if staff else None, staff_type=staff_type)
 
-    def check_available_date(self, date: datetime) -> bool:
+    def check_available_date(self, date: datetime, staff: HealthcareProfessional = None) -> bool:
         """
         Check if input date is available for the appointment
 
         :param date:
+        :param staff: check the date of this staff. The date is available if any staff is free if it is not specified.
         :return:
          True:available
          False:unavailable
         """
-        return self.__scheduler.is_date_available(date=date)
\ No newline at end of file
+        return self.__scheduler.is_date_available(date=date, staff_id=staff.id if staff else None)
\ No newline at end of file
@@ -0,0 +1,204 @@
+import base64
+import binascii
+import json
+from datetime import datetime, date, time, timedelta
+from flask import current_app, request, url_for
+from sqlalchemy import and_, or_
+from surgery import app
+
+"""
+This script defines keyset(cursor) pagination used in list screens
+A page is read by a range query on (sort column, id) from the cursor,
+so the cost of a page does not depend on how many rows are before it.
+"""
+
+
+class Cursor(object):
+    """
+    Class that represents the position of a page in a sorted list
+    It is passed to screens as an opaque url-safe string.
+    """
+    def __init__(self, sort: str, value, id: int, backward: bool = False):
+        self.sort = sort
+        self.value = value
+        self.id = id
+        # True when the cursor points to the previous page
+        self.backward = backward
+
+    def encode(self) -> str:
+        """
+        Encode the cursor into an url-safe string
+
+        :return:
+         cursor: str
+        """
+        value = {'dt': self.value.isoformat()} if isinstance(self.value, datetime) else self.value
+        payload = json.dumps([self.sort, value, self.id, int(self.backward)], separators=(',', ':'))
+
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    @classmethod
+    def decode(cls, text: str):
+        """
+        Decode an url-safe string into a cursor
+
+        :param text:
+        :return:
+         cursor: Cursor (None if the string is broken)
+        """
+        try:
+            payload = base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+            sort, value, id, backward = json.loads(payload)
+            if isinstance(value, dict):
+                value = datetime.fromisoformat(value['dt'])
+            return cls(sort=sort, value=value, id=int(id), backward=bool(backward))
+        except (binascii.Error, ValueError, TypeError, KeyError):
+            return None
+
+
+class KeysetPage(object):
+    """
+    Class that represents a page of a list screen
+    """
+    def __init__(self, items: list, sort: str, page_size: int, next_cursor: str = None, prev_cursor: str = None):
+        self.items = items
+        self.sort = sort
+        self.page_size = page_size
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def page_size_from(args) -> int:
+    """
+    Get the page size from request arguments
+    Only sizes listed in configuration are allowed.
+
+    :param args:
+    :return:
+     page_size: int
+    """
+    page_size = args.get('page_size', type=int)
+    if page_size not in current_app.config['LIST_PAGE_SIZES']:
+        page_size = current_app.config['LIST_PAGE_SIZE']
+
+    return page_size
+
+
+def date_from_arg(args, name: str) -> date:
+    """
+    Get a date(YYYY-MM-DD) from request arguments
+
+    :param args:
+    :param name:
+    :return:
+     date: date (None if it is not set or broken)
+    """
+    try:
+        return date.fromisoformat(args.get(name, ''))
+    except ValueError:
+        return None
+
+
+def filter_date_range(query, column, args):
+    """
+    Filter a query by date_from and date_to in request arguments
+    Both ends are inclusive days.
+
+    :param query:
+    :param column:
+    :param args:
+    :return:
+     query
+    """
+    date_from = date_from_arg(args, 'date_from')
+    date_to = date_from_arg(args, 'date_to')
+    if date_from:
+        query = query.filter(column >= datetime.combine(date_from, time()))
+    if date_to:
+        query = query.filter(column < datetime.combine(date_to + timedelta(days=1), time()))
+
+    return query
+
+
+def paginate(query, id_column, sort_columns: dict, args, default_sort: str = 'id') -> KeysetPage:
+    """
+    Read a page of the query by keyset pagination
+
+    :param query: query with filters applied
+    :param id_column: unique column used to break ties
+    :param sort_columns: sortable columns keyed by the name used in request arguments
+    :param args: request arguments (sort, cursor, page_size)
+    :param default_sort: sort used when it is not specified. '-' prefix means descending.
+    :return:
+     page: KeysetPage
+    """
+    sort = args.get('sort', default_sort)
+    if sort.lstrip('-') not in sort_columns:
+        sort = default_sort
+    descending = sort.startswith('-')
+    column = sort_columns[sort.lstrip('-')]
+    page_size = page_size_from(args)
+
+    # A cursor made for another sort order cannot be used
+    cursor = Cursor.decode(args.get('cursor', ''))
+    if cursor is not None and cursor.sort != sort:
+        cursor = None
+    backward = cursor is not None and cursor.backward
+
+    # Reading the previous page is reading the list in reverse order from the cursor
+    reverse = descending != backward
+    if cursor is not None:
+        if column is id_column:
+            query = query.filter(id_column < cursor.id if reverse else id_column > cursor.id)
+        # The bound on the column alone lets the database start reading the index at the cursor,
+        # which it cannot do for the OR that breaks ties by id
+        elif reverse:
+            query = query.filter(column <= cursor.value, or_(column < cursor.value, id_column < cursor.id))
+        else:
+            query = query.filter(column >= cursor.value, or_(column > cursor.value, id_column > cursor.id))
+    order = [column.desc(), id_column.desc()] if reverse else [column.asc(), id_column.asc()]
+    if column is id_column:
+        order = order[:1]
+
+    # One more row is read to know if there is a following page
+    items = query.order_by(*order).limit(page_size + 1).all()
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    if backward:
+        items.reverse()
+
+    def cursor_of(item, backward: bool) -> str:
+        return Cursor(sort=sort, value=getattr(item, column.key), id=getattr(item, id_column.key),
+                      backward=backward).encode()
+
+    next_cursor = prev_cursor = None
+    if items:
+        if has_more or backward:
+            next_cursor = cursor_of(items[-1], backward=False)
+        if (has_more and backward) or (cursor is not None and not backward):
+            prev_cursor = cursor_of(items[0], backward=True)
+
+    return KeysetPage(items=items, sort=sort, page_size=page_size, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+@app.template_global()
+def page_url(**changes) -> str:
+    """
+    Build the url of the current list screen with request arguments changed
+    This is used by templates for pagination, sort and page size links.
+
+    :param changes: request arguments to change. None removes the argument.
+    :return:
+     url: str
+    """
+    args = request.args.to_dict()
+    args.update(changes)
+    args = {key: value for key, value in args.items() if value not in (None, '')}
+
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
@@ -0,0 +1,92 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+from surgery import app
+
+"""
+This script defines hashing and verification of passwords
+Hashes are made by PASSWORD_HASH_METHOD in configuration, and a hash made by another method is replaced
+when the user signs in, since only then the password is known.
+Hashing runs in a pool of PASSWORD_HASH_WORKERS threads. PBKDF2 of hashlib releases the GIL while it runs,
+so a burst of sign-ins uses at most that many cores and other requests keep being served.
+At most PASSWORD_HASH_PLACES passwords are hashed or waiting for the pool in a process.
+A sign-in waits up to PASSWORD_HASH_WAIT_SECONDS for a place and is then refused, so a burst of sign-ins does not hold
+request threads for long. A new hash waits until a place is free, since it is made for a password already checked.
+"""
+
+
+class PasswordHasherBusyError(Exception):
+    """
+    Error raised when too many passwords are being hashed or waiting
+    """
+    def __init__(self):
+        super().__init__('Too many users are signing in. Please try again in a moment.')
+
+
+class PasswordHasher(object):
+    """
+    Bounded pool of threads that hash passwords
+    """
+    def __init__(self, workers: int, places: int):
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        # Places for passwords being hashed or waiting
+        self.__places = threading.BoundedSemaphore(max(workers, places))
+
+    def run(self, function, *args, timeout: float = None):
+        """
+        Run a function in the pool and wait for the result
+        PasswordHasherBusyError is raised if no place is free within the timeout.
+
+        :param function:
+        :param args: arguments of the function
+        :param timeout: seconds to wait for a place (wait until a place is free if it is None)
+        :return:
+         result of the function
+        """
+        if not self.__places.acquire(timeout=timeout):
+            raise PasswordHasherBusyError()
+        try:
+            future = self.__executor.submit(function, *args)
+        except BaseException:
+            self.__places.release()
+            raise
+        future.add_done_callback(lambda _: self.__places.release())
+
+        return future.result()
+
+
+def get_hasher() -> PasswordHasher:
+    """
+    Get the password hasher of the application, creating it by configuration on first use
+    """
+    if 'password_hasher' not in app.extensions:
+        app.extensions['password_hasher'] = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'],
+                                                           app.config['PASSWORD_HASH_PLACES'])
+
+    return app.extensions['password_hasher']
+
+
+def hash_password(password: str) -> str:
+    """
+    Make a hash of the password by PASSWORD_HASH_METHOD
+    """
+    return get_hasher().run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    """
+    Check if the password matches the hash
+    """
+    return get_hasher().run(check_password_hash, password_hash, password,
+                            timeout=app.config['PASSWORD_HASH_WAIT_SECONDS'])
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """
+    Check if the hash is made by a method or cost other than PASSWORD_HASH_METHOD
+
+    :return:
+     True if the hash should be made again
+    """
+    # Hashes are "method$salt$hash", and the method of pbkdf2 has the number of iterations
+    return password_hash.split('$', 1)[0] != app.config['PASSWORD_HASH_METHOD']
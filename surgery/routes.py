@@ -1,9 +1,17 @@
 from datetime import datetime, date, timedelta
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, request
 from flask_login import current_user, login_user, logout_user, login_required
-from surgery import app
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from surgery import app, db
 from surgery.forms import LoginForm, AppointmentForm, PrescriptionForm, PatientForm, HealthcareProfessionalForm
-from surgery.models import User, AppointmentSchedule, Receptionist, HealthcareProfessional, Doctor, Patient, Prescription
+from surgery.models import User, Receptionist, HealthcareProfessional, Doctor, Patient, Prescription, \
+    Appointment, AppointmentArchive, PrescriptionArchive, AppointmentSchedule, UnitOfWork, SlotUnavailableError, \
+    PatientQuotaError, PATIENT_QUOTA, APPOINTMENT_HOURS, get_roster
+from surgery.pagination import KeysetPage, paginate, filter_date_range
+from surgery.auth import current_identity, doctor_required
+from surgery.cache import cached_fragment
+from surgery.passwords import PasswordHasherBusyError
 
 
 """
@@ -11,6 +19,124 @@ This scripts defines Controller classes
 """
 
 
+def filter_by_name(query, column, model, name: str):
+    """
+    Filter a query by the name of the related staff or patient
+    The name is looked up by its index and the query is filtered by the foreign key.
+
+    :param query:
+    :param column: foreign key column of the query
+    :param model: HealthcareProfessional or Patient
+    :param name:
+    :return:
+     query
+    """
+    if not name:
+        return query
+
+    return query.filter(column.in_(db.session.query(model.id).filter(model.name == name)))
+
+
+def appointment_page(args) -> KeysetPage:
+    """
+    Get a page of appointments, or of archived appointments if history is given
+    Filters(date_from, date_to, staff, patient, type), sort, cursor and history are given by request arguments
+
+    :param args: request arguments
+    :return:
+     appointments: KeysetPage
+    """
+    model = AppointmentArchive if args.get('history') else Appointment
+    # Staff and patient shown in each row are loaded by the same query
+    query = model.query.options(joinedload(model.healthcare_pro), joinedload(model.patient))
+    query = filter_date_range(query, model.date, args)
+    query = filter_by_name(query, model.staff_id, HealthcareProfessional, args.get('staff'))
+    query = filter_by_name(query, model.patient_id, Patient, args.get('patient'))
+    if args.get('type'):
+        query = query.filter(model.type == args['type'])
+
+    return paginate(query, model.id, {'id': model.id, 'type': model.type, 'date': model.date,
+                                      'created_at': model.created_at}, args, default_sort='date')
+
+
+def prescription_page(args) -> KeysetPage:
+    """
+    Get a page of prescriptions, or of archived prescriptions if history is given
+    Filters(date_from, date_to, staff, patient, type), sort, cursor and history are given by request arguments
+
+    :param args: request arguments
+    :return:
+     prescriptions: KeysetPage
+    """
+    model = PrescriptionArchive if args.get('history') else Prescription
+    # Doctor and patient shown in each row are loaded by the same query
+    query = model.query.options(joinedload(model.doctor), joinedload(model.patient))
+    query = filter_date_range(query, model.created_at, args)
+    query = filter_by_name(query, model.doctor_id, HealthcareProfessional, args.get('staff'))
+    query = filter_by_name(query, model.patient_id, Patient, args.get('patient'))
+    if args.get('type'):
+        query = query.filter(model.type == args['type'])
+
+    return paginate(query, model.id, {'id': model.id, 'type': model.type, 'quantity': model.quantity,
+                                      'created_at': model.created_at}, args)
+
+
+def patient_page(args) -> KeysetPage:
+    """
+    Get a page of patients
+    Filters(date_from, date_to, staff, patient), sort and cursor are given by request arguments
+
+    :param args: request arguments
+    :return:
+     patients: KeysetPage
+    """
+    # Primary doctor shown in each row is loaded by the same query
+    query = Patient.query.options(joinedload(Patient.doctor))
+    query = filter_date_range(query, Patient.created_at, args)
+    query = filter_by_name(query, Patient.doctor_id, HealthcareProfessional, args.get('staff'))
+    if args.get('patient'):
+        query = query.filter(Patient.name == args['patient'])
+
+    return paginate(query, Patient.id, {'id': Patient.id, 'name': Patient.name, 'created_at': Patient.created_at}, args)
+
+
+def healthcare_pro_page(args) -> KeysetPage:
+    """
+    Get a page of healthcare professionals
+    Filters(date_from, date_to, staff, type), sort and cursor are given by request arguments
+
+    :param args: request arguments
+    :return:
+     healthcare_pros: KeysetPage
+    """
+    query = filter_date_range(HealthcareProfessional.query, HealthcareProfessional.created_at, args)
+    if args.get('staff'):
+        query = query.filter(HealthcareProfessional.name == args['staff'])
+    if args.get('type'):
+        query = query.filter(HealthcareProfessional.employee_type == args['type'])
+
+    return paginate(query, HealthcareProfessional.id, {'id': HealthcareProfessional.id, 'name': HealthcareProfessional.name,
+                                                       'employee_num': HealthcareProfessional.employee_num,
+                                                       'created_at': HealthcareProfessional.created_at}, args)
+
+
+def doctor_page(args) -> KeysetPage:
+    """
+    Get a page of doctors with their stored numbers of patients
+    Filters(staff), sort and cursor are given by request arguments
+
+    :param args: request arguments
+    :return:
+     doctors: KeysetPage
+    """
+    query = Doctor.query
+    if args.get('staff'):
+        query = query.filter(Doctor.name == args['staff'])
+
+    return paginate(query, Doctor.id, {'id': Doctor.id, 'name': Doctor.name, 'employee_num': Doctor.employee_num,
+                                       'patient_count': Doctor.patient_count}, args)
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """
@@ -24,10 +150,15 @@ def login():
         # Get user data from DB
         user = User.query.filter_by(username=form.username.data).first()
         # Check if input password matches
-        if user is None or not user.check_password(form.password.data):
-            flash('Invalid username or password')
-            print('Login Failure')
-            return redirect(url_for('login'))
+        try:
+            if user is None or not user.check_password(form.password.data):
+                flash('Invalid username or password')
+                print('Login Failure')
+                return redirect(url_for('login'))
+            user.rehash_password(form.password.data)
+        except PasswordHasherBusyError as e:
+            flash(str(e))
+            return render_template('login.html', title='Sign In', form=form), 503
         login_user(user, remember=form.remember_me.data)
         print('Redirect Index')
         return redirect(url_for('index'))
@@ -60,13 +191,61 @@ def index():
 def reception():
     """
     Controller for Reception page
-    Get all appointments from a database and send it to a template
+    Get a page of appointments from a database and send it to a template
+    Filters(date_from, date_to, staff, patient, type), sort, cursor and history are given by request arguments
     """
-    # AppointmentSchedule manages all appointments in a database
-    scheduler = AppointmentSchedule()
+    # The live board receives changes made after the table is rendered
+    tables = ('appointment', 'appointment_archive', 'healthcare_pro', 'patient')
+    table = cached_fragment('reception', tables, lambda: render_template(
+        '_reception_table.html', appointments=appointment_page(request.args), rendered_at=datetime.utcnow().isoformat()))
 
-    # scheduler.appointments is getter to retrieve all appointments
-    return render_template('reception.html', title='Reception', appointments=scheduler.appointments)
+    return render_template('reception.html', title='Reception', table=table)
+
+
+def calendar_range(view: str, day: date) -> tuple[date, date, date, date]:
+    """
+    Get the range of days shown by the calendar and the days shown by the previous and next links
+
+    :param view: week or month
+    :param day: a day in the range
+    :return:
+     first_day: Monday of the week, or the first day of the month
+     last_day:
+     previous_day: first day of the previous range
+     next_day: first day of the next range
+    """
+    if view == 'month':
+        first_day = day.replace(day=1)
+        next_day = (first_day + timedelta(days=31)).replace(day=1)
+        return first_day, next_day - timedelta(days=1), (first_day - timedelta(days=1)).replace(day=1), next_day
+
+    first_day = day - timedelta(days=day.weekday())
+    return first_day, first_day + timedelta(days=6), first_day - timedelta(days=7), first_day + timedelta(days=7)
+
+
+@app.route('/calendar')
+@login_required
+def calendar():
+    """
+    Controller for Calendar page
+    Booked and free slots of each staff in a week or a month are read by one grouped query
+    The view(week, month), a day in the range(date) and filters(type, staff) are given by request arguments
+    """
+    view = 'month' if request.args.get('view') == 'month' else 'week'
+    try:
+        day = date.fromisoformat(request.args.get('date', ''))
+    except ValueError:
+        day = date.today()
+    first_day, last_day, previous_day, next_day = calendar_range(view, day)
+
+    # The default range moves with today, so it is a part of the key
+    table = cached_fragment(f'calendar-{date.today().isoformat()}', ('appointment', 'healthcare_pro'), lambda: render_template(
+        '_calendar_table.html', view=view, hours=APPOINTMENT_HOURS, first_slot=AppointmentSchedule.first_slot(),
+        occupancy=AppointmentSchedule.occupancy(first_day, last_day, staff_type=request.args.get('type'),
+                                                staff_name=request.args.get('staff'))))
+
+    return render_template('calendar.html', title='Calendar', table=table, view=view, first_day=first_day,
+                           last_day=last_day, previous_day=previous_day, next_day=next_day)
 
 
 @app.route('/make_appointment', methods=['GET', 'POST'])
@@ -77,12 +256,11 @@ def make_appointment():
     """
     # Create form class
     form = AppointmentForm()
-    # Get User instance for creating receptionist
-    user = User.query.filter_by(username=current_user.username).first()
-    # Create Receptionist instance
-    receptionist = Receptionist(name=user.username, employee_num=user.employee_num)
-    # Get next available date
-    next_available_date = receptionist.find_next_available()
+    # Create Receptionist instance from the signed in user
+    receptionist = Receptionist(name=current_user.username, employee_num=current_user.employee_num)
+    # Get the soonest slots free for any staff, and the next available date
+    options = receptionist.soonest_options(app.config['APPOINTMENT_OPTIONS'])
+    next_available_date = options[0][0] if options else None
 
     # When submitting form data with POST method, the logic to make appointment runs
     # In other cases, render a template for an initial display
@@ -103,39 +281,60 @@ def make_appointment():
         print(f'Appointment type:{appointment_type}')
         print(f'Doctor:{staff_name} Patient:{patient_name}')
         print(f'date:{appointment_date}')
+        occurrences = form.occurrences.data or 1
+        interval = timedelta(**{form.repeat_unit.data: form.repeat_every.data or 1})
 
         # Validation
         # Check if the appointment date is available
         if appointment_date.date() < date.today() + timedelta(days=1):
             flash(f'Please select any day after tommorow. Next available date is {next_available_date}')
-            return render_template('make_appointment.html', title='Make Appointment', form=form, next_available_date=next_available_date)
+            return render_template('make_appointment.html', title='Make Appointment', form=form, next_available_date=next_available_date, options=options)
 
-        # Check if the appointment date is available
-        if not receptionist.check_available_date(date=appointment_date):
-            flash(f'{appointment_date} is not available. Next available date is {next_available_date}')
-            return render_template('make_appointment.html', title='Make Appointment', form=form, next_available_date=next_available_date)
+        if occurrences > app.config['APPOINTMENT_MAX_OCCURRENCES']:
+            flash(f"Occurrences must be {app.config['APPOINTMENT_MAX_OCCURRENCES']} or less.")
+            return render_template('make_appointment.html', title='Make Appointment', form=form, next_available_date=next_available_date, options=options)
 
         # Find doctor from database and create instance
         staff = receptionist.find_staff(name=staff_name)
         if staff is None:
             # If doctor is not found, return error message.
             flash('Cannot find the doctor. Please Confirm the name.')
-            return render_template('make_appointment.html', title='Make Appointment', form=form, next_available_date=next_available_date)
-
-        # Find patient from database and create instance
-        patient = receptionist.find_patient(name=patient_name)
-        if patient is None:
-            # If patient is not found, insert a new record into database as a new patient
-            patient = receptionist.add_patient(name=patient_name, address=patient_address, phone=patient_phone)
-
-        # Make an appointment
-        # Inserting a record into a database is performed
-        receptionist.make_appointment(appointment_type=appointment_type, staff=staff, patient=patient, appointment_date=appointment_date)
-
-        flash('Succeeded making appointment.')
+            return render_template('make_appointment.html', title='Make Appointment', form=form, next_available_date=next_available_date, options=options)
+
+        # Adding a new patient and making an appointment are committed together
+        # The slot is reserved by the insert itself, and a taken slot is reported with the next free slot of the staff
+        try:
+            with UnitOfWork():
+                # Find patient from database and create instance
+                patient = receptionist.find_patient(name=patient_name)
+                if patient is None:
+                    # If patient is not found, insert a new record into database as a new patient
+                    patient = receptionist.add_patient(name=patient_name, address=patient_address, phone=patient_phone)
+
+                # Make an appointment
+                # Inserting a record into a database is performed
+                if occurrences == 1:
+                    receptionist.make_appointment(appointment_type=appointment_type, staff=staff, patient=patient, appointment_date=appointment_date)
+                    booked, conflicts = 1, []
+                else:
+                    # Occurrences are checked by one query and made together, and taken slots are reported
+                    dates = AppointmentSchedule.recurring_dates(appointment_date, interval, occurrences)
+                    appointments, conflicts = receptionist.make_appointments(
+                        [(appointment_type, staff, patient, occurrence) for occurrence in dates])
+                    booked = len(appointments)
+        except SlotUnavailableError as e:
+            flash(str(e))
+            return render_template('make_appointment.html', title='Make Appointment', form=form, next_available_date=e.next_available_date, options=options)
+
+        for conflict in conflicts:
+            flash(str(conflict))
+        if not booked:
+            return render_template('make_appointment.html', title='Make Appointment', form=form, next_available_date=next_available_date, options=options)
+
+        flash('Succeeded making appointment.' if occurrences == 1 else f'Succeeded making {booked} of {occurrences} appointments.')
         return redirect(url_for('reception'))
 
-    return render_template('make_appointment.html', title='Make Appointment', form=form, next_available_date=next_available_date)
+    return render_template('make_appointment.html', title='Make Appointment', form=form, next_available_date=next_available_date, options=options)
 
 
 @app.route('/cancel_appointment/<int:appointment_id>', methods=['GET', 'POST'])
@@ -147,10 +346,8 @@ def cancel_appointment(appointment_id):
 
     :param appointment_id:
     """
-    # Get User instance for creating receptionist
-    user = User.query.filter_by(username=current_user.username).first()
-    # Create Receptionist instance
-    receptionist = Receptionist(name=user.username, employee_num=user.employee_num)
+    # Create Receptionist instance from the signed in user
+    receptionist = Receptionist(name=current_user.username, employee_num=current_user.employee_num)
 
     # Cancel appointment
     # Deleting a record from a database is performed
@@ -162,35 +359,29 @@ def cancel_appointment(appointment_id):
 
 @app.route('/prescription', methods=['GET', 'POST'])
 @login_required
+@doctor_required()
 def prescription():
     """
     Controller for Prescription page
-    Get all prescriptions from a database and send it to a template
+    Get a page of prescriptions from a database and send it to a template
+    Filters(date_from, date_to, staff, patient, type), sort, cursor and history are given by request arguments
     """
-    # Authorization
-    # Only doctor user is allowed to perform this operation.
-    doctor = Doctor.query.filter_by(employee_num=current_user.employee_num).first()
-    if doctor is None:
-        flash(f'You are not authorized to perform this operation.')
-        return redirect(url_for('index'))
+    tables = ('prescription', 'prescription_archive', 'healthcare_pro', 'patient')
+    table = cached_fragment('prescription', tables, lambda: render_template(
+        '_prescription_table.html', prescriptions=prescription_page(request.args)))
 
-    prescriptions = Prescription.query.all()
-
-    return render_template('prescription.html', title='Prescription', prescriptions=prescriptions)
+    return render_template('prescription.html', title='Prescription', table=table)
 
 
 @app.route('/issue_prescription', methods=['GET', 'POST'])
 @login_required
+@doctor_required(redirect_to='prescription')
 def issue_prescription():
     """
     Controller for Issuing Prescription page
     """
-    # Authorization
-    # Only doctor user is allowed to perform this operation.
-    doctor = Doctor.query.filter_by(employee_num=current_user.employee_num).first()
-    if doctor is None:
-        flash(f'You are not authorized to perform this operation.')
-        return redirect(url_for('prescription'))
+    # Doctor instance of the signed in user, authorized by doctor_required
+    doctor = current_identity().doctor
 
     # Create form class
     form = PrescriptionForm()
@@ -227,6 +418,7 @@ def issue_prescription():
 
 @app.route('/cancel_prescription/<int:prescription_id>', methods=['GET', 'POST'])
 @login_required
+@doctor_required(redirect_to='prescription')
 def cancel_prescription(prescription_id):
     """
     Controller for canceling a prescription
@@ -234,12 +426,8 @@ def cancel_prescription(prescription_id):
 
     :param prescription_id:
     """
-    # Authorization
-    # Only doctor user is allowed to perform this operation.
-    doctor = Doctor.query.filter_by(employee_num=current_user.employee_num).first()
-    if doctor is None:
-        flash(f'You are not authorized to perform this operation.')
-        return redirect(url_for('prescription'))
+    # Doctor instance of the signed in user, authorized by doctor_required
+    doctor = current_identity().doctor
 
     # Cancel appointment
     # Deleting a record from a database is performed
@@ -251,36 +439,26 @@ def cancel_prescription(prescription_id):
 
 @app.route('/patient', methods=['GET', 'POST'])
 @login_required
+@doctor_required()
 def patient():
     """
-    Controller for Reception page
-    Get all patients from a database and send it to a template
+    Controller for Patient page
+    Get a page of patients from a database and send it to a template
+    Filters(date_from, date_to, staff, patient), sort and cursor are given by request arguments
     """
-    # Authorization
-    # Only doctor user is allowed to perform this operation.
-    doctor = Doctor.query.filter_by(employee_num=current_user.employee_num).first()
-    if doctor is None:
-        flash(f'You are not authorized to perform this operation.')
-        return redirect(url_for('index'))
+    table = cached_fragment('patient', ('patient', 'healthcare_pro'), lambda: render_template(
+        '_patient_table.html', patients=patient_page(request.args)))
 
-    patients = Patient.query.all()
-
-    return render_template('patient.html', title='Manage Patient', patients=patients)
+    return render_template('patient.html', title='Manage Patient', table=table)
 
 
 @app.route('/register_patient', methods=['GET', 'POST'])
 @login_required
+@doctor_required()
 def register_patient():
     """
     Controller for Registering Patient page
     """
-    # Authorization
-    # Only doctor user is allowed to perform this operation.
-    doctor = Doctor.query.filter_by(employee_num=current_user.employee_num).first()
-    if doctor is None:
-        flash(f'You are not authorized to perform this operation.')
-        return redirect(url_for('index'))
-
     # Create form class
     form = PatientForm()
 
@@ -302,23 +480,28 @@ def register_patient():
             flash(f'This name:{name} is already registered. Please confirm name or add any identifier to the name ')
             return render_template('register_patient.html', title='Register Patient', form=form)
 
-        # Find doctor from database
-        doctor = Doctor.query.filter_by(name=doctor_name).first()
-        if doctor is None:
+        # Find doctor from the roster
+        # A doctor has no stored count if the doctor row is deleted after the roster is read
+        doctor = get_roster().by_name(doctor_name)
+        count = Doctor.count_patients(doctor.id) if doctor is not None and doctor.is_doctor else None
+        if count is None:
             flash(f'The doctor you entered is not registered.')
             return render_template('register_patient.html', title='Register Patient', form=form)
 
         # Check if the number of registered patients by a doctor
-        # More than 500 is not allowed to be registered
-        count = Patient.query.filter_by(doctor_id=doctor.id).count()
-        print(count)
-        if count >= 500:
-            flash(f'Less than 500 patients can be registered by a doctor.')
+        # More than PATIENT_QUOTA(500) is not allowed to be registered
+        # The stored count is read by the id, and checked again in the transaction that registers the patient
+        if count >= PATIENT_QUOTA:
+            flash(f'Less than {PATIENT_QUOTA} patients can be registered by a doctor.')
             return render_template('register_patient.html', title='Register Patient', form=form)
 
-        # Register patient
+        # Register patient by the signed in doctor, authorized by doctor_required
         # Inserting a record into a database is performed
-        doctor.register_patient(name=name, address=address, phone=phone, doctor_id=doctor.id)
+        try:
+            current_identity().doctor.register_patient(name=name, address=address, phone=phone, doctor_id=doctor.id)
+        except PatientQuotaError as e:
+            flash(str(e))
+            return render_template('register_patient.html', title='Register Patient', form=form)
 
         flash('Succeeded register patient.')
         return redirect(url_for('patient'))
@@ -328,6 +511,7 @@ def register_patient():
 
 @app.route('/delete_patient/<int:patient_id>', methods=['GET', 'POST'])
 @login_required
+@doctor_required(redirect_to='prescription')
 def delete_patient(patient_id):
     """
     Controller for deleting a patient
@@ -335,12 +519,8 @@ def delete_patient(patient_id):
 
     :param patient_id:
     """
-    # Authorization
-    # Only doctor user is allowed to perform this operation.
-    doctor = Doctor.query.filter_by(employee_num=current_user.employee_num).first()
-    if doctor is None:
-        flash(f'You are not authorized to perform this operation.')
-        return redirect(url_for('prescription'))
+    # Doctor instance of the signed in user, authorized by doctor_required
+    doctor = current_identity().doctor
 
     # Deleting a record from a database is performed
     doctor.delete_patient(patient_id=patient_id)
@@ -351,36 +531,26 @@ def delete_patient(patient_id):
 
 @app.route('/healthcare_pro', methods=['GET', 'POST'])
 @login_required
+@doctor_required()
 def healthcare_pro():
     """
     Controller for Healthcare Professional page
-    Get all healthcare professionals from a database and send it to a template
+    Get a page of healthcare professionals from a database and send it to a template
+    Filters(date_from, date_to, staff, type), sort and cursor are given by request arguments
     """
-    # Authorization
-    # Only doctor user is allowed to perform this operation.
-    doctor = Doctor.query.filter_by(employee_num=current_user.employee_num).first()
-    if doctor is None:
-        flash(f'You are not authorized to perform this operation.')
-        return redirect(url_for('index'))
+    table = cached_fragment('healthcare_pro', ('healthcare_pro', ), lambda: render_template(
+        '_healthcare_pro_table.html', healthcare_pros=healthcare_pro_page(request.args)))
 
-    healthcare_pros = HealthcareProfessional.query.all()
-
-    return render_template('healthcare_pro.html', title='Manage Healthcare Professional', healthcare_pros=healthcare_pros)
+    return render_template('healthcare_pro.html', title='Manage Healthcare Professional', table=table)
 
 
 @app.route('/register_healthcare_pro', methods=['GET', 'POST'])
 @login_required
+@doctor_required()
 def register_healthcare_pro():
     """
     Controller for Registering Healthcare Professional page
     """
-    # Authorization
-    # Only doctor user is allowed to perform this operation.
-    doctor = Doctor.query.filter_by(employee_num=current_user.employee_num).first()
-    if doctor is None:
-        flash(f'You are not authorized to perform this operation.')
-        return redirect(url_for('index'))
-
     form = HealthcareProfessionalForm()
 
     # When submitting form data with POST method, the logic to register healthcare professional runs
@@ -394,21 +564,28 @@ def register_healthcare_pro():
         employee_num = form.employee_num.data
 
         # Check if the name is already used
-        healthcare_pro = HealthcareProfessional.query.filter_by(name=name).first()
+        # Staff are looked up in the roster, and the database rejects a name registered in the meantime
+        healthcare_pro = get_roster().by_name(name)
         if healthcare_pro:
             flash(f'This name:{name} is already registered. Please confirm name or add any identifier to the name ')
             return render_template('register_healthcare_pro.html', title='Register Healthcare Professional', form=form)
 
         # Validation
         # Check if the employee number is already used
-        healthcare_pro = HealthcareProfessional.query.filter_by(employee_num=employee_num).first()
+        healthcare_pro = get_roster().by_employee_num(employee_num)
         if healthcare_pro:
             flash(f'This employee number:{employee_num} is already used.')
             return render_template('register_healthcare_pro.html', title='Register Healthcare Professional', form=form)
 
         # Inserting a record into a database is performed
         healthcare_pro = HealthcareProfessional(name=name, employee_type=employee_type, employee_num=employee_num)
-        healthcare_pro.persist()
+        try:
+            healthcare_pro.persist()
+        except IntegrityError:
+            # Another worker registered the name or the employee number after the roster was read
+            db.session.rollback()
+            flash(f'This name:{name} or employee number:{employee_num} is already registered.')
+            return render_template('register_healthcare_pro.html', title='Register Healthcare Professional', form=form)
 
         flash('Succeeded register Healthcare Professional.')
         return redirect(url_for('healthcare_pro'))
@@ -418,6 +595,7 @@ def register_healthcare_pro():
 
 @app.route('/delete_healthcare_pro/<int:healthcare_pro_id>', methods=['GET', 'POST'])
 @login_required
+@doctor_required()
 def delete_healthcare_pro(healthcare_pro_id):
     """
     Controller for deleting a healthcare professional
@@ -425,13 +603,6 @@ def delete_healthcare_pro(healthcare_pro_id):
 
     :param healthcare_pro_id:
     """
-    # Authorization
-    # Only doctor user is allowed to perform this operation.
-    doctor = Doctor.query.filter_by(employee_num=current_user.employee_num).first()
-    if doctor is None:
-        flash(f'You are not authorized to perform this operation.')
-        return redirect(url_for('index'))
-
     # Deleting a record from a database is performed
     healthcare_pro = HealthcareProfessional.query.filter_by(id=healthcare_pro_id).first()
     healthcare_pro.delete()
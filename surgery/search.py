@@ -0,0 +1,215 @@
+import re
+import sqlite_utils
+from flask import request, jsonify
+from flask_login import login_required
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from surgery import app, db
+from surgery.models import Patient, HealthcareProfessional
+
+"""
+This script defines full-text search over patients and staff
+Search indexes are SQLite FTS5 tables with external content, created by sqlite-utils.
+ - patient_fts: name, address and phone of patients
+ - healthcare_pro_fts: names of healthcare professionals
+Triggers on the content tables keep the indexes in sync, so rows written by the ORM and by bulk inserts are searchable.
+The indexes are created with the tables by db.create_all(), or by "python initialize.py search-index" for databases
+made by "flask db upgrade". Migrations do not create them, and autogenerate leaves them out.
+Search answers 503 with the command to run while the indexes are missing.
+"""
+
+# Columns indexed for each table
+SEARCH_COLUMNS = {
+    Patient.__tablename__: ['name', 'address', 'phone'],
+    HealthcareProfessional.__tablename__: ['name'],
+}
+# Accents are ignored, so that "Zoe" finds "Zoë"
+SEARCH_TOKENIZE = 'unicode61 remove_diacritics 2'
+# Tables of search indexes, such as patient_fts and its shadow tables patient_fts_data, patient_fts_idx, ...
+SEARCH_TABLE = re.compile('^(' + '|'.join(SEARCH_COLUMNS) + r')_fts(_\w+)?$')
+
+
+def enable_search_index(dbapi_connection, table: str, replace: bool = False):
+    """
+    Create the search index of the table with its triggers and fill it with existing rows
+
+    :param dbapi_connection: sqlite3 connection
+    :param table: content table
+    :param replace: rebuild the index even if it already exists
+    """
+    database = sqlite_utils.Database(dbapi_connection, recursive_triggers=False)
+    if replace:
+        database[table].disable_fts()
+    database[table].enable_fts(SEARCH_COLUMNS[table], create_triggers=True, tokenize=SEARCH_TOKENIZE, replace=True)
+
+
+def build_search_index(replace: bool = True):
+    """
+    Create or rebuild search indexes of all tables on the database of the application
+    """
+    connection = db.get_engine(app).raw_connection()
+    try:
+        for table in SEARCH_COLUMNS:
+            enable_search_index(connection.connection, table, replace=replace)
+    finally:
+        connection.close()
+
+
+def _create_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        enable_search_index(connection.connection.dbapi_connection, target.name)
+
+
+def _drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text(f'DROP TABLE IF EXISTS [{target.name}_fts]'))
+
+
+for model in (Patient, HealthcareProfessional):
+    event.listen(model.__table__, 'after_create', _create_search_index)
+    event.listen(model.__table__, 'before_drop', _drop_search_index)
+
+
+def include_object(object, name, type_, reflected, compare_to) -> bool:
+    """
+    Tell autogenerate of migrations to leave search indexes alone
+    They are not in the metadata, so autogenerate would otherwise drop them.
+    """
+    return not (type_ == 'table' and reflected and compare_to is None and SEARCH_TABLE.match(name))
+
+
+# Arguments given to the context of migrations by the env.py of Flask-Migrate
+app.extensions['migrate'].configure_args['include_object'] = include_object
+
+
+def has_search_index(table: str) -> bool:
+    """
+    Check if the search index of the table exists on the database
+    """
+    return db.session.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                              {'name': f'{table}_fts'}).first() is not None
+
+
+def search_response(table: str, search):
+    """
+    Answer a search, or 503 with the command to build indexes if the index of the table is missing
+
+    :param table: content table
+    :param search: function() that returns the response
+    :return:
+     response
+    """
+    try:
+        return search()
+    except OperationalError:
+        db.session.rollback()
+        if has_search_index(table):
+            raise
+        return jsonify({'error': 'Search index is not built. Run "python initialize.py search-index".'}), 503
+
+
+def match_expression(query: str) -> str:
+    """
+    Convert a query typed by a user into an FTS5 expression matching every word as a prefix
+    Punctuation is dropped, so that user input cannot be read as FTS5 syntax.
+
+    :param query: such as "dav high"
+    :return:
+     expression: such as '"dav"* "high"*', or None if the query has no words
+    """
+    words = re.findall(r'\w+', query or '')
+    if not words:
+        return None
+
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_patients(query: str, limit: int = None, doctor_id: int = None) -> list[dict]:
+    """
+    Find patients whose name, address or phone start with the words of the query, best matches first
+    Patients of a doctor are returned in the order of the index instead.
+
+    :param query:
+    :param limit: maximum number of patients
+    :param doctor_id: find only patients of this doctor if it is specified
+    :return:
+     patients: list of dict
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return []
+
+    if doctor_id is None:
+        # Only the first SEARCH_CANDIDATES matches are ranked,
+        # so that a short prefix matching most patients does not rank the whole table
+        sql = 'SELECT patient.id, patient.name, patient.address, patient.phone, patient.doctor_id ' \
+              'FROM (SELECT rowid, rank FROM patient_fts WHERE patient_fts MATCH :expression LIMIT :candidates) AS matched ' \
+              'JOIN patient ON patient.id = matched.rowid ORDER BY matched.rank LIMIT :limit'
+    else:
+        # Matches are filtered by the doctor in index order, so that no patient of the doctor is missed
+        sql = 'SELECT patient.id, patient.name, patient.address, patient.phone, patient.doctor_id ' \
+              'FROM patient_fts JOIN patient ON patient.id = patient_fts.rowid ' \
+              'WHERE patient_fts MATCH :expression AND patient.doctor_id = :doctor_id LIMIT :limit'
+    rows = db.session.execute(text(sql), {'expression': expression, 'doctor_id': doctor_id,
+                                          'candidates': app.config['SEARCH_CANDIDATES'],
+                                          'limit': limit or app.config['SEARCH_RESULT_LIMIT']})
+
+    return [dict(row._mapping) for row in rows]
+
+
+def search_staff(query: str, limit: int = None) -> list[dict]:
+    """
+    Find healthcare professionals whose name start with the words of the query, best matches first
+
+    :param query:
+    :param limit: maximum number of staff
+    :return:
+     staff: list of dict
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return []
+
+    rows = db.session.execute(text(
+        'SELECT healthcare_pro.id, healthcare_pro.name, healthcare_pro.employee_num, healthcare_pro.employee_type AS type '
+        'FROM (SELECT rowid, rank FROM healthcare_pro_fts WHERE healthcare_pro_fts MATCH :expression LIMIT :candidates) '
+        'AS matched JOIN healthcare_pro ON healthcare_pro.id = matched.rowid ORDER BY matched.rank LIMIT :limit'),
+        {'expression': expression, 'candidates': app.config['SEARCH_CANDIDATES'],
+         'limit': limit or app.config['SEARCH_RESULT_LIMIT']})
+
+    return [dict(row._mapping) for row in rows]
+
+
+def limit_from(args) -> int:
+    """
+    Get the number of results from request arguments, bounded by SEARCH_MAX_LIMIT
+    """
+    limit = args.get('limit', type=int) or app.config['SEARCH_RESULT_LIMIT']
+
+    return max(1, min(limit, app.config['SEARCH_MAX_LIMIT']))
+
+
+@app.route('/search/patients')
+@login_required
+def search_patients_json():
+    """
+    Controller for typeahead of patients
+    q is matched as prefixes of words in name, address and phone. doctor_id narrows results to patients of a doctor.
+    """
+    query = request.args.get('q', '')
+
+    return search_response(Patient.__tablename__, lambda: jsonify({'query': query, 'results': search_patients(
+        query, limit=limit_from(request.args), doctor_id=request.args.get('doctor_id', type=int))}))
+
+
+@app.route('/search/staff')
+@login_required
+def search_staff_json():
+    """
+    Controller for typeahead of healthcare professionals
+    q is matched as prefixes of words in names.
+    """
+    query = request.args.get('q', '')
+
+    return search_response(HealthcareProfessional.__tablename__, lambda: jsonify(
+        {'query': query, 'results': search_staff(query, limit=limit_from(request.args))}))
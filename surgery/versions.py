@@ -0,0 +1,79 @@
+from datetime import datetime
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.sqlite import insert
+from surgery import db
+from surgery.models import TableVersion
+
+"""
+This script keeps a change counter per table
+The counters of tables changed by a flush are incremented in the same transaction,
+so a reader sees a new version exactly when the change is visible to it.
+Versions are used to answer conditional requests without reading the tables.
+Rows written by bulk statements bypass the session, so the writer calls mark_changed() for their tables.
+"""
+
+
+def mark_changed(*tables: str):
+    """
+    Increment the versions of the tables in the current transaction
+
+    :param tables: table names
+    """
+    if tables:
+        increment(db.session.connection(), tables)
+        db.session.info.setdefault('changed_tables', set()).update(tables)
+
+
+def increment(connection, tables):
+    """
+    Increment the versions of the tables on the connection
+    A table that has not been counted yet is inserted with version 1.
+    """
+    now = datetime.utcnow()
+    statement = insert(TableVersion.__table__)
+    statement = statement.on_conflict_do_update(index_elements=[TableVersion.table_name], set_={
+        'version': TableVersion.__table__.c.version + 1,
+        'updated_at': statement.excluded.updated_at,
+    })
+    connection.execute(statement, [{'table_name': table, 'version': 1, 'updated_at': now} for table in sorted(set(tables))])
+
+
+def table_versions(tables) -> tuple[dict, datetime]:
+    """
+    Read the versions of the tables by one query
+
+    :param tables: table names
+    :return:
+     versions: dict of version keyed by table name. Tables that have never changed are 0.
+     last_modified: datetime when any of the tables is changed last (None if none of them has changed)
+    """
+    rows = db.session.query(TableVersion.table_name, TableVersion.version, TableVersion.updated_at) \
+        .filter(TableVersion.table_name.in_(tables)).all()
+    versions = {table: 0 for table in tables}
+    last_modified = None
+    for table, version, updated_at in rows:
+        versions[table] = version
+        if last_modified is None or updated_at > last_modified:
+            last_modified = updated_at
+
+    return versions, last_modified
+
+
+@event.listens_for(db.session, 'after_flush')
+def _count_changes(session, flush_context):
+    # Objects in dirty may have no changed column, such as one whose collection is only loaded
+    changed = list(session.new) + list(session.deleted) + \
+        [instance for instance in session.dirty if session.is_modified(instance, include_collections=False)]
+    tables = set()
+    for instance in changed:
+        if not isinstance(instance, TableVersion):
+            tables.update(table.name for table in inspect(instance).mapper.tables)
+    if tables:
+        increment(session.connection(), tables)
+        # Tables changed by the transaction, used after commit to invalidate caches
+        session.info.setdefault('changed_tables', set()).update(tables)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('changed_tables', None)
@@ -1,17 +1,1158 @@
-from surgery.models import Patient
-from surgery import db
+import os
+import sys
+import tempfile
+import threading
+import time as timer
+import tracemalloc
+import sqlite_utils
+from datetime import datetime, date, time, timedelta
+from sqlalchemy import event, create_engine
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash, check_password_hash
+from surgery.models import User, Doctor, Nurse, Patient, Appointment, AppointmentArchive, AppointmentChange, \
+    AppointmentSchedule, HealthcareProfessional, Prescription, PrescriptionArchive, PrescriptionRollup, \
+    PrescriptionHistogram, Receptionist, UnitOfWork, AVAILABILITY_WINDOW_DAYS, SlotUnavailableError, PatientQuotaError, \
+    UnregisteredDoctorError, PATIENT_QUOTA, APPOINTMENT_HOURS, get_roster
+from surgery.archive import archive_all
+from surgery.importer import PatientImporter
+from surgery.analytics import rebuild_rollups
+from surgery.versions import increment
+from surgery.board import slots
+from surgery.search import build_search_index
+from surgery.passwords import get_hasher, hash_password
+from surgery.jobs import JOB_FUNCTIONS, RUNNING, SUCCEEDED, FAILED, get_queue, start_runner, submit_job, job_function
+from surgery import app, db
 
 """
-Test scripts to insert 500 records into patient table
+Test scripts for the application
+
+[Usage]
+python test.py
+ ->Insert 500 records into patient table
+python test.py query_budget
+ ->Check that list screens run within their query budgets on a temporary database,
+   and that lists sorted by each sortable column are read from an index
+python test.py concurrent_booking [threads] [slots]
+ ->Book the same slots from parallel threads and check that exactly one booking of each slot succeeds
+python test.py export_memory
+ ->Check that memory used by exports does not grow with the number of rows
+python test.py fragment_cache
+ ->Check that cached list screens run no query, and that changes are shown at once, with each cache backend
+python test.py patient_count
+ ->Check that stored numbers of patients follow registration, reassignment and deletion, and the quota
+python test.py background_jobs
+ ->Check that jobs run within the concurrency bound, report progress, and are retried after errors
+python test.py recurring_booking [occurrences]
+ ->Check that a recurring booking checks its slots by one query, and makes free slots and reports taken ones,
+   and that the API refuses dates with an offset and unknown types
+python test.py archive
+ ->Check that old rows are moved into archive tables in batches and are still listed as history
+python test.py prescription_analytics
+ ->Check that rollups follow issued, cancelled and archived prescriptions, and that reports do not read prescriptions
+python test.py metrics
+ ->Check that failed statements leave nothing on connections, and that /metrics is only answered to allowed addresses
+python test.py identity
+ ->Check that a user deleted by another worker process is signed out after IDENTITY_VERSION_CHECK_SECONDS
+python test.py roster
+ ->Check that staff are looked up without a query, and that changes by this and other processes are found
+python test.py reception_streams
+ ->Check that streams above RECEPTION_MAX_STREAMS end at once, and that closed streams give back their slots
+python test.py availability
+ ->Check that the next available slot of a staff whose day is full rolls to the next day while others are offered,
+   that soonest options are in the order of slots, and that the search window is doubled when it is full
+python test.py import_patients
+ ->Check that patients are imported from CSV and JSONL files, and rows that cannot be imported are reported by line
+python test.py unit_of_work
+ ->Check that a new patient is rolled back with a booking of a taken slot, and that nested units of work commit once
+python test.py search
+ ->Check that patients and staff are found by prefixes, that indexes follow changes of rows,
+   that results are bounded by SEARCH_MAX_LIMIT, and that search answers 503 while an index is missing
+python test.py conditional_get
+ ->Check that an unchanged list answers 304 by one query, and that a booking changes its ETag and Last-Modified
+python test.py passwords
+ ->Check that old hashes are replaced on sign-in, and that sign-ins wait for the password hasher before 503
 """
 
+# Maximum number of SQL statements that each list screen may run
+# The identity of the signed in user is cached, so it does not count on a warm request
+QUERY_BUDGETS = {
+    '/reception': 1,
+    '/prescription': 1,
+    '/patient': 1,
+    '/healthcare_pro': 1,
+    '/calendar': 1,
+}
+
+# Sortable columns of list resources
+SORTABLE_COLUMNS = {
+    '/api/v1/appointments': ['type', 'date', 'created_at'],
+    '/api/v1/prescriptions': ['type', 'quantity', 'created_at'],
+    '/api/v1/patients': ['name', 'created_at'],
+    '/api/v1/staff': ['name', 'employee_num', 'created_at'],
+}
+
 
 def add_patient():
     for count in range(500):
         patient = Patient(name=f'Test{count+1}', address='Test', phone='123456789', doctor_id=1)
         db.session.add(patient)
+    db.session.commit()
+
+
+class QueryCounter(object):
+    """
+    Context manager counting SQL statements executed on the database while it is active
+    """
+    def __init__(self):
+        self.statements: list[str] = []
+        self.executions: list[tuple] = []
+
+    def __enter__(self):
+        event.listen(db.get_engine(app), 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(db.get_engine(app), 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+        self.executions.append((statement, parameters))
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+def assert_query_budget(client, url: str, budget: int):
+    """
+    Request the url and fail when it runs more SQL statements than the budget
+
+    :param client: Flask test client with a signed in user
+    :param url:
+    :param budget:
+    """
+    with QueryCounter() as counter:
+        response = client.get(url)
+    # Versions of users and staff are read by whichever request comes after IDENTITY_VERSION_CHECK_SECONDS,
+    # so they are not a part of the budget of a screen
+    counter.statements = [statement for statement in counter.statements if 'FROM table_version' not in statement]
+
+    assert response.status_code == 200, f'{url} returned {response.status_code}'
+    assert counter.count <= budget, f'{url} ran {counter.count} queries over its budget {budget}:\n' + \
+                                    '\n'.join(counter.statements)
+    print(f'{url}: {counter.count} queries (budget {budget})')
+
+
+def explain_list_query(client, url: str) -> list[str]:
+    """
+    Request the url and get the query plans of the statements that read a page
+    """
+    statements = []
+    with QueryCounter() as counter:
+        client.get(url)
+    with app.app_context():
+        connection = db.session.connection()
+        for statement, parameters in counter.executions:
+            if 'ORDER BY' in statement and 'LIMIT' in statement:
+                plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+                statements.append('; '.join(row[-1] for row in plan))
+
+    return statements
+
+def create_test_database(rows: int = 0):
+    """
+    Switch the application to a temporary database and insert a doctor, a nurse and a user to sign in
+    The user is David and the password is cat, the same as initialize.py.
+
+    :param rows: number of patients, appointments and prescriptions to insert
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'test.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['JOB_RUNNER_AUTOSTART'] = False
+    with app.app_context():
+        insert_test_data(rows)
+
+
+def insert_test_data(rows: int):
+    """
+    Insert test data into the database
+    """
+    db.create_all()
+
+    doctor = Doctor(name='David', employee_num='DC001', employee_type='doctor')
+    nurse = Nurse(name='Nancy', employee_num='NS001', employee_type='nurse')
+    user = User(username='David', employee_num='DC001')
+    user.set_password('cat')
+    db.session.add_all([doctor, nurse, user])
+    db.session.flush()
+
+    first_day = date.today() + timedelta(days=1)
+    for count in range(rows):
+        patient = Patient(name=f'Test{count+1}', address='Test', phone='123456789', doctor_id=doctor.id)
+        db.session.add(patient)
+        db.session.flush()
+        appointment_date = datetime.combine(first_day + timedelta(days=count // 4), time(hour=[9, 11, 14, 16][count % 4]))
+        db.session.add(Appointment(type='Consultation', staff_id=[doctor.id, nurse.id][count % 2], patient_id=patient.id,
+                                   date=appointment_date, created_by='David'))
+        db.session.add(Prescription(type='Tablet', patient_id=patient.id, doctor_id=doctor.id, quantity=1, dosage=1.0))
+    db.session.commit()
+
+
+def sign_in(client):
+    """
+    Sign in with the user inserted by create_test_database
+    """
+    response = client.post('/login', data={'username': 'David', 'password': 'cat'})
+    assert response.status_code == 302, 'Sign in failed'
+
+
+def check_query_budget():
+    """
+    Check that every list screen stays within its query budget whatever the number of rows
+    Each request runs in its own application context, so nothing is served from a previous request's session.
+    """
+    create_test_database(rows=200)
+    client = app.test_client()
+    sign_in(client)
+    # Warm the identity cache
+    client.get('/index')
+    for url, budget in QUERY_BUDGETS.items():
+        assert_query_budget(client, url, budget)
+        assert_query_budget(client, url + '?page_size=200', budget)
+
+    # Every sortable column is read from an index, on the first page and on the page after a cursor
+    for url, sorts in SORTABLE_COLUMNS.items():
+        for sort in sorts + ['-' + sort for sort in sorts]:
+            first_url = f'{url}?sort={sort}&page_size=20'
+            # Lists of a few staff have no next page
+            next_url = client.get(first_url).get_json()['next']
+            for page_url in [first_url] + ([next_url] if next_url else []):
+                plans = explain_list_query(client, page_url)
+                for plan in plans:
+                    assert 'TEMP B-TREE' not in plan, f'{page_url} sorts rows out of an index: {plan}'
+                # The page after a cursor starts reading the index at the cursor rather than at the first row
+                assert page_url is first_url or any(f'({sort.lstrip("-")}>?)' in plan or f'({sort.lstrip("-")}<?)' in plan
+                                                    for plan in plans), f'{page_url} reads the index from the start'
+    print(f'Sorted lists are read from indexes: {sum(len(sorts) for sorts in SORTABLE_COLUMNS.values()) * 2} sorts')
+
+
+def book(slots: list[datetime], barrier: threading.Barrier, results: list, lock: threading.Lock):
+    """
+    Book each slot for the doctor in turn, as a receptionist would
+    Results are appended as (slot, True) for a booking and (slot, False) for a taken slot.
+    """
+    barrier.wait()
+    for slot in slots:
+        with app.app_context():
+            receptionist = Receptionist(name='David', employee_num='DC001')
+            staff = receptionist.find_staff(name='David')
+            patient = receptionist.find_patient(name='Test1')
+            try:
+                receptionist.make_appointment(appointment_type='Consultation', staff=staff, patient=patient,
+                                              appointment_date=slot)
+                booked = True
+            except SlotUnavailableError:
+                booked = False
+        with lock:
+            results.append((slot, booked))
+
+
+def check_concurrent_booking(threads: int = 8, slots: int = 50):
+    """
+    Fire bookings of the same slots from parallel threads
+    Every thread tries every slot in the same order, so each slot is contended by all threads.
+    Exactly one booking of each slot must succeed, and the others must be reported as taken.
+    """
+    app.config['DATABASE_PROFILE'] = 'production'
+    create_test_database(rows=1)
+
+    first_slot = datetime.combine(date.today() + timedelta(days=30), time(hour=9))
+    targets = [first_slot + timedelta(days=i) for i in range(slots)]
+    barrier = threading.Barrier(threads)
+    results: list[tuple] = []
+    lock = threading.Lock()
+    workers = [threading.Thread(target=book, args=(targets, barrier, results, lock)) for _ in range(threads)]
+    started = timer.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = timer.perf_counter() - started
+
+    assert len(results) == threads * slots, f'{threads * slots - len(results)} bookings failed with errors'
+    for target in targets:
+        booked = sum(1 for slot, success in results if slot == target and success)
+        assert booked == 1, f'{target} was booked {booked} times'
+    with app.app_context():
+        stored = Appointment.query.filter(Appointment.date >= first_slot).count()
+    assert stored == slots, f'{stored} appointments are stored for {slots} slots'
+
+    print(f'{threads} threads x {slots} slots: {len(results)} attempts in {elapsed:.2f}s')
+    print(f'attempts/s: {len(results) / elapsed:.1f}, bookings/s: {slots / elapsed:.1f}, '
+          f'rejected: {len(results) - slots}')
+
+
+def measure_export(rows: int) -> tuple[int, int]:
+    """
+    Export appointments of a database with the number of rows, and measure the peak memory of the request
+
+    :return:
+     peak: bytes
+     lines: number of lines exported
+    """
+    # Rows are inserted by the benchmark data generator, which is much faster than inserting them one by one
+    from benchmark.data import DataSize, use_database, build_database
+    use_database()
+    with app.app_context():
+        build_database(DataSize(patients=100, appointments=rows, prescriptions=0))
+    client = app.test_client()
+    client.post('/login', data={'username': 'David', 'password': 'cat'})
+
+    tracemalloc.start()
+    try:
+        response = client.get('/export/appointments', buffered=False)
+        lines = sum(chunk.count(b'\n') for chunk in response.response)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak, lines
+
+
+def check_export_memory():
+    """
+    Check that exports are streamed, so that ten times more rows do not use much more memory
+    """
+    small_peak, small_lines = measure_export(5000)
+    large_peak, large_lines = measure_export(50000)
+    assert small_lines == 5001 and large_lines == 50001, 'Some rows are not exported'
+    print(f'5000 rows: {small_peak / 1024:.0f} KiB, 50000 rows: {large_peak / 1024:.0f} KiB')
+    assert large_peak < small_peak * 2, 'Memory used by an export grows with the number of rows'
+
+
+def check_fragment_cache():
+    """
+    Check that a list screen read again runs no SQL statement, and is rendered again after its table changes
+    """
+    for backend in ('memory', 'sqlite'):
+        app.config['FRAGMENT_CACHE'] = backend
+        app.config['FRAGMENT_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(), 'fragment_cache.db')
+        app.extensions.pop('fragment_cache', None)
+        create_test_database(rows=10)
+        client = app.test_client()
+        sign_in(client)
+        client.get('/index')
+        for url in QUERY_BUDGETS:
+            client.get(url)
+            assert_query_budget(client, url, 0)
+
+        with app.app_context():
+            patient = Patient(name='Cached', address='Test', phone='123456789', doctor_id=1)
+            patient.persist()
+        with QueryCounter() as counter:
+            response = client.get('/patient')
+        assert b'Cached' in response.data, f'{backend}: a new patient is not shown'
+        assert counter.count > 0, f'{backend}: the patient list is not rendered again'
+        # Screens that do not show patients stay cached
+        assert_query_budget(client, '/healthcare_pro', 0)
+        print(f'{backend}: ok')
+
+
+def check_patient_count():
+    """
+    Check that the number of patients stored with each doctor is the same as the number counted from the patient table
+    """
+    create_test_database(rows=PATIENT_QUOTA - 2)
+    with app.app_context():
+        doctor = Doctor.query.filter_by(name='David').first()
+        other = Doctor(name='Diana', employee_num='DC002', employee_type='doctor')
+        other.persist()
+
+        def assert_counts():
+            for staff_id in (doctor.id, other.id):
+                count = Patient.query.filter_by(doctor_id=staff_id).count()
+                assert Doctor.count_patients(staff_id) == count, f'The stored count of {staff_id} is not {count}'
+
+        doctor.register_patient(name='Count1', address='Test', phone='123456789', doctor_id=doctor.id)
+        doctor.register_patient(name='Count2', address='Test', phone='123456789', doctor_id=doctor.id)
+        assert_counts()
+        try:
+            doctor.register_patient(name='Count3', address='Test', phone='123456789', doctor_id=doctor.id)
+            raise AssertionError('A patient over the quota is registered')
+        except PatientQuotaError:
+            assert Patient.query.filter_by(name='Count3').first() is None, 'A patient over the quota is not rolled back'
+        assert_counts()
+
+        # A doctor registered as staff only has no doctor row
+        staff_id = db.session.execute(HealthcareProfessional.__table__.insert(), {
+            'name': 'Dora', 'employee_num': 'DC003', 'employee_type': 'doctor'}).inserted_primary_key[0]
+        db.session.commit()
+        try:
+            doctor.register_patient(name='Count4', address='Test', phone='123456789', doctor_id=staff_id)
+            raise AssertionError('A patient is registered to a staff without a doctor row')
+        except UnregisteredDoctorError:
+            assert Patient.query.filter_by(name='Count4').first() is None, 'A patient of no doctor is not rolled back'
+
+        patient = Patient.query.filter_by(name='Count1').first()
+        patient.doctor_id = other.id
+        db.session.commit()
+        assert_counts()
+        doctor.delete_patient(patient.id)
+        assert_counts()
+        print(f'{doctor.name}: {Doctor.count_patients(doctor.id)}, {other.name}: {Doctor.count_patients(other.id)}')
+
+    # Counts broken behind the session are repaired by a recount, which must change the responses of capacities
+    client = app.test_client()
+    sign_in(client)
+    with app.app_context():
+        db.session.execute(Doctor.__table__.update().values(patient_count=0))
+        db.session.commit()
+    etag = client.get('/api/v1/doctors/capacity').headers['ETag']
+    with app.app_context():
+        Doctor.recount_patients()
+        assert_counts()
+    response = client.get('/api/v1/doctors/capacity', headers={'If-None-Match': etag})
+    assert response.status_code == 200, f'Capacities answered {response.status_code} after a recount'
+    counts = {item['name']: item['patient_count'] for item in response.get_json()['items']}
+    assert counts['David'] == PATIENT_QUOTA - 1, f'Capacities are not recounted: {counts}'
+
+
+def wait_for_jobs(job_ids: list[int], timeout: float = 30) -> tuple[list[dict], int]:
+    """
+    Wait until the jobs succeed or fail, and record the largest number of them running at once
+    """
+    deadline = timer.monotonic() + timeout
+    peak = 0
+    while timer.monotonic() < deadline:
+        jobs = [get_queue().get(job_id) for job_id in job_ids]
+        peak = max(peak, sum(job['status'] == RUNNING for job in jobs))
+        if all(job['status'] in (SUCCEEDED, FAILED) for job in jobs):
+            return jobs, peak
+        timer.sleep(0.05)
+    raise AssertionError('Jobs do not finish in time')
+
+
+def check_background_jobs():
+    """
+    Check that jobs run in the background within JOB_CONCURRENCY, and that a failing job is retried
+    """
+    create_test_database(rows=100)
+    directory = tempfile.mkdtemp()
+    app.config.update(JOB_QUEUE_PATH=os.path.join(directory, 'jobs.db'), JOB_OUTPUT_DIR=directory, JOB_WORKERS=4,
+                      JOB_CONCURRENCY=2, JOB_RETRY_SECONDS=0.1, JOB_POLL_SECONDS=0.1, EXPORT_BATCH_SIZE=10)
+    attempts = []
+
+    @job_function('test-sleep')
+    def sleep(context, seconds: float):
+        timer.sleep(seconds)
+        return {}
+
+    @job_function('test-flaky')
+    def flaky(context, failures: int):
+        attempts.append(context.attempt)
+        if context.attempt <= failures:
+            raise RuntimeError('Failure for the test')
+        return {'attempt': context.attempt}
+
+    start_runner()
+    with app.app_context():
+        jobs, peak = wait_for_jobs([submit_job('test-sleep', {'seconds': 0.3}) for _ in range(6)])
+        assert peak <= 2, f'{peak} jobs run at once'
+
+        jobs, _ = wait_for_jobs([submit_job('test-flaky', {'failures': 1}), submit_job('test-flaky', {'failures': 5})])
+        assert jobs[0]['status'] == SUCCEEDED and jobs[0]['result'] == {'attempt': 2}, 'A job is not retried'
+        assert jobs[1]['status'] == FAILED and jobs[1]['attempts'] == app.config['JOB_MAX_ATTEMPTS'], \
+            'A job is tried more than JOB_MAX_ATTEMPTS'
+
+        (job, ), _ = wait_for_jobs([submit_job('export', {'resource': 'patients', 'export_format': 'csv'})])
+        assert job['status'] == SUCCEEDED and job['result']['rows'] == 100 and job['progress'] == 1, \
+            'The export job does not write every row'
+    for kind in ('test-sleep', 'test-flaky'):
+        JOB_FUNCTIONS.pop(kind)
+    print(f'At most {peak} jobs run at once, attempts of failing jobs: {attempts}')
+
+
+def check_recurring_booking(occurrences: int = 20):
+    """
+    Book a weekly appointment of which some slots are already taken
+    All slots must be checked by one query whatever the number of occurrences. Free slots must be booked
+    with their changes, and taken slots and a slot given twice must be reported as conflicts.
+    """
+    create_test_database(rows=1)
+    with app.app_context():
+        receptionist = Receptionist(name='David', employee_num='DC001')
+        staff = receptionist.find_staff(name='David')
+        patient = receptionist.find_patient(name='Test1')
+        first_slot = datetime.combine(date.today() + timedelta(days=30), time(hour=9))
+        dates = AppointmentSchedule.recurring_dates(first_slot, timedelta(weeks=1), occurrences)
+        taken = dates[::3]
+        receptionist.make_appointments([('Consultation', staff, patient, slot) for slot in taken])
+
+        with QueryCounter() as counter:
+            appointments, conflicts = receptionist.make_appointments(
+                [('Consultation', staff, patient, slot) for slot in dates + dates[1:2]])
+        # Staff and patient expired by the previous commit are read again, but appointments are read once
+        selects = [statement for statement in counter.statements if 'FROM appointment' in statement]
+        assert len(selects) == 1, f'Slots are checked by {len(selects)} queries:\n' + '\n'.join(selects)
+        assert len(appointments) == occurrences - len(taken), f'{len(appointments)} appointments are made'
+        assert [conflict.date for conflict in conflicts if conflict.reason == 'booked'] == taken, \
+            'Taken slots are not reported'
+        assert [conflict.index for conflict in conflicts if conflict.reason == 'duplicate'] == [occurrences], \
+            'A slot given twice is not reported'
+        stored = Appointment.query.filter(Appointment.date >= first_slot).count()
+        assert stored == occurrences, f'{stored} appointments are stored for {occurrences} occurrences'
+        changes = AppointmentChange.query.filter(AppointmentChange.date >= first_slot).count()
+        assert changes == occurrences, f'{changes} changes are logged for {occurrences} appointments'
+
+    # Dates with an offset and unknown types are refused before anything is booked
+    client = app.test_client()
+    sign_in(client)
+    later_slot = (first_slot + timedelta(days=1)).isoformat()
+    for body in ({'type': 'Consultation', 'staff': 'David', 'patient': 'Test1', 'date': later_slot + '+09:00'},
+                 {'type': 'Massage', 'staff': 'David', 'patient': 'Test1', 'date': later_slot}):
+        response = client.post('/api/v1/appointments/recurring', json=dict(body, count=2))
+        assert response.status_code == 400, f'A recurring booking of {body} is answered with {response.status_code}'
+        response = client.post('/api/v1/appointments/bulk', json={'items': [body]})
+        assert response.status_code == 400, f'A bulk booking of {body} is answered with {response.status_code}'
+
+    print(f'{occurrences} occurrences: {len(appointments)} made, {len(conflicts)} conflicts, '
+          f'{counter.count} statements')
+
+
+def check_archive(rows: int = 200):
+    """
+    Check that appointments and prescriptions older than the horizons are moved into archive tables
+    Hot tables must keep only recent rows, no row may be lost, and archived rows must be listed with history=1.
+    """
+    create_test_database(rows=rows)
+    with app.app_context():
+        # Half of the rows are moved before the horizons
+        old_appointments = Appointment.query.order_by(Appointment.id).limit(rows // 2).all()
+        for appointment in old_appointments:
+            appointment.date -= timedelta(days=app.config['ARCHIVE_APPOINTMENT_DAYS'] + 60)
+        for prescription in Prescription.query.order_by(Prescription.id).limit(rows // 2):
+            prescription.created_at -= timedelta(days=app.config['ARCHIVE_PRESCRIPTION_DAYS'] + 1)
         db.session.commit()
+        old_ids = {appointment.id for appointment in old_appointments}
+
+        batches = []
+        moved = archive_all(batch_size=30, on_batch=batches.append)
+        assert moved == {'appointments': rows // 2, 'prescriptions': rows // 2}, f'Moved rows are {moved}'
+        assert max(batches) == 30, f'Rows are moved in batches of {batches}'
+        assert Appointment.query.count() == rows - rows // 2 and Prescription.query.count() == rows - rows // 2, \
+            'Old rows are left in the hot tables'
+        assert {archived.id for archived in AppointmentArchive.query} == old_ids, 'Archived appointments are not the old ones'
+        assert PrescriptionArchive.query.count() == rows // 2, 'Archived prescriptions are lost'
+        assert archive_all() == {'appointments': 0, 'prescriptions': 0}, 'Rows are archived twice'
+
+    client = app.test_client()
+    sign_in(client)
+    items = client.get('/api/v1/appointments?history=1&page_size=200').get_json()['items']
+    assert {item['id'] for item in items} == old_ids, 'Archived appointments are not listed as history'
+    items = client.get('/api/v1/appointments?page_size=200').get_json()['items']
+    assert not old_ids.intersection(item['id'] for item in items), 'Archived appointments are listed as current'
+    assert_query_budget(client, '/reception?history=1', QUERY_BUDGETS['/reception'])
+    assert_query_budget(client, '/prescription?history=1', QUERY_BUDGETS['/prescription'])
+    print(f'Archived: {moved}, batches: {batches}')
+
+
+def read_rollups() -> tuple[list, list]:
+    """
+    Read every row of rollups, with totals rounded so that sums in another order compare equal
+    """
+    rollups = [(row.grain, row.day, row.doctor_id, row.type, row.count, row.total_quantity, round(row.total_dosage, 6))
+               for row in PrescriptionRollup.query.order_by(PrescriptionRollup.grain, PrescriptionRollup.day,
+                                                            PrescriptionRollup.doctor_id, PrescriptionRollup.type)]
+    histograms = [(row.grain, row.day, row.doctor_id, row.type, row.measure, row.bucket, row.count)
+                  for row in PrescriptionHistogram.query.order_by(PrescriptionHistogram.grain, PrescriptionHistogram.day,
+                                                                  PrescriptionHistogram.doctor_id, PrescriptionHistogram.type,
+                                                                  PrescriptionHistogram.measure, PrescriptionHistogram.bucket)]
+
+    return rollups, histograms
+
+
+def check_prescription_analytics(rows: int = 100):
+    """
+    Check that rollups kept by issuing and cancelling prescriptions are the same as rebuilt ones
+    Reports must add up to the prescriptions, including archived ones, and must not read the prescription tables.
+    """
+    create_test_database(rows=rows)
+    with app.app_context():
+        doctor = Doctor.query.filter_by(name='David').first()
+        patients = Patient.query.order_by(Patient.id).limit(10).all()
+        for count, patient in enumerate(patients):
+            doctor.issue_prescription(['Tablet', 'Powder', 'Ointment'][count % 3], patient, count * 3, count / 4)
+        for prescription in Prescription.query.order_by(Prescription.id.desc()).limit(4):
+            doctor.cancel_prescription(prescription.id)
+        # Some prescriptions are issued in past years and archived
+        for count, prescription in enumerate(Prescription.query.order_by(Prescription.id).limit(rows // 2)):
+            prescription.created_at -= timedelta(days=app.config['ARCHIVE_PRESCRIPTION_DAYS'] + 30 * count)
+        db.session.commit()
+        archive_all()
+
+        kept = read_rollups()
+        issued = Prescription.query.count() + PrescriptionArchive.query.count()
+        # Ends of a range in the middle of months are read from daily rows, and the months between from monthly rows
+        date_from, date_to = date.today() - timedelta(days=1000), date.today() - timedelta(days=400)
+        in_range = sum(model.query.filter(model.created_at >= date_from, model.created_at < date_to + timedelta(days=1))
+                       .count() for model in (Prescription, PrescriptionArchive))
+        assert rebuild_rollups() == issued, 'Rebuilt rollups do not count every prescription'
+        assert read_rollups() == kept, 'Rollups kept by issuing and cancelling differ from rebuilt ones'
+
+    client = app.test_client()
+    sign_in(client)
+    with QueryCounter() as counter:
+        response = client.get('/api/v1/analytics/prescriptions?group=year,doctor,type')
+    report = response.get_json()
+    assert response.status_code == 200, f'Report failed with {response.status_code}'
+    assert not [statement for statement in counter.statements if 'FROM prescription ' in statement
+                or 'FROM prescription_archive' in statement], 'Report reads prescriptions'
+    assert report['total']['count'] == issued, f'Report counts {report["total"]["count"]} of {issued} prescriptions'
+    assert sum(item['count'] for item in report['items']) == issued, 'Groups do not add up to the total'
+    assert all(item['doctor_name'] == 'David' for item in report['items']), 'Doctor names are not reported'
+    for measure, buckets in report['distributions'].items():
+        assert sum(bucket['count'] for bucket in buckets) == issued, f'Distribution of {measure} does not add up'
+    for group in ('month', 'day'):
+        report = client.get(f'/api/v1/analytics/prescriptions?group={group}&date_from={date_from}&date_to={date_to}').get_json()
+        assert report['total']['count'] == in_range, f'Report by {group} counts {report["total"]["count"]} of {in_range}'
+    response = client.get('/api/v1/analytics/prescriptions?type=Powder&group=type')
+    assert [item['type'] for item in response.get_json()['items']] == ['Powder'], 'Reports are not filtered by type'
+    etag = response.headers['ETag']
+    response = client.get('/api/v1/analytics/prescriptions?type=Powder&group=type', headers={'If-None-Match': etag})
+    assert response.status_code == 304, 'Unchanged report is sent again'
+    print(f'Prescriptions: {issued}, in range: {in_range}, statements: {counter.count}')
+
+
+def check_metrics(failures: int = 10):
+    """
+    Check that statements rejected by the database do not leave their start times on the connection
+    """
+    create_test_database(rows=1)
+    with app.app_context():
+        connection = db.session.connection()
+        for count in range(failures):
+            try:
+                connection.execute(Patient.__table__.insert(), {'id': 1, 'name': f'Duplicate{count}'})
+            except IntegrityError:
+                pass
+        assert not connection.info.get('query_started'), f"{len(connection.info['query_started'])} start times are left"
+
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 200, 'Metrics are not answered to the local address'
+    response = client.get('/metrics', environ_base={'REMOTE_ADDR': '192.0.2.1'})
+    assert response.status_code == 403, f'Metrics are answered to another address with {response.status_code}'
+    print(f'{failures} failed statements: nothing is left')
+
+
+def check_identity():
+    """
+    Check that the cached identity follows users deleted by another worker process
+    """
+    create_test_database()
+    client = app.test_client()
+    sign_in(client)
+    assert client.get('/api/v1/staff').status_code == 200, 'The signed in user is not authorized'
+    with QueryCounter() as counter:
+        client.get('/api/v1/staff')
+        client.get('/api/v1/staff')
+    assert not [statement for statement in counter.statements if 'FROM user' in statement], 'The identity is not cached'
+
+    # Another worker process deletes the user with its own connection
+    with app.app_context():
+        engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+        with engine.begin() as connection:
+            connection.execute(User.__table__.delete().where(User.__table__.c.username == 'David'))
+            increment(connection, ['user'])
+        engine.dispose()
+    timer.sleep(app.config['IDENTITY_VERSION_CHECK_SECONDS'] + 0.1)
+    response = client.get('/api/v1/staff')
+    assert response.status_code == 401, f'A deleted user is authorized with {response.status_code}'
+    print('A deleted user is signed out')
+
+
+def check_roster(lookups: int = 1000):
+    """
+    Check that staff are looked up in the roster without a query
+    Staff registered by this process must be found at once, and staff registered by another worker process
+    must be found after ROSTER_VERSION_CHECK_SECONDS.
+    """
+    create_test_database(rows=1)
+    client = app.test_client()
+    sign_in(client)
+    with app.app_context():
+        roster = get_roster()
+        receptionist = Receptionist(name='David', employee_num='DC001')
+        assert receptionist.find_staff(name='David').is_doctor, 'The doctor is not found'
+        with QueryCounter() as counter:
+            for count in range(lookups):
+                staff = receptionist.find_staff(name=['David', 'Nancy'][count % 2])
+                assert roster.by_id(staff.id) is roster.by_employee_num(staff.employee_num) is staff, 'Indexes differ'
+        assert counter.count == 0, f'{lookups} lookups ran {counter.count} statements'
+        assert not hasattr(staff, '__dict__'), 'Records are not compact'
+
+    response = client.post('/register_healthcare_pro', data={'type': 'nurse', 'name': 'Nora', 'employee_num': 'NS002'},
+                           follow_redirects=True)
+    assert b'Succeeded register' in response.data, 'Staff is not registered'
+    response = client.post('/register_healthcare_pro', data={'type': 'doctor', 'name': 'Nora', 'employee_num': 'DC009'},
+                           follow_redirects=True)
+    assert b'already registered' in response.data, 'A registered name is registered again'
+    response = client.post('/register_patient', data={'name': 'Roster1', 'address': 'Test', 'phone': '123456789',
+                                                      'doctor_name': 'Nora'}, follow_redirects=True)
+    assert b'not registered' in response.data, 'A patient is registered to a nurse'
+    # A doctor registered as staff only has no doctor row, which keeps the number of patients
+    response = client.post('/register_healthcare_pro', data={'type': 'doctor', 'name': 'Dora', 'employee_num': 'DC003'},
+                           follow_redirects=True)
+    assert b'Succeeded register' in response.data, 'Staff is not registered'
+    response = client.post('/register_patient', data={'name': 'Roster1', 'address': 'Test', 'phone': '123456789',
+                                                      'doctor_name': 'Dora'}, follow_redirects=True)
+    assert response.status_code == 200 and b'not registered' in response.data, \
+        'A patient is registered to a doctor without a doctor row'
+    with app.app_context():
+        assert get_roster().by_name('Nora').employee_type == 'nurse', 'Staff registered by this process is not found'
+
+        # Another worker process registers a doctor with its own connection
+        engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+        with engine.begin() as connection:
+            connection.execute(HealthcareProfessional.__table__.insert(), {'name': 'Oscar', 'employee_num': 'DC002',
+                                                                          'employee_type': 'doctor'})
+            connection.execute(Doctor.__table__.insert(), {'id': connection.execute(
+                HealthcareProfessional.__table__.select().where(HealthcareProfessional.name == 'Oscar')).first().id})
+            increment(connection, ['healthcare_pro', 'doctor'])
+        engine.dispose()
+        timer.sleep(app.config['ROSTER_VERSION_CHECK_SECONDS'] + 0.1)
+        assert get_roster().by_name('Oscar') is not None, 'Staff registered by another process is not found'
+    response = client.post('/register_patient', data={'name': 'Roster1', 'address': 'Test', 'phone': '123456789',
+                                                      'doctor_name': 'Oscar'}, follow_redirects=True)
+    assert b'Succeeded register patient' in response.data, 'A patient is not registered to the new doctor'
+    print(f'{lookups} lookups: {counter.count} statements')
+
+
+def check_reception_streams():
+    """
+    Check that a worker keeps at most RECEPTION_MAX_STREAMS streams of the reception board open
+    """
+    create_test_database(rows=1)
+    client = app.test_client()
+    sign_in(client)
+    limit = app.config['RECEPTION_MAX_STREAMS']
+    streams = [client.get('/reception/events?since=2000-01-01T00:00:00', buffered=False) for _ in range(limit)]
+    for stream in streams:
+        # The slot is taken when the stream starts
+        next(iter(stream.response))
+
+    started = timer.monotonic()
+    response = client.get('/reception/events?since=2000-01-01T00:00:00')
+    elapsed = timer.monotonic() - started
+    assert response.status_code == 200 and response.data.startswith(b'retry:'), 'A stream above the cap is refused'
+    assert elapsed < app.config['RECEPTION_EVENTS_POLL_SECONDS'], f'A stream above the cap is kept open {elapsed:.1f}s'
+
+    # Streams of one thread hold nested request contexts, so they are closed in reverse order
+    for stream in reversed(streams):
+        stream.close()
+    assert slots.acquire(limit), 'Closed streams do not give back their slots'
+    slots.release()
+    print(f'{limit} streams open, the next one ends in {elapsed * 1000:.0f}ms')
+
+
+def book_slots(staff_id: int, patient_id: int, slots: list[datetime]):
+    """
+    Insert appointments of the staff in the slots by one statement
+    """
+    db.session.execute(Appointment.__table__.insert(), [
+        {'type': 'Consultation', 'staff_id': staff_id, 'patient_id': patient_id, 'date': slot, 'created_by': 'David'}
+        for slot in slots])
+    db.session.commit()
+
+
+def check_availability():
+    """
+    Check that availability follows slots booked for each staff
+    All slots of the first day are booked for the doctor, so the doctor's next slot is on the next day,
+    while the nurse is still free on the first day.
+    """
+    create_test_database()
+    with app.app_context():
+        doctor = Doctor.query.filter_by(name='David').first()
+        nurse = Nurse.query.filter_by(name='Nancy').first()
+        patient = Patient(name='Slot1', address='Test', phone='123456789', doctor_id=doctor.id)
+        db.session.add(patient)
+        db.session.commit()
+        schedule = AppointmentSchedule()
+        first_slot = schedule.first_slot()
+        first_day = [first_slot.replace(hour=hour) for hour in APPOINTMENT_HOURS]
+        book_slots(doctor.id, patient.id, first_day)
+
+        next_day = first_slot + timedelta(days=1)
+        assert schedule.find_next_available(staff_id=doctor.id) == next_day, 'The next slot of a full day is offered'
+        assert schedule.find_next_available(staff_id=nurse.id) == first_slot, 'A free staff is not offered'
+        assert schedule.find_next_available() == first_slot, 'A slot in which a staff is free is not offered'
+
+        # A slot is available while fewer appointments than staff are made in it
+        assert schedule.is_date_available(first_slot), 'A slot with a free staff is unavailable'
+        assert not schedule.is_date_available(first_slot, staff_id=doctor.id), 'A booked slot is available'
+        book_slots(nurse.id, patient.id, first_day[:1])
+        assert not schedule.is_date_available(first_slot), 'A slot booked for every staff is available'
+        assert schedule.is_date_available(first_day[1]), 'A slot with a free staff is unavailable'
+        assert schedule.find_next_available() == first_day[1], 'The next slot does not skip a slot booked for everyone'
+
+        # Options are in the order of slots, and of staff ids in a slot
+        assert schedule.soonest(5) == [(slot, nurse.id, 'Nancy') for slot in first_day[1:]] + \
+            [(next_day, doctor.id, 'David'), (next_day, nurse.id, 'Nancy')], 'Options are not in the order of slots'
+        matrix = AppointmentSchedule.free_busy()
+        assert not matrix.is_free(doctor.id, first_slot) and matrix.is_free(doctor.id, next_day), 'Bits of slots differ'
+        assert matrix.free_staff(first_day[1]) == [nurse.id], 'A booked staff is free'
+        assert matrix.index_of(first_slot.replace(hour=10)) is None, 'A time between slots has a bit'
+        assert matrix.date_of(matrix.index_of(first_day[3])) == first_day[3], 'A bit is not of its slot'
+        assert matrix.earliest([doctor.id]) == (next_day, doctor.id, 'David'), 'The earliest slot of a staff differs'
+
+        # The doctor is booked over the first window, so the next slot is found in the second, twice as long, window
+        book_slots(doctor.id, patient.id, [slot + timedelta(days=day) for day in range(1, AVAILABILITY_WINDOW_DAYS + 6)
+                                           for slot in first_day])
+        doctor_id = doctor.id
+        with QueryCounter() as counter:
+            next_free = schedule.find_next_available(staff_id=doctor_id)
+        assert next_free == first_slot + timedelta(days=AVAILABILITY_WINDOW_DAYS + 6), f'{next_free} is offered'
+        assert counter.count == 2, f'{counter.count} windows are read'
+        n = len(APPOINTMENT_HOURS) * AVAILABILITY_WINDOW_DAYS + 1
+        options = schedule.soonest(n, staff_id=nurse.id)
+        slots = [slot for slot, _, _ in options]
+        assert len(options) == n and slots == sorted(set(slots)), f'{len(options)} options are found over windows'
+        assert slots[-1].date() == first_slot.date() + timedelta(days=AVAILABILITY_WINDOW_DAYS), \
+            'Options of the second window do not follow the first'
+    print(f'Next slot of the doctor: {next_day}, of anyone: {first_day[1]}, after the first window: {next_free}')
+
+
+def check_import_patients():
+    """
+    Import patients from a CSV file and a JSONL file with rows that cannot be imported
+    Rows over the quota, names registered in the database or earlier in the file, unknown doctors, missing values
+    and broken lines must be reported by line, and the others imported with the stored numbers of patients.
+    """
+    create_test_database(rows=PATIENT_QUOTA - 2)
+    directory = tempfile.mkdtemp()
+    csv_path = os.path.join(directory, 'patients.csv')
+    with open(csv_path, 'w', encoding='utf-8') as file:
+        file.write('name,address,phone,doctor_name\n'
+                   'Import1,Test,123456789,David\n'
+                   'Import2,Test,123456789,David\n'
+                   'Import3,Test,123456789,David\n'
+                   'Test1,Test,123456789,David\n'
+                   'Import1,Test,123456789,Diana\n'
+                   'Import4,Test,123456789,Nobody\n'
+                   'Import5,Test,,Diana\n'
+                   'Import6,Test,123456789,Diana\n')
+    jsonl_path = os.path.join(directory, 'patients.jsonl')
+    with open(jsonl_path, 'w', encoding='utf-8') as file:
+        file.write('{"name": "Json1", "address": "Test", "phone": 123456789, "doctor_name": "Diana"}\n'
+                   '{"name": "Json2", "address": "Test"\n'
+                   '\n'
+                   '["Json3", "Test", "123456789", "Diana"]\n'
+                   '{"name": "Json4", "address": "Test", "phone": "123456789", "doctor_name": "Nancy"}\n'
+                   '{"name": "Test2", "address": "Test", "phone": "123456789", "doctor_name": "Diana"}\n')
+
+    with app.app_context():
+        other = Doctor(name='Diana', employee_num='DC002', employee_type='doctor')
+        other.persist()
+        doctor_id, other_id = Doctor.query.filter_by(name='David').first().id, other.id
+
+        # Batches of two rows make duplicates span batches
+        report = PatientImporter(batch_size=2).run(csv_path)
+        errors = {line: (name, message) for line, name, message in report.errors}
+        assert report.imported == 3, f'{report.imported} rows of the CSV file are imported'
+        assert sorted(errors) == [4, 5, 6, 7, 8], f'Errors are reported for lines {sorted(errors)}'
+        assert 'Less than' in errors[4][1], f'A row over the quota is reported as {errors[4]}'
+        assert 'already registered' in errors[5][1] and 'already registered' in errors[6][1], \
+            'Registered names are not reported'
+        assert 'doctor is not registered' in errors[7][1], f'An unknown doctor is reported as {errors[7]}'
+        assert errors[8][1].startswith('phone'), f'A missing phone is reported as {errors[8]}'
+
+        report = PatientImporter(batch_size=2).run(jsonl_path)
+        errors = {line: (name, message) for line, name, message in report.errors}
+        assert report.imported == 1, f'{report.imported} rows of the JSONL file are imported'
+        assert sorted(errors) == [2, 4, 5, 6], f'Errors are reported for lines {sorted(errors)}'
+        assert errors[2][1] == errors[4][1] == 'The row cannot be read.', 'Broken lines are not reported'
+        assert 'doctor is not registered' in errors[5][1], 'A nurse is accepted as a doctor'
+
+        for staff_id, count in ((doctor_id, PATIENT_QUOTA), (other_id, 2)):
+            assert Doctor.count_patients(staff_id) == Patient.query.filter_by(doctor_id=staff_id).count() == count, \
+                f'The stored count of {staff_id} is {Doctor.count_patients(staff_id)}, not {count}'
+    print(f'Imported: CSV 3, JSONL 1, stored counts: {PATIENT_QUOTA}, 2')
+
+
+def check_unit_of_work():
+    """
+    Check that operations in a unit of work are committed or rolled back together
+    A new patient registered with a booking of a taken slot must be rolled back with the booking,
+    and units of work nested in each other must commit once, at the end of the outermost one.
+    """
+    create_test_database(rows=1)
+    client = app.test_client()
+    sign_in(client)
+    with app.app_context():
+        taken = Appointment.query.first().date
+    response = client.post('/make_appointment', data={
+        'type': 'Consultation', 'staff_name': 'David', 'patient_name': 'Atomic1', 'patient_address': 'Test',
+        'patient_phone': '123456789', 'date': taken.date().isoformat(), 'time': taken.strftime('%-H:%M')},
+        follow_redirects=True)
+    assert b'is not available' in response.data, 'A taken slot is booked'
+
+    commits = []
+
+    def count_commit(session):
+        commits.append(session)
+
+    event.listen(db.session, 'after_commit', count_commit)
+    try:
+        with app.app_context():
+            assert Patient.query.filter_by(name='Atomic1').first() is None, 'A patient of a taken slot is not rolled back'
+            receptionist = Receptionist(name='David', employee_num='DC001')
+            staff = receptionist.find_staff(name='David')
+            try:
+                with UnitOfWork():
+                    patient = receptionist.add_patient(name='Atomic2', address='Test', phone='123456789')
+                    receptionist.make_appointment(appointment_type='Consultation', staff=staff, patient=patient,
+                                                  appointment_date=taken)
+                raise AssertionError('A taken slot is booked')
+            except SlotUnavailableError:
+                assert Patient.query.filter_by(name='Atomic2').first() is None, 'A patient is not rolled back'
+
+            commits.clear()
+            with UnitOfWork():
+                with UnitOfWork():
+                    patient = receptionist.add_patient(name='Atomic3', address='Test', phone='123456789')
+                    assert patient.id is not None, 'A patient is not flushed in a unit of work'
+                receptionist.make_appointment(appointment_type='Consultation', staff=staff, patient=patient,
+                                              appointment_date=taken + timedelta(days=1))
+                assert not commits, f'{len(commits)} commits are made inside a unit of work'
+            assert len(commits) == 1, f'{len(commits)} commits are made by nested units of work'
+            assert Appointment.query.filter_by(patient_id=patient.id).count() == 1, 'The booking is not committed'
+    finally:
+        event.remove(db.session, 'after_commit', count_commit)
+    print(f'A taken slot rolls back its patient, nested units of work commit {len(commits)} time')
+
+
+def search_names(client, url: str) -> list[str]:
+    """
+    Request a search and get the names found
+    """
+    response = client.get(url)
+    assert response.status_code == 200, f'{url} returned {response.status_code}'
+
+    return [result['name'] for result in response.get_json()['results']]
+
+
+def check_search():
+    """
+    Search patients and staff while their rows are inserted, updated and deleted
+    Every word must match as a prefix of name, address or phone, and typeahead must return no more than
+    SEARCH_MAX_LIMIT results. Search must answer 503 while an index is missing, and work again once it is rebuilt.
+    """
+    max_limit = app.config['SEARCH_MAX_LIMIT']
+    create_test_database(rows=max_limit + 5)
+    client = app.test_client()
+    sign_in(client)
+
+    with app.app_context():
+        patient = Patient(name='Zoë Highfield', address='12 Orchard Lane', phone='07700900123',
+                          doctor_id=Doctor.query.filter_by(name='David').first().id)
+        nurse = Nurse(name='Olive Brook', employee_num='NS002', employee_type='nurse')
+        db.session.add_all([patient, nurse])
+        db.session.commit()
+        patient_id, nurse_id = patient.id, nurse.id
+
+    for query in ('zoe', 'high', 'orch lan', '077009'):
+        assert search_names(client, f'/search/patients?q={query}') == ['Zoë Highfield'], f'"{query}" is not matched'
+    assert search_names(client, '/search/patients?q=zoe orchard') == ['Zoë Highfield'], 'Words are not matched together'
+    assert search_names(client, '/search/patients?q=zoe tulip') == [], 'A patient matching one word is found'
+    assert search_names(client, '/search/patients?q=ighfield') == [], 'A word is matched in the middle'
+    assert search_names(client, '/search/staff?q=oli') == ['Olive Brook'], 'A new staff is not found'
+
+    with app.app_context():
+        db.session.get(Patient, patient_id).address = '3 Meadow Road'
+        db.session.get(HealthcareProfessional, nurse_id).name = 'Olivia Stone'
+        db.session.commit()
+    assert search_names(client, '/search/patients?q=orchard') == [], 'An old address is still found'
+    assert search_names(client, '/search/patients?q=meadow') == ['Zoë Highfield'], 'A new address is not found'
+    assert search_names(client, '/search/staff?q=brook') == [], 'An old name of a staff is still found'
+    assert search_names(client, '/search/staff?q=stone') == ['Olivia Stone'], 'A new name of a staff is not found'
+
+    with app.app_context():
+        db.session.delete(db.session.get(Patient, patient_id))
+        db.session.delete(db.session.get(HealthcareProfessional, nurse_id))
+        db.session.commit()
+    assert search_names(client, '/search/patients?q=zoe') == [], 'A deleted patient is found'
+    assert search_names(client, '/search/staff?q=olivia') == [], 'A deleted staff is found'
+
+    names = search_names(client, f'/search/patients?q=test&limit={max_limit * 2}')
+    assert len(names) == max_limit, f'{len(names)} patients are returned over SEARCH_MAX_LIMIT {max_limit}'
+    names = search_names(client, '/search/patients?q=test')
+    assert len(names) == app.config['SEARCH_RESULT_LIMIT'], f'{len(names)} patients are returned by default'
+
+    # A database made by migrations has neither the index nor its triggers
+    connection = db.get_engine(app).raw_connection()
+    try:
+        sqlite_utils.Database(connection.connection)['patient'].disable_fts()
+    finally:
+        connection.close()
+    response = client.get('/search/patients?q=test')
+    assert response.status_code == 503, f'Search without an index returned {response.status_code}'
+    assert 'search-index' in response.get_json()['error'], 'The command to build indexes is not told'
+    assert search_names(client, '/search/staff?q=nancy') == ['Nancy'], 'Staff are not found without patient index'
+
+    with app.app_context():
+        build_search_index()
+    names = search_names(client, '/search/patients?q=test1')
+    assert 'Test1' in names, 'Patients are not found after the index is rebuilt'
+    print(f'Search: prefixes, changes of rows, at most {max_limit} results, 503 without an index')
+
+
+def check_conditional_get():
+    """
+    Poll the list of appointments with conditional headers before and after a booking
+    An unchanged list must answer 304 to If-None-Match and to If-Modified-Since by reading only the versions of
+    its tables, and a booking must change the ETag and Last-Modified so that the next poll reads the list again.
+    """
+    create_test_database(rows=4)
+    # The identity of the user is not checked again during the test, so that a poll runs only its own query
+    app.config['IDENTITY_VERSION_CHECK_SECONDS'] = 60
+    client = app.test_client()
+    sign_in(client)
+    url = '/api/v1/appointments'
+
+    response = client.get(url)
+    assert response.status_code == 200, f'{url} returned {response.status_code}'
+    etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+    assert etag and last_modified, f'ETag {etag} and Last-Modified {last_modified} are not both given'
+
+    with QueryCounter() as counter:
+        response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304, f'If-None-Match of the current ETag returned {response.status_code}'
+    assert not response.data, 'A body is sent with 304'
+    assert counter.count == 1 and 'FROM table_version' in counter.statements[0], \
+        f'A 304 poll ran {counter.count} queries:\n' + '\n'.join(counter.statements)
+    response = client.get(url, headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 304, f'If-Modified-Since of Last-Modified returned {response.status_code}'
+    response = client.get(url + '?page_size=20', headers={'If-None-Match': etag})
+    assert response.status_code == 200, 'The ETag of other arguments is matched'
+
+    # HTTP dates have no fraction of seconds, so the booking is made in a later second than the test data
+    timer.sleep(1)
+    slot = datetime.combine(date.today() + timedelta(days=30), time(hour=9))
+    response = client.post('/make_appointment', data={
+        'type': 'Consultation', 'staff_name': 'David', 'patient_name': 'Poll1', 'patient_address': 'Test',
+        'patient_phone': '123456789', 'date': slot.date().isoformat(), 'time': '9:00'})
+    assert response.status_code == 302, f'The booking returned {response.status_code}'
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200, f'If-None-Match of an old ETag returned {response.status_code}'
+    assert response.headers['ETag'] != etag, 'The ETag is not changed by a booking'
+    assert 'Poll1' in [item['patient_name'] for item in response.get_json()['items']], 'The booking is not listed'
+    response = client.get(url, headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200, f'If-Modified-Since of an old Last-Modified returned {response.status_code}'
+    assert response.headers['Last-Modified'] != last_modified, 'Last-Modified is not changed by a booking'
+    print(f'{url}: 304 by {counter.count} query, ETag and Last-Modified changed by a booking')
+
+
+def check_passwords():
+    """
+    Sign in with hashes made by an old method, with a wrong password, and while the password hasher is full
+    A hash made by an old method must be replaced by a correct password only. A sign-in must wait
+    PASSWORD_HASH_WAIT_SECONDS for a place and then be answered 503, while a new hash waits until a place is free.
+    """
+    create_test_database()
+    client = app.test_client()
+    old_hash = generate_password_hash('cat', 'pbkdf2:sha256:1000')
+    with app.app_context():
+        User.query.filter_by(username='David').first().password_hash = old_hash
+        db.session.commit()
+
+    response = client.post('/login', data={'username': 'David', 'password': 'dog'})
+    assert response.status_code == 302 and '/login' in response.headers['Location'], 'A wrong password is accepted'
+    with app.app_context():
+        assert User.query.filter_by(username='David').first().password_hash == old_hash, \
+            'A hash is replaced by a wrong password'
+
+    sign_in(client)
+    client.get('/logout')
+    with app.app_context():
+        new_hash = User.query.filter_by(username='David').first().password_hash
+    assert new_hash.startswith(app.config['PASSWORD_HASH_METHOD'] + '$'), f'An old hash is kept: {new_hash[:20]}'
+    assert check_password_hash(new_hash, 'cat'), 'A new hash does not match the password'
+
+    # The only place of the password hasher is taken until the event is set
+    places, workers, wait = (app.config[key] for key in
+                             ('PASSWORD_HASH_PLACES', 'PASSWORD_HASH_WORKERS', 'PASSWORD_HASH_WAIT_SECONDS'))
+    app.config.update(PASSWORD_HASH_PLACES=1, PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_WAIT_SECONDS=0.2)
+    app.extensions.pop('password_hasher', None)
+    release = threading.Event()
+    holder = threading.Thread(target=get_hasher().run, args=(release.wait, ))
+    hashes = []
+    hasher = threading.Thread(target=lambda: hashes.append(hash_password('cat')))
+    try:
+        holder.start()
+        timer.sleep(0.1)
+        started = timer.perf_counter()
+        response = client.post('/login', data={'username': 'David', 'password': 'cat'})
+        elapsed = timer.perf_counter() - started
+        assert response.status_code == 503, f'A sign-in without a place returned {response.status_code}'
+        assert b'Too many users' in response.data, 'The reason of 503 is not shown'
+        assert elapsed >= 0.2, f'A sign-in is refused in {elapsed * 1000:.0f}ms without waiting'
+
+        hasher.start()
+        timer.sleep(0.5)
+        assert hasher.is_alive() and not hashes, 'A new hash does not wait for a place'
+        release.set()
+        hasher.join(10)
+        assert hashes and check_password_hash(hashes[0], 'cat'), 'A new hash is not made after a place is free'
+        sign_in(client)
+    finally:
+        release.set()
+        holder.join()
+        app.config.update(PASSWORD_HASH_PLACES=places, PASSWORD_HASH_WORKERS=workers, PASSWORD_HASH_WAIT_SECONDS=wait)
+        app.extensions.pop('password_hasher', None)
+    print(f'Old hash replaced, wrong password refused, 503 after {elapsed * 1000:.0f}ms without a place')
 
 
 if __name__ == '__main__':
-    add_patient()
\ No newline at end of file
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'patient'
+    if mode == 'patient':
+        add_patient()
+    elif mode == 'query_budget':
+        check_query_budget()
+    elif mode == 'concurrent_booking':
+        check_concurrent_booking(*[int(arg) for arg in sys.argv[2:4]])
+    elif mode == 'export_memory':
+        check_export_memory()
+    elif mode == 'fragment_cache':
+        check_fragment_cache()
+    elif mode == 'patient_count':
+        check_patient_count()
+    elif mode == 'background_jobs':
+        check_background_jobs()
+    elif mode == 'recurring_booking':
+        check_recurring_booking(*[int(arg) for arg in sys.argv[2:3]])
+    elif mode == 'archive':
+        check_archive()
+    elif mode == 'prescription_analytics':
+        check_prescription_analytics()
+    elif mode == 'metrics':
+        check_metrics()
+    elif mode == 'identity':
+        check_identity()
+    elif mode == 'roster':
+        check_roster()
+    elif mode == 'reception_streams':
+        check_reception_streams()
+    elif mode == 'availability':
+        check_availability()
+    elif mode == 'import_patients':
+        check_import_patients()
+    elif mode == 'unit_of_work':
+        check_unit_of_work()
+    elif mode == 'search':
+        check_search()
+    elif mode == 'conditional_get':
+        check_conditional_get()
+    elif mode == 'passwords':
+        check_passwords()